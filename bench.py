@@ -0,0 +1,797 @@
+"""
+Нагрузочный бенчмарк бота без Telegram.
+
+Апдейты прогоняются через настоящий Dispatcher (build_dispatcher из bot.py),
+запросы к Bot API перехватывает FakeSession, база — временный файл.
+
+Режимы доставки апдейтов (--mode):
+    feed     — dp.feed_update напрямую (латентность хендлеров)
+    webhook  — локальный aiohttp-сервер вебхука, апдейты приходят POST-запросами
+    polling  — dp.start_polling, FakeSession отдаёт апдейты пачками на getUpdates
+    broadcast — рассылка всем пользователям через Outbox (лимиты, RetryAfter, пиковая скорость)
+
+Сценарии (--scenario): последовательности апдейтов одного пользователя,
+пользователи идут параллельно (до --concurrency). Для каждого сценария —
+пропускная способность, p50/p95/p99 и число SQL-запросов на апдейт
+(через sqlite3 set_trace_callback на всех соединениях пула):
+    registration  — /start → имя → запрос доступа → админ одобряет
+    grade_entry   — добавление оценок кнопками и вводом
+    cabinet       — личный кабинет
+    leaderboard   — лидерборд и его inline-переключатели
+    admin         — админка: список, оценка пользователю, /cache
+    mixed         — всё вперемешку
+
+Пример:
+    python bench.py --scenario all --json results.json
+    python bench.py --scenario all --compare results.json   # сравнить с прошлым прогоном
+    python bench.py --users 200 --grades 20 --updates 2000 --concurrency 100
+    python bench.py --blocking   # «до»: SQLite вызывается прямо в event loop
+    python bench.py --record updates.jsonl
+    python bench.py --mode webhook --replay updates.jsonl --api-latency 0.05
+    python bench.py --mode polling --replay updates.jsonl --api-latency 0.05
+    python bench.py --storage memory   # FSM в памяти вместо SQLiteStorage
+    python bench.py --mode broadcast --users 500 --flood-every 100
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import sqlite3
+import random
+import functools
+import tempfile
+import json
+import platform
+import subprocess
+import threading
+from datetime import datetime
+
+os.environ.setdefault("TOKEN", "123456:BENCHMARK-TOKEN")
+# админы для сценариев админки; очередь уведомлений без лимитов Telegram —
+# меряем стоимость хендлеров, а не ожидание токенов (см. --mode broadcast)
+BENCH_ADMINS = [1, 2, 3, 4]
+os.environ.setdefault("ADMIN_IDS", ",".join(map(str, BENCH_ADMINS)))
+os.environ.setdefault("OUTBOX_RATE", "1000000")
+os.environ.setdefault("OUTBOX_CHAT_RATE", "1000000")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import bot as app
+
+from aiogram import Bot
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetMe, GetUpdates, SendMessage
+from aiogram.types import Update, Message, Chat, User, CallbackQuery
+
+
+class FakeSession(BaseSession):
+    """Сессия, которая отвечает на запросы Bot API локально (с опциональной задержкой)."""
+
+    def __init__(self, latency: float = 0.0, updates: list[Update] | None = None, flood_every: int = 0):
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+        self._message_id = 0
+        # каждый flood_every-й sendMessage отвечает RetryAfter (0 — никогда)
+        self.flood_every = flood_every
+        self.sent_at: list[float] = []
+        # очередь апдейтов для getUpdates (режим polling)
+        self.pending_updates = list(updates or [])
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, GetUpdates):
+            if not self.pending_updates:
+                await asyncio.sleep(0.01)
+                return []
+            limit = method.limit or 100
+            batch, self.pending_updates = self.pending_updates[:limit], self.pending_updates[limit:]
+            return batch
+        if isinstance(method, GetMe):
+            return User(id=1, is_bot=True, first_name="bench", username="bench_bot")
+        if isinstance(method, SendMessage):
+            if self.flood_every and self.requests % self.flood_every == 0:
+                raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+            self._message_id += 1
+            self.sent_at.append(time.perf_counter())
+            return Message(
+                message_id=self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=int(method.chat_id), type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def seed_db(path: str, users: int, grades_per_user: int):
+    app.DB_NAME = path
+    app.db_init()
+    subjects = app.get_subjects()
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO users(tg_id, full_name, is_verified) VALUES(?, ?, 1)",
+        [(1000 + i, f"User{i} Bench") for i in range(users)],
+    )
+    conn.executemany(
+        "INSERT INTO grades(tg_id, subject, grade) VALUES(?, ?, ?)",
+        [
+            (1000 + i, random.choice(subjects), round(random.uniform(2.0, 5.0), 2))
+            for i in range(users)
+            for _ in range(grades_per_user)
+        ],
+    )
+    conn.commit()
+    conn.close()
+    app.warm_caches()
+
+
+def make_message_update(update_id: int, tg_id: int, text: str) -> Update:
+    user = User(id=tg_id, is_bot=False, first_name=f"User{tg_id}")
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=Chat(id=tg_id, type="private"),
+            from_user=user,
+            text=text,
+        ),
+    )
+
+
+def make_callback_update(update_id: int, tg_id: int, data: str) -> Update:
+    user = User(id=tg_id, is_bot=False, first_name=f"User{tg_id}")
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=tg_id, type="private"),
+        from_user=User(id=1, is_bot=True, first_name="bench"),
+        text="…",
+    )
+    return Update(
+        update_id=update_id,
+        callback_query=CallbackQuery(id=str(update_id), from_user=user, chat_instance="bench", message=message, data=data),
+    )
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def make_updates(args) -> list[Update]:
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            return [Update.model_validate(json.loads(line)) for line in f if line.strip()]
+    texts = [app.BTN_CAB, app.BTN_TOP, app.BTN_ADD, app.BTN_HELP]
+    return [
+        make_message_update(i, 1000 + random.randrange(args.users), random.choice(texts))
+        for i in range(1, args.updates + 1)
+    ]
+
+
+def record_updates(path: str, updates: list[Update]):
+    with open(path, "w", encoding="utf-8") as f:
+        for u in updates:
+            f.write(u.model_dump_json(exclude_none=True) + "\n")
+
+
+class CompletionTracker:
+    """Outer-middleware на dp.update: время окончания обработки каждого апдейта."""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.finished: dict[int, float] = {}
+        self.done = asyncio.Event()
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.finished[event.update_id] = time.perf_counter()
+            if len(self.finished) >= self.expected:
+                self.done.set()
+
+
+def summarize(updates: list[Update], started: dict[int, float], tracker: CompletionTracker, elapsed: float, session) -> dict:
+    latencies = [tracker.finished[u] - started[u] for u in tracker.finished if u in started]
+    return {
+        "updates": len(updates),
+        "handled": len(tracker.finished),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(tracker.finished) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "api_requests": session.requests,
+    }
+
+
+class QueryCounter:
+    """Счётчик SQL-выражений через set_trace_callback (строки «-- TRIGGER» не считаем)."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, statement: str):
+        if not statement.startswith("--"):
+            with self._lock:
+                self.count += 1
+
+    def install(self):
+        """Подключается ко всем соединениям, которые пул откроет после вызова."""
+        open_conn = app.DBPool._open
+
+        def _open(pool):
+            conn = open_conn(pool)
+            conn.set_trace_callback(self)
+            return conn
+
+        app.DBPool._open = _open
+
+
+# Сценарий: (uid, rnd) -> список шагов ("m", текст) / ("c", callback_data) / ("admin-c", callback_data)
+def scenario_registration(uid: int, rnd: random.Random) -> list:
+    return [
+        ("m", "/start"),
+        ("m", f"Новый{uid} Пользователь"),
+        ("m", app.BTN_GET_CODE),
+        ("admin-c", f"auth:accept:{uid}"),
+        ("m", "/start"),
+    ]
+
+
+def scenario_grade_entry(uid: int, rnd: random.Random) -> list:
+    subject = rnd.choice(app.SUBJECTS.names())
+    return [
+        ("m", app.BTN_ADD),
+        ("m", subject),
+        ("m", rnd.choice(["2", "3", "4", "5"])),
+        ("m", app.BTN_ADD_SAME),
+        ("m", app.BTN_GOTHER),
+        ("m", f"{rnd.uniform(2, 5):.2f}".replace(".", ",")),
+        ("m", app.BTN_OTHER_SUBJ),
+        ("m", rnd.choice(app.SUBJECTS.names())),
+        ("m", "5"),
+        ("m", app.BTN_TO_MENU),
+    ]
+
+
+def scenario_cabinet(uid: int, rnd: random.Random) -> list:
+    return [("m", app.BTN_CAB), ("m", app.BTN_HELP), ("m", app.BTN_CAB)]
+
+
+def scenario_leaderboard(uid: int, rnd: random.Random) -> list:
+    subject = rnd.choice(app.SUBJECTS.names())
+    return [
+        ("m", app.BTN_TOP),
+        ("c", "top:w:*"),
+        ("c", "top:m:*"),
+        ("c", "top:subj:"),
+        ("c", f"top:all:{subject}"),
+        ("c", f"top:t:{subject}"),
+        ("c", "top:imp:*"),
+    ]
+
+
+def scenario_admin(uid: int, rnd: random.Random, target: int = 1000) -> list:
+    return [
+        ("m", app.BTN_ADMIN),
+        ("m", app.BTN_ADM_LIST),
+        ("c", f"ul:a:n:{target}"),
+        ("c", "ul:find"),
+        ("m", "user1"),
+        ("c", f"ul:s:n:{target + 1}"),
+        ("m", app.BTN_ADM_ADD_GRADE),
+        ("m", str(target)),
+        ("m", rnd.choice(app.SUBJECTS.names())),
+        ("m", rnd.choice(["3", "4", "5"])),
+        ("m", "/cache"),
+        ("m", app.BTN_ADM_ANALYTICS),
+        ("m", app.BTN_ADM_BACK),
+    ]
+
+
+SCENARIOS = {
+    "registration": scenario_registration,
+    "grade_entry": scenario_grade_entry,
+    "cabinet": scenario_cabinet,
+    "leaderboard": scenario_leaderboard,
+    "admin": scenario_admin,
+}
+
+
+class ScenarioRunner:
+    """Гоняет сценарии через один Dispatcher и одну базу, по очереди."""
+
+    def __init__(self, args, counter: QueryCounter):
+        self.args = args
+        self.counter = counter
+        self.rnd = random.Random(args.seed)
+        self.update_id = 0
+        self.next_new_user = 10_000_000
+
+    def _update(self, uid: int, step: tuple) -> Update:
+        self.update_id += 1
+        kind, payload = step
+        if kind == "m":
+            return make_message_update(self.update_id, uid, payload)
+        if kind == "c":
+            return make_callback_update(self.update_id, uid, payload)
+        return make_callback_update(self.update_id, BENCH_ADMINS[0], payload)
+
+    def _sessions(self, name: str) -> list[tuple[int, list]]:
+        """Список (uid, шаги) на прогон сценария; у одного uid шаги строго по порядку."""
+        n, args = self.args.sessions, self.args
+        if name == "registration":
+            sessions = []
+            for _ in range(n):
+                self.next_new_user += 1
+                sessions.append((self.next_new_user, scenario_registration(self.next_new_user, self.rnd)))
+            return sessions
+        if name == "admin":
+            # у админа своё FSM-состояние — сессии одного админа идут подряд
+            return [
+                (BENCH_ADMINS[i % len(BENCH_ADMINS)],
+                 scenario_admin(0, self.rnd, target=1000 + self.rnd.randrange(args.users)))
+                for i in range(n)
+            ]
+        if name == "mixed":
+            names = ["grade_entry", "cabinet", "leaderboard", "cabinet", "leaderboard", "registration", "admin"]
+            sessions = []
+            for _ in range(n):
+                sessions.extend(self._sessions_one(self.rnd.choice(names)))
+            return sessions
+        users = self.rnd.sample(range(1000, 1000 + args.users), min(n, args.users))
+        return [(uid, SCENARIOS[name](uid, self.rnd)) for uid in users]
+
+    def _sessions_one(self, name: str) -> list[tuple[int, list]]:
+        keep = self.args.sessions
+        self.args.sessions = 1
+        try:
+            return self._sessions(name)
+        finally:
+            self.args.sessions = keep
+
+    async def run(self, name: str) -> dict:
+        dp = make_dispatcher(self.args)
+        session = FakeSession(latency=self.args.api_latency)
+        tg_bot = Bot(app.TOKEN, session=session)
+        sessions = self._sessions(name)
+
+        # сессии одного uid выполняются последовательно в одной корутине
+        by_user: dict[int, list[list]] = {}
+        for uid, steps in sessions:
+            by_user.setdefault(uid, []).append(steps)
+
+        latencies: list[float] = []
+        errors = 0
+        sem = asyncio.Semaphore(self.args.concurrency)
+
+        async def user_flow(uid: int, runs: list[list]):
+            nonlocal errors
+            async with sem:
+                for steps in runs:
+                    for step in steps:
+                        update = self._update(uid, step)
+                        t = time.perf_counter()
+                        try:
+                            await dp.feed_update(tg_bot, update)
+                        except Exception:
+                            errors += 1
+                        latencies.append(time.perf_counter() - t)
+
+        queries_before = self.counter.count
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user_flow(uid, runs) for uid, runs in by_user.items()))
+        elapsed = time.perf_counter() - t0
+        queries = self.counter.count - queries_before
+        await app.OUTBOX.close()
+        await dp.storage.close()
+        await tg_bot.session.close()
+
+        handled = len(latencies)
+        return {
+            "sessions": len(sessions),
+            "updates": handled,
+            "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_ups": round(handled / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(max(latencies, default=0.0) * 1000, 2),
+            "db_queries": queries,
+            "queries_per_update": round(queries / handled, 2) if handled else 0.0,
+            "api_requests": session.requests,
+        }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_scenarios(args) -> dict:
+    names = list(SCENARIOS) + ["mixed"] if args.scenario == "all" else args.scenario.split(",")
+    unknown = [n for n in names if n not in SCENARIOS and n != "mixed"]
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(unknown)}")
+
+    counter = QueryCounter()
+    counter.install()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_db(os.path.join(tmp, "bench.db"), args.users, args.grades)
+        for tg_id in BENCH_ADMINS:
+            app.upsert_user(tg_id, f"Admin{tg_id} Bench")
+            app.set_user_verified(tg_id, 1)
+        runner = ScenarioRunner(args, counter)
+        for name in names:
+            results[name] = asyncio.run(runner.run(name))
+        app.db_close()
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "params": {k: getattr(args, k) for k in ("users", "grades", "sessions", "concurrency", "api_latency", "storage", "seed")},
+        "scenarios": results,
+    }
+
+
+def print_scenarios(report: dict, baseline: dict | None = None):
+    cols = ("updates", "throughput_ups", "p50_ms", "p95_ms", "p99_ms", "queries_per_update", "errors")
+    print(f"{'scenario':<14}" + "".join(f"{c:>20}" for c in cols))
+    for name, r in report["scenarios"].items():
+        row = f"{name:<14}" + "".join(f"{r[c]:>20}" for c in cols)
+        print(row)
+        base = (baseline or {}).get("scenarios", {}).get(name)
+        if base:
+            diff = []
+            for c in cols:
+                if base.get(c):
+                    diff.append(f"{(r[c] - base[c]) / base[c] * 100:>+19.1f}%")
+                else:
+                    diff.append(f"{'—':>20}")
+            print(f"{'  vs base':<14}" + "".join(diff))
+
+
+def make_dispatcher(args):
+    storage = MemoryStorage() if args.storage == "memory" else app.SQLiteStorage()
+    return app.build_dispatcher(storage=storage)
+
+
+async def run_feed(args, updates: list[Update]) -> dict:
+    dp = make_dispatcher(args)
+    tracker = CompletionTracker(len(updates))
+    dp.update.outer_middleware(tracker)
+    session = FakeSession(latency=args.api_latency)
+    tg_bot = Bot(app.TOKEN, session=session)
+
+    started: dict[int, float] = {}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(update: Update):
+        async with sem:
+            started[update.update_id] = time.perf_counter()
+            await dp.feed_update(tg_bot, update)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in updates))
+    elapsed = time.perf_counter() - t0
+    await dp.storage.close()
+    await tg_bot.session.close()
+    return summarize(updates, started, tracker, elapsed, session)
+
+
+async def run_webhook(args, updates: list[Update]) -> dict:
+    import aiohttp
+    from aiohttp import web
+
+    dp = make_dispatcher(args)
+    tracker = CompletionTracker(len(updates))
+    dp.update.outer_middleware(tracker)
+    session = FakeSession(latency=args.api_latency)
+    tg_bot = Bot(app.TOKEN, session=session)
+
+    web_app = app.build_webhook_app(dp, tg_bot)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+
+    url = f"http://127.0.0.1:{args.port}{app.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": app.WEBHOOK_SECRET} if app.WEBHOOK_SECRET else {}
+    started: dict[int, float] = {}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession() as http:
+        async def post(update: Update):
+            async with sem:
+                started[update.update_id] = time.perf_counter()
+                body = update.model_dump(mode="json", exclude_none=True)
+                async with http.post(url, json=body, headers=headers) as resp:
+                    resp.raise_for_status()
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates))
+        await asyncio.wait_for(tracker.done.wait(), timeout=300)
+        elapsed = time.perf_counter() - t0
+
+    result = summarize(updates, started, tracker, elapsed, session)
+    await site.stop()
+    await runner.cleanup()
+    return result
+
+
+async def run_polling(args, updates: list[Update]) -> dict:
+    dp = make_dispatcher(args)
+    tracker = CompletionTracker(len(updates))
+    dp.update.outer_middleware(tracker)
+    session = FakeSession(latency=args.api_latency, updates=updates)
+    tg_bot = Bot(app.TOKEN, session=session)
+
+    t0 = time.perf_counter()
+    # все апдейты «пришли» в момент старта: латентность включает ожидание в очереди getUpdates
+    started = {u.update_id: t0 for u in updates}
+    polling = asyncio.create_task(dp.start_polling(tg_bot, handle_signals=False, close_bot_session=False))
+    await asyncio.wait_for(tracker.done.wait(), timeout=300)
+    elapsed = time.perf_counter() - t0
+    await dp.stop_polling()
+    await polling
+    await tg_bot.session.close()
+    return summarize(updates, started, tracker, elapsed, session)
+
+
+def peak_per_second(times: list[float]) -> int:
+    """Максимум отправок в любом скользящем окне длиной 1 с."""
+    times = sorted(times)
+    peak = lo = 0
+    for hi, t in enumerate(times):
+        while t - times[lo] >= 1.0:
+            lo += 1
+        peak = max(peak, hi - lo + 1)
+    return peak
+
+
+async def run_broadcast(args, updates: list[Update]) -> dict:
+    session = FakeSession(latency=args.api_latency, flood_every=args.flood_every)
+    tg_bot = Bot(app.TOKEN, session=session)
+    outbox = app.Outbox(rate=args.outbox_rate)
+    chat_ids = app.list_verified_user_ids()
+
+    t0 = time.perf_counter()
+    ok, failed = await outbox.broadcast(tg_bot, chat_ids, "📣 bench")
+    elapsed = time.perf_counter() - t0
+    await outbox.close()
+    await tg_bot.session.close()
+    return {
+        "messages": len(chat_ids),
+        "delivered": ok,
+        "failed": failed,
+        "retried": outbox.retried,
+        "elapsed_s": round(elapsed, 3),
+        "rate_mps": round(ok / elapsed, 1) if elapsed else 0.0,
+        "peak_1s": peak_per_second(session.sent_at),
+        "api_requests": session.requests,
+    }
+
+
+async def run_writes(args, updates: list[Update]) -> dict:
+    """
+    Всплеск записей: --concurrency одновременных добавлений оценки (класс после
+    контрольной), повторяется до --updates записей. --group-commit-max 1 —
+    commit на каждую оценку, для сравнения.
+    """
+    app.GROUP_COMMIT.max_batch = args.group_commit_max
+    users = list(range(1000, 1000 + args.users))
+    subjects = app.SUBJECTS.names()
+    latencies: list[float] = []
+
+    async def add_one():
+        t = time.perf_counter()
+        await app.run_db(app.add_grade_db, random.choice(users), random.choice(subjects), random.choice([3, 4, 5]))
+        latencies.append(time.perf_counter() - t)
+
+    before = app.GROUP_COMMIT.stats()
+    t0 = time.perf_counter()
+    done = 0
+    while done < args.updates:
+        burst = min(args.concurrency, args.updates - done)
+        await asyncio.gather(*(add_one() for _ in range(burst)))
+        done += burst
+    elapsed = time.perf_counter() - t0
+    commits = app.GROUP_COMMIT.stats()["batches"] - before["batches"]
+    return {
+        "writes": done,
+        "burst": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "writes_per_s": round(done / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "commits": commits,
+        "avg_batch": round(done / commits, 1) if commits else 0.0,
+    }
+
+
+async def run_multiprocess(args, updates: list[Update]) -> dict:
+    """
+    Многопроцессный режим: апдейты раздаются --workers процессам по chat_id,
+    запись идёт через единственный пишущий поток этого процесса. Время — от
+    первого апдейта до остановки всех воркеров (всё обработано, FSM сброшен).
+    """
+    pool = app.WorkerPool(args.workers, session_factory=functools.partial(FakeSession, latency=args.api_latency))
+    await pool.start()
+    raw = [update.model_dump(mode="json", by_alias=True, exclude_none=True) for update in updates]
+    t0 = time.perf_counter()
+    for update in raw:
+        pool.dispatch(update)
+    await pool.stop(timeout=600)
+    elapsed = time.perf_counter() - t0
+    return {
+        "workers": args.workers,
+        "updates": len(raw),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(raw) / elapsed, 1) if elapsed else 0.0,
+        "writes": pool.server.calls,
+    }
+
+
+async def startup_child(args):
+    """Выполняется в дочернем процессе --mode startup: старт бота и вывод таймингов."""
+    tg_bot = Bot(app.TOKEN, session=FakeSession(latency=args.api_latency))
+    timings = await app.startup(tg_bot)
+    print(json.dumps(timings), flush=True)
+    await app.OUTBOX.close()
+    await tg_bot.session.close()
+    app.db_close()
+
+
+async def run_startup(args, updates: list[Update]) -> dict:
+    """
+    Холодный старт: новый процесс на уже заполненной базе, время от запуска
+    интерпретатора до готовности принимать апдейты (медиана по --repeat запускам).
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), "--startup-child", app.DB_NAME,
+           "--api-latency", str(args.api_latency)]
+    app.db_close()  # дочерний процесс открывает базу сам
+    walls, imports, inits, owns = [], [], [], []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        timings = None
+        while timings is None:
+            line = await proc.stdout.readline()
+            if not line:
+                raise SystemExit("дочерний процесс завершился, не сообщив тайминги")
+            if line.startswith(b"{"):
+                timings = json.loads(line)
+        walls.append(time.perf_counter() - t0)
+        imports.append(timings["import"])
+        inits.append(timings["init"])
+        owns.append(timings["own"])
+        await proc.wait()
+
+    # нижняя граница: интерпретатор + импорт aiogram (pydantic-модели типов), на неё бот не влияет
+    floors = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(sys.executable, "-c", "import aiogram.types")
+        await proc.wait()
+        floors.append(time.perf_counter() - t0)
+
+    wall_ms = percentile(walls, 50) * 1000
+    own_ms = percentile(owns, 50)
+    return {
+        "runs": args.repeat,
+        "wall_ms": round(wall_ms, 1),
+        "wall_max_ms": round(max(walls) * 1000, 1),
+        "module_load_ms": round(percentile(imports, 50), 1),
+        "init_ms": round(percentile(inits, 50), 1),
+        "aiogram_floor_ms": round(percentile(floors, 50) * 1000, 1),
+        # цель — на собственную подготовку бота: без импорта aiogram, который от бота не зависит
+        "own_ms": round(own_ms, 1),
+        "target_ms": app.STARTUP_TARGET_MS,
+        "within_target": own_ms <= app.STARTUP_TARGET_MS,
+    }
+
+
+MODES = {
+    "feed": run_feed,
+    "webhook": run_webhook,
+    "polling": run_polling,
+    "broadcast": run_broadcast,
+    "startup": run_startup,
+    "workers": run_multiprocess,
+    "writes": run_writes,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк хендлеров")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--grades", type=int, default=20, help="оценок на пользователя")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, сек")
+    parser.add_argument("--blocking", action="store_true", help="вызывать SQLite прямо в event loop (как раньше)")
+    parser.add_argument("--mode", choices=sorted(MODES), default="feed", help="как доставлять апдейты")
+    parser.add_argument("--port", type=int, default=8099, help="порт локального вебхук-сервера")
+    parser.add_argument("--storage", choices=["sqlite", "memory"], default="sqlite", help="хранилище FSM")
+    parser.add_argument("--outbox-rate", type=float, default=app.OUTBOX_RATE, help="broadcast: общий лимит, сообщений/сек")
+    parser.add_argument("--flood-every", type=int, default=0, help="broadcast: каждый N-й sendMessage получает RetryAfter")
+    parser.add_argument("--scenario", metavar="NAMES", help="all или через запятую: " + ", ".join(list(SCENARIOS) + ["mixed"]))
+    parser.add_argument("--sessions", type=int, default=300, help="сценарии: сессий на сценарий")
+    parser.add_argument("--seed", type=int, default=42, help="сценарии: seed генератора")
+    parser.add_argument("--json", metavar="FILE", help="сценарии: сохранить результаты в JSON")
+    parser.add_argument("--compare", metavar="FILE", help="сценарии: сравнить с сохранённым JSON")
+    parser.add_argument("--group-commit-max", type=int, default=app.GROUP_COMMIT_MAX, help="writes: записей в одной транзакции (1 — commit на каждую)")
+    parser.add_argument("--workers", type=int, default=2, help="workers: число процессов-обработчиков")
+    parser.add_argument("--repeat", type=int, default=5, help="startup: число запусков")
+    parser.add_argument("--startup-child", metavar="DB", help=argparse.SUPPRESS)
+    parser.add_argument("--record", metavar="FILE", help="сохранить сгенерированные апдейты в JSONL и выйти")
+    parser.add_argument("--replay", metavar="FILE", help="взять апдейты из JSONL (записанного через --record)")
+    args = parser.parse_args()
+
+    if args.startup_child:
+        app.DB_NAME = args.startup_child
+        asyncio.run(startup_child(args))
+        return 0
+
+    if args.scenario:
+        random.seed(args.seed)
+        report = run_scenarios(args)
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+        print_scenarios(report, baseline)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"Результаты: {args.json}")
+        return 0
+
+    updates = make_updates(args)
+    if args.record:
+        record_updates(args.record, updates)
+        print(f"Записано апдейтов: {len(updates)} -> {args.record}")
+        return 0
+
+    if args.blocking:
+        async def run_db_inline(func, *a, **kw):
+            return func(*a, **kw)
+        app.run_db = run_db_inline
+
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_db(os.path.join(tmp, "bench.db"), args.users, args.grades)
+        result = asyncio.run(MODES[args.mode](args, updates))
+
+    mode = f"{args.mode}/{'blocking' if args.blocking else 'executor'}/{args.storage}"
+    print(f"[{mode}] " + " ".join(f"{k}={v}" for k, v in result.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
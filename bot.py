@@ -1,23 +1,48 @@
 import os
+import sys
+import io
 from dotenv import load_dotenv
 import asyncio
 import sqlite3
 import logging
+import signal
 import random
-from datetime import datetime
+import reprlib
+import bisect
+import heapq
+import functools
+import itertools
+import json
+import time
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+# отсчёт холодного старта (см. startup); импорт aiogram ниже — основная его часть.
+# multiprocessing, pickle, sortedcontainers, matplotlib, numpy, openpyxl импортируются там,
+# где нужны: polling/webhook без воркеров и CLI-режимы их не грузят
+PROCESS_STARTED = time.perf_counter()
 
 load_dotenv()
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.types import BufferedInputFile, InputFile, Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+
+# pydantic-модели всех типов Bot API; от кода бота не зависит и в цель старта не входит
+AIOGRAM_LOADED = time.perf_counter()
 
 # ========= НАСТРОЙКИ =========
 TOKEN = os.getenv("TOKEN")
-if not TOKEN:
-    raise SystemExit("TOKEN не найден. Создай .env и добавь TOKEN=...")
 
 raw_admins = os.getenv("ADMIN_IDS", "")
 ADMIN_IDS = {int(x.strip()) for x in raw_admins.split(",") if x.strip().isdigit()}
@@ -28,6 +53,64 @@ print("ADMIN_IDS =", ADMIN_IDS)
 REQUEST_COOLDOWN_SEC = 600  # 10 минут
 DB_NAME = "grades.db"
 
+# Хранилище состояний FSM: "sqlite" (переживает перезапуск) или "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))  # сек простоя, после которых состояние забывается
+
+# Очередь исходящих уведомлений и рассылок. Лимиты Telegram: ~30 сообщений/сек
+# на бота и ~1 сообщение/сек в один чат — держимся немного ниже.
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_MAX_ATTEMPTS = 5
+
+# Webhook-режим (python bot.py --webhook). WEBHOOK_URL — публичный адрес без пути,
+# например https://bot.example.com; если не задан, вебхук в Telegram не регистрируется
+# (удобно, когда его выставляет reverse proxy или для локальных тестов).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_DRAIN_TIMEOUT = 10  # сек на дообработку апдейтов при остановке
+
+# Group commit для добавления оценок: записи, пришедшие, пока идёт предыдущий
+# commit, уходят одной транзакцией (до GROUP_COMMIT_MAX). GROUP_COMMIT_DELAY_MS > 0 —
+# дополнительно ждать добора; при synchronous=NORMAL это только добавляет задержку.
+GROUP_COMMIT_MAX = int(os.getenv("GROUP_COMMIT_MAX", "128"))
+GROUP_COMMIT_DELAY_MS = float(os.getenv("GROUP_COMMIT_DELAY_MS", "0"))
+
+# Многопроцессный режим (python bot.py --workers N или WORKERS=N): главный процесс
+# принимает апдейты (polling или webhook), пишет в базу и раздаёт апдейты
+# N воркерам по chat_id. 0 или 1 — обычный однопроцессный режим.
+WORKERS = int(os.getenv("WORKERS", "0"))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0 — выключить).
+# Хендлеры и DB-хелперы медленнее порогов попадают в лог как slow.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+SLOW_HANDLER_MS = float(os.getenv("SLOW_HANDLER_MS", "500"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+
+# Цель холодного старта: собственная подготовка бота от запуска процесса до готовности
+# принимать апдейты, без импорта aiogram (~1.5 с на медленных машинах, от бота не зависит).
+# Превышение — warning в логе (python bench.py --mode startup меряет со стороны).
+STARTUP_TARGET_MS = float(os.getenv("STARTUP_TARGET_MS", "500"))
+
+# Графики «📈 Динамика»: скользящая средняя за CHART_WINDOW_DAYS дней, не больше
+# CHART_MAX_POINTS точек на предмет. Рисуются в пуле из CHART_WORKERS процессов,
+# готовые хранятся для CHART_CACHE_SIZE пользователей.
+CHART_WINDOW_DAYS = int(os.getenv("CHART_WINDOW_DAYS", "30"))
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", "120"))
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "1"))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "256"))
+
+# Отчёт «📊 Аналитика» считается по колоночному снимку grades (NumPy memmap в
+# ANALYTICS_DIR, по умолчанию рядом с базой: <DB_NAME>.analytics). Снимок
+# перестраивается не чаще раза в ANALYTICS_REFRESH_SEC и только если оценки менялись.
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "")
+ANALYTICS_REFRESH_SEC = int(os.getenv("ANALYTICS_REFRESH_SEC", "600"))
+
 # ========= ЛОГИ =========
 logging.basicConfig(
     level=logging.INFO,
@@ -35,10 +118,168 @@ logging.basicConfig(
 )
 log = logging.getLogger("grades-bot")
 
+# ========= МЕТРИКИ =========
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """
+    Минимальный реестр метрик (counter / gauge / histogram) с выводом
+    в текстовом формате Prometheus — без prometheus_client.
+    Метки передаются keyword-аргументами; обновления потокобезопасны
+    (DB-хелперы пишут метрики из потоков пула).
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta: dict[str, tuple[str, str]] = {}
+        self._values: dict[str, dict[tuple, float]] = {}
+        self._hists: dict[str, dict[tuple, list]] = {}
+        self._collectors: list = []
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        if kind == "histogram":
+            self._hists.setdefault(name, {})
+        else:
+            self._values.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(labels.items())
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._hists[name].get(key)
+            if h is None:
+                # [счётчики по корзинам (+Inf последней), сумма, количество]
+                h = self._hists[name][key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def collector(self, func):
+        """func() -> [(имя, тип, описание, значение)], вызывается при каждом render()."""
+        self._collectors.append(func)
+        return func
+
+    @staticmethod
+    def _labels(key: tuple, le: str | None = None) -> str:
+        pairs = [(k, str(v)) for k, v in key]
+        if le is not None:
+            pairs.append(("le", le))
+        if not pairs:
+            return ""
+        escaped = (
+            (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+            for k, v in pairs
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind != "histogram":
+                    for key, value in self._values[name].items():
+                        lines.append(f"{name}{self._labels(key)} {value:g}")
+                    continue
+                for key, (counts, total, count) in self._hists[name].items():
+                    acc = 0
+                    for bound, c in zip(self.buckets + (float("inf"),), counts):
+                        acc += c
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket{self._labels(key, le)} {acc}")
+                    lines.append(f"{name}_sum{self._labels(key)} {total:g}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+        for func in self._collectors:
+            try:
+                for name, kind, help_text, value in func():
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.append(f"{name} {value:g}")
+            except Exception:
+                log.exception("metrics: ошибка коллектора %s", func.__name__)
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("bot_handler_seconds", "histogram", "Время обработки апдейта хендлером")
+METRICS.describe("bot_handler_total", "counter", "Вызовы хендлеров по результату")
+METRICS.describe("bot_handler_in_flight", "gauge", "Хендлеры, выполняющиеся сейчас")
+METRICS.describe("bot_db_seconds", "histogram", "Время выполнения DB-хелпера (в потоке пула)")
+METRICS.describe("bot_db_queue_seconds", "histogram", "Ожидание свободного потока пула DB")
+METRICS.describe("bot_db_errors_total", "counter", "Исключения в DB-хелперах")
+METRICS.describe("bot_db_in_flight", "gauge", "DB-хелперы, выполняющиеся сейчас")
+METRICS.describe("bot_slow_total", "counter", "Вызовы медленнее порога SLOW_HANDLER_MS / SLOW_QUERY_MS")
+
+
+def _db_observe(name: str, started: float, args: tuple, failed: bool):
+    elapsed = time.perf_counter() - started
+    if failed:
+        METRICS.inc("bot_db_errors_total", helper=name)
+    METRICS.inc("bot_db_in_flight", -1, helper=name)
+    METRICS.observe("bot_db_seconds", elapsed, helper=name)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        METRICS.inc("bot_slow_total", kind="db")
+        log.warning("slow db %s: %.1f ms args=%s", name, elapsed * 1000, reprlib.repr(args))
+
+
+def db_timed(func):
+    """Декоратор DB-хелпера: гистограмма времени, ошибки, in-flight и slow-лог."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        METRICS.inc("bot_db_in_flight", helper=name)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _db_observe(name, started, args, failed)
+
+    return wrapper
+
+
+def db_timed_future(name: str, future: Future, args: tuple = ()) -> Future:
+    """
+    Те же метрики под именем хелпера для записи, ушедшей в GROUP_COMMIT мимо
+    его обёртки: время — от постановки в очередь до commit пачки.
+    """
+    METRICS.inc("bot_db_in_flight", helper=name)
+    started = time.perf_counter()
+    future.add_done_callback(lambda f: _db_observe(name, started, args, f.exception() is not None))
+    return future
+
+
+# Хелперы, которые пишут в базу. В многопроцессном режиме воркеры не вызывают
+# их сами, а отправляют пишущему процессу (см. run_db и раздел WORKERS).
+WRITE_OPS: dict[str, object] = {}
+
+
+def db_write_op(func):
+    """Помечает DB-хелпер как пишущий (ставится поверх @db_timed)."""
+    func.db_write_op = True
+    WRITE_OPS[func.__name__] = func
+    return func
+
+
 # ========= КНОПКИ =========
 BTN_ADD = "➕ Добавить оценку"
 BTN_CAB = "📊 Личный кабинет"
 BTN_TOP = "🏆 Лидерборд"
+BTN_DYNAMICS = "📈 Динамика"
 BTN_HELP = "ℹ️ Помощь"
 BTN_CANCEL = "❌ Отмена"
 BTN_GET_CODE = "📩 Запросить доступ"
@@ -54,6 +295,10 @@ BTN_ADM_DEMO = "🤖 Добавить демо-пользователей"
 BTN_ADM_ADD_GRADE = "➕ Оценка пользователю"
 BTN_ADM_DEL_GRADE = "🗑 Удалить оценку пользователю"
 BTN_ADM_CLEAR_GRADES = "🧹 Очистить оценки пользователю"
+BTN_ADM_BROADCAST = "📣 Рассылка"
+BTN_ADM_IMPORT = "📥 Импорт оценок (CSV)"
+BTN_ADM_ANALYTICS = "📊 Аналитика"
+BTN_ADM_EXPORT = "📤 Экспорт оценок"
 
 BTN_NEW_SUBJ = "➕ Новый предмет"
 BTN_ADD_SAME = "✅ Ещё по этому предмету"
@@ -73,16 +318,24 @@ def is_admin(tg_id: int) -> bool:
 
 
 def main_kb(tg_id: int) -> ReplyKeyboardMarkup:
+    return _main_kb(is_admin(tg_id))
+
+
+# Клавиатуры не меняются во время работы, поэтому строятся один раз
+@functools.lru_cache(maxsize=None)
+def _main_kb(admin: bool) -> ReplyKeyboardMarkup:
     rows = [
         [KeyboardButton(text=BTN_ADD), KeyboardButton(text=BTN_CAB)],
-        [KeyboardButton(text=BTN_TOP), KeyboardButton(text=BTN_DEL_ONE)],
-        [KeyboardButton(text=BTN_DEL_ALL), KeyboardButton(text=BTN_HELP)],
+        [KeyboardButton(text=BTN_TOP), KeyboardButton(text=BTN_DYNAMICS)],
+        [KeyboardButton(text=BTN_DEL_ONE), KeyboardButton(text=BTN_DEL_ALL)],
+        [KeyboardButton(text=BTN_HELP)],
     ]
-    if is_admin(tg_id):
+    if admin:
         rows.append([KeyboardButton(text=BTN_ADMIN)])
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
 
+@functools.lru_cache(maxsize=None)
 def cancel_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=BTN_CANCEL)]],
@@ -90,6 +343,7 @@ def cancel_kb() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def unauth_kb() -> ReplyKeyboardMarkup:
     # Клавиатура для неавторизованного пользователя: запросить код у админа или отмена
     return ReplyKeyboardMarkup(
@@ -101,14 +355,17 @@ def unauth_kb() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def admin_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
-            [KeyboardButton(text=BTN_ADM_LIST)],
+            [KeyboardButton(text=BTN_ADM_LIST), KeyboardButton(text=BTN_ADM_ANALYTICS)],
             [KeyboardButton(text=BTN_ADM_DEL), KeyboardButton(text=BTN_ADM_DEMO)],
             [KeyboardButton(text=BTN_ADM_ADD_GRADE)],
             [KeyboardButton(text=BTN_ADM_DEL_GRADE)],
             [KeyboardButton(text=BTN_ADM_CLEAR_GRADES)],
+            [KeyboardButton(text=BTN_ADM_IMPORT), KeyboardButton(text=BTN_ADM_EXPORT)],
+            [KeyboardButton(text=BTN_ADM_BROADCAST)],
             [KeyboardButton(text=BTN_ADM_BACK)],
         ],
         resize_keyboard=True
@@ -129,6 +386,84 @@ def subject_kb(subjects: list[str]) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 
+# Периоды лидерборда (ключи совпадают с period_keys; "imp" — рост за месяц)
+TOP_PERIODS = {
+    "all": "за всё время",
+    "w": "за неделю",
+    "m": "за месяц",
+    "t": "за четверть",
+    "imp": "рост за месяц",
+}
+
+
+@functools.lru_cache(maxsize=256)
+def top_periods_kb(subject: str = "*") -> InlineKeyboardMarkup:
+    def btn(text: str, period: str) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text=text, callback_data=f"top:{period}:{subject}")
+
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [btn("Неделя", "w"), btn("Месяц", "m"), btn("Четверть", "t")],
+        [btn("Всё время", "all"), btn("📈 Рост", "imp")],
+        [InlineKeyboardButton(text="📚 По предмету", callback_data="top:subj:")],
+    ])
+
+
+@functools.lru_cache(maxsize=None)
+def export_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="📥 Мои оценки (CSV)", callback_data="export:csv"),
+        InlineKeyboardButton(text="JSON", callback_data="export:json"),
+    ]])
+
+
+def users_page_kb(rows, has_prev: bool, has_next: bool, search: bool = False) -> InlineKeyboardMarkup:
+    """Навигация по списку пользователей: ul:<a|s>:<p|n>:<tg_id курсора>; s — страницы поиска."""
+    scope = "s" if search else "a"
+    nav = []
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="◀", callback_data=f"ul:{scope}:p:{rows[0]['tg_id']}"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="▶", callback_data=f"ul:{scope}:n:{rows[-1]['tg_id']}"))
+    tail = [InlineKeyboardButton(text="🔎 Поиск", callback_data="ul:find")]
+    if search:
+        tail.append(InlineKeyboardButton(text="👥 Все", callback_data="ul:all"))
+    return InlineKeyboardMarkup(inline_keyboard=[nav, tail] if nav else [tail])
+
+
+def user_candidates_kb(found: list[tuple[int, str]]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{name} (id={tg_id})", callback_data=f"pick:u:{tg_id}")]
+        for tg_id, name in found
+    ])
+
+
+def subject_candidates_kb(found: list[str]) -> InlineKeyboardMarkup:
+    # callback_data не длиннее 64 байт: слишком длинные названия остаются только на обычной клавиатуре
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=name, callback_data=f"pick:s:{name}")]
+        for name in found
+        if len(f"pick:s:{name}".encode()) <= 64
+    ])
+
+
+@functools.lru_cache(maxsize=None)
+def analytics_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🔄 Пересчитать по свежим данным", callback_data="an:refresh"),
+    ]])
+
+
+def top_subjects_kb(subjects: list[str]) -> InlineKeyboardMarkup:
+    buttons = [InlineKeyboardButton(text="Все предметы", callback_data="top:all:*")]
+    for s in subjects:
+        data = f"top:all:{s}"
+        # callback_data ограничен 64 байтами
+        if len(data.encode()) <= 64:
+            buttons.append(InlineKeyboardButton(text=s, callback_data=data))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
+
+@functools.lru_cache(maxsize=None)
 def grade_pick_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -140,6 +475,7 @@ def grade_pick_kb() -> ReplyKeyboardMarkup:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def after_add_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -150,9 +486,6 @@ def after_add_kb() -> ReplyKeyboardMarkup:
     )
 
 
-from typing import Optional
-
-
 def parse_grade(text: str) -> Optional[float]:
     """
     Принимаем:
@@ -189,88 +522,546 @@ def fmt_grade(g) -> str:
 
 
 # ========= DB =========
-def db_connect():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Настройки пула соединений SQLite
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BUSY_TIMEOUT_MS = 5000
+DB_PRAGMAS = (
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # ~16 МБ страничного кэша на соединение
+    "PRAGMA mmap_size=268435456",    # 256 МБ memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+)
 
 
-def db_init():
-    conn = db_connect()
-    cur = conn.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        tg_id INTEGER PRIMARY KEY,
-        full_name TEXT NOT NULL,
-        is_verified INTEGER NOT NULL DEFAULT 0
-    )
-    """)
+class DBPool:
+    """
+    Долгоживущие соединения с базой: один пишущий + ограниченный пул читающих.
+    WAL позволяет читателям (кабинет, лидерборд) не ждать писателя (добавление оценок).
+    Прагмы выставляются один раз при открытии соединения, подготовленные
+    выражения переиспользуются через кэш statement'ов sqlite3.
+    """
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS subjects (
-        name TEXT PRIMARY KEY
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS grades (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tg_id INTEGER NOT NULL,
-        subject TEXT NOT NULL,
-        grade REAL NOT NULL CHECK(grade >= 2.0 AND grade <= 5.0),
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(tg_id) REFERENCES users(tg_id),
-        FOREIGN KEY(subject) REFERENCES subjects(name)
-    )
-    """)
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.max_readers = max(1, readers)
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        self._opened_readers = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = self._open()
+        self._writer.execute("PRAGMA journal_mode=WAL")
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def read(self):
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened_readers < self.max_readers
+                if can_open:
+                    self._opened_readers += 1
+            conn = self._open() if can_open else self._readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
 
 
-    # Миграции (если база уже существовала)
+_db_pool: DBPool | None = None
+_db_pool_lock = threading.Lock()
+
+
+def db_pool() -> DBPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DBPool(DB_NAME)
+    return _db_pool
+
+
+def db_read():
+    return db_pool().read()
+
+
+def db_write():
+    return db_pool().write()
+
+
+def db_close():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
+
+
+# ====== Миграции ======
+# Миграция — (версия, описание, шаги). Шаг — SQL-строка или функция(conn).
+# Применяются по порядку, каждая в своей транзакции; номер последней
+# применённой миграции хранится в schema_version.
+def _migration_users_is_verified(conn):
+    """ALTER TABLE users ADD COLUMN is_verified (если колонки ещё нет)"""
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+    if "is_verified" not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN is_verified INTEGER NOT NULL DEFAULT 0")
+
+
+# Периоды для роллапов лидербордов. Выражения используются в триггерах,
+# period_keys() — их точная копия на Python (для запросов «текущего» периода).
+# Четверти учебного года: сен–окт, ноя–дек, янв–мар, апр–авг.
+def _period_exprs(ts: str) -> list[str]:
+    month = f"CAST(strftime('%m', {ts}) AS INTEGER)"
+    year = f"CAST(strftime('%Y', {ts}) AS INTEGER)"
+    return [
+        "'all'",
+        f"'w:' || strftime('%Y-%W', {ts})",
+        f"'m:' || strftime('%Y-%m', {ts})",
+        f"'t:' || ({year} - ({month} < 9)) || '-' || "
+        f"CASE WHEN {month} >= 11 THEN 2 WHEN {month} >= 9 THEN 1 WHEN {month} <= 3 THEN 3 ELSE 4 END",
+    ]
+
+
+def period_keys(ts: datetime) -> dict[str, str]:
+    m = ts.month
+    term = 2 if m >= 11 else 1 if m >= 9 else 3 if m <= 3 else 4
+    return {
+        "all": "all",
+        "w": "w:" + ts.strftime("%Y-%W"),
+        "m": "m:" + ts.strftime("%Y-%m"),
+        "t": f"t:{ts.year - (m < 9)}-{term}",
+    }
+
+
+def _rollup_triggers() -> list[str]:
+    new_periods = " UNION ALL ".join(f"SELECT {e} AS period" for e in _period_exprs("COALESCE(NEW.created_at, CURRENT_TIMESTAMP)"))
+    old_periods = ", ".join(_period_exprs("COALESCE(OLD.created_at, CURRENT_TIMESTAMP)"))
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_grades_rollups_insert AFTER INSERT ON grades
+        BEGIN
+            INSERT INTO grade_rollups(subject, period, tg_id, grade_sum, cnt)
+            SELECT s.subject, p.period, NEW.tg_id, NEW.grade, 1
+            FROM (SELECT NEW.subject AS subject UNION ALL SELECT '*') s,
+                 ({new_periods}) p
+            WHERE 1
+            ON CONFLICT(subject, period, tg_id) DO UPDATE SET
+                grade_sum = grade_sum + excluded.grade_sum,
+                cnt = cnt + 1;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_grades_rollups_delete AFTER DELETE ON grades
+        BEGIN
+            UPDATE grade_rollups
+            SET grade_sum = grade_sum - OLD.grade, cnt = cnt - 1
+            WHERE subject IN (OLD.subject, '*') AND period IN ({old_periods}) AND tg_id = OLD.tg_id;
+            DELETE FROM grade_rollups
+            WHERE subject IN (OLD.subject, '*') AND period IN ({old_periods}) AND tg_id = OLD.tg_id AND cnt <= 0;
+        END
+        """,
+    ]
+
+
+def _rollup_backfill() -> str:
+    parts = [
+        f"SELECT {subj} AS subject, {period} AS period, tg_id, grade FROM grades"
+        for subj in ("subject", "'*'")
+        for period in _period_exprs("COALESCE(created_at, CURRENT_TIMESTAMP)")
+    ]
+    return f"""
+        INSERT OR REPLACE INTO grade_rollups(subject, period, tg_id, grade_sum, cnt)
+        SELECT subject, period, tg_id, SUM(grade), COUNT(*)
+        FROM ({" UNION ALL ".join(parts)})
+        GROUP BY subject, period, tg_id
+    """
+
+
+def _fts_name(expr: str) -> str:
+    """SQL-выражение имени для users_fts: ё -> е (регистр сворачивает сам токенизатор)."""
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+MIGRATIONS = [
+    (1, "базовые таблицы", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            tg_id INTEGER PRIMARY KEY,
+            full_name TEXT NOT NULL,
+            is_verified INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subjects (
+            name TEXT PRIMARY KEY
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS grades (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER NOT NULL,
+            subject TEXT NOT NULL,
+            grade REAL NOT NULL CHECK(grade >= 2.0 AND grade <= 5.0),
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(tg_id) REFERENCES users(tg_id),
+            FOREIGN KEY(subject) REFERENCES subjects(name)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_achievements (
+            tg_id INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            unlocked_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (tg_id, code),
+            FOREIGN KEY(tg_id) REFERENCES users(tg_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS access_requests (
+            tg_id INTEGER PRIMARY KEY,
+            full_name TEXT NOT NULL,
+            username TEXT,
+            status TEXT NOT NULL,
+            requested_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            last_request_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            handled_by INTEGER,
+            handled_at TEXT
+        )
+        """,
+    ]),
+    (2, "users.is_verified для старых баз", [_migration_users_is_verified]),
+    (3, "индексы по grades", [
+        # выборки последних оценок (ORDER BY id DESC), удаление всех оценок пользователя
+        "CREATE INDEX IF NOT EXISTS idx_grades_tg_id ON grades(tg_id)",
+        # покрывающий: кабинет (GROUP BY subject), средняя пользователя, лидерборд
+        "CREATE INDEX IF NOT EXISTS idx_grades_tg_subject_grade ON grades(tg_id, subject, grade)",
+    ]),
+    (4, "агрегаты user_stats / user_subject_stats", [
+        """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            tg_id INTEGER PRIMARY KEY,
+            grade_sum REAL NOT NULL,
+            cnt INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_subject_stats (
+            tg_id INTEGER NOT NULL,
+            subject TEXT NOT NULL,
+            grade_sum REAL NOT NULL,
+            cnt INTEGER NOT NULL,
+            max_grade REAL NOT NULL,
+            last_grade_id INTEGER NOT NULL,
+            last_grade REAL NOT NULL,
+            PRIMARY KEY (tg_id, subject)
+        ) WITHOUT ROWID
+        """,
+        # агрегаты поддерживаются триггерами, поэтому их не обходит ни один путь записи
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_grades_stats_insert AFTER INSERT ON grades
+        BEGIN
+            INSERT INTO user_stats(tg_id, grade_sum, cnt) VALUES(NEW.tg_id, NEW.grade, 1)
+            ON CONFLICT(tg_id) DO UPDATE SET
+                grade_sum = grade_sum + excluded.grade_sum,
+                cnt = cnt + 1;
+
+            INSERT INTO user_subject_stats(tg_id, subject, grade_sum, cnt, max_grade, last_grade_id, last_grade)
+            VALUES(NEW.tg_id, NEW.subject, NEW.grade, 1, NEW.grade, NEW.id, NEW.grade)
+            ON CONFLICT(tg_id, subject) DO UPDATE SET
+                grade_sum = grade_sum + excluded.grade_sum,
+                cnt = cnt + 1,
+                max_grade = MAX(max_grade, excluded.max_grade),
+                last_grade = CASE WHEN excluded.last_grade_id > last_grade_id
+                                  THEN excluded.last_grade ELSE last_grade END,
+                last_grade_id = MAX(last_grade_id, excluded.last_grade_id);
+        END
+        """,
+        # при удалении max/last пересчитываются по индексу, только если удалили именно их
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_grades_stats_delete AFTER DELETE ON grades
+        BEGIN
+            UPDATE user_stats
+            SET grade_sum = grade_sum - OLD.grade, cnt = cnt - 1
+            WHERE tg_id = OLD.tg_id;
+            DELETE FROM user_stats WHERE tg_id = OLD.tg_id AND cnt <= 0;
+
+            UPDATE user_subject_stats
+            SET grade_sum = grade_sum - OLD.grade,
+                cnt = cnt - 1,
+                max_grade = CASE WHEN OLD.grade < max_grade THEN max_grade ELSE COALESCE(
+                    (SELECT MAX(grade) FROM grades WHERE tg_id = OLD.tg_id AND subject = OLD.subject), 0) END,
+                last_grade = CASE WHEN OLD.id <> last_grade_id THEN last_grade ELSE COALESCE(
+                    (SELECT grade FROM grades WHERE tg_id = OLD.tg_id AND subject = OLD.subject
+                     ORDER BY id DESC LIMIT 1), 0) END,
+                last_grade_id = CASE WHEN OLD.id <> last_grade_id THEN last_grade_id ELSE COALESCE(
+                    (SELECT MAX(id) FROM grades WHERE tg_id = OLD.tg_id AND subject = OLD.subject), 0) END
+            WHERE tg_id = OLD.tg_id AND subject = OLD.subject;
+            DELETE FROM user_subject_stats WHERE tg_id = OLD.tg_id AND subject = OLD.subject AND cnt <= 0;
+        END
+        """,
+        # заполнить агрегаты по уже существующим оценкам
+        """
+        INSERT OR REPLACE INTO user_stats(tg_id, grade_sum, cnt)
+        SELECT tg_id, SUM(grade), COUNT(*) FROM grades GROUP BY tg_id
+        """,
+        """
+        INSERT OR REPLACE INTO user_subject_stats(tg_id, subject, grade_sum, cnt, max_grade, last_grade_id, last_grade)
+        SELECT a.tg_id, a.subject, a.grade_sum, a.cnt, a.max_grade, a.last_grade_id, g.grade
+        FROM (
+            SELECT tg_id, subject, SUM(grade) AS grade_sum, COUNT(*) AS cnt,
+                   MAX(grade) AS max_grade, MAX(id) AS last_grade_id
+            FROM grades
+            GROUP BY tg_id, subject
+        ) a
+        JOIN grades g ON g.id = a.last_grade_id
+        """,
+    ]),
+    (5, "роллапы для лидербордов по предметам и периодам", [
+        # subject = '*' — все предметы; period — 'all', 'w:ГГГГ-НН', 'm:ГГГГ-ММ', 't:ГГГГ-Ч'
+        """
+        CREATE TABLE IF NOT EXISTS grade_rollups (
+            subject TEXT NOT NULL,
+            period TEXT NOT NULL,
+            tg_id INTEGER NOT NULL,
+            grade_sum REAL NOT NULL,
+            cnt INTEGER NOT NULL,
+            PRIMARY KEY (subject, period, tg_id)
+        ) WITHOUT ROWID
+        """,
+        *_rollup_triggers(),
+        _rollup_backfill(),
+    ]),
+    (6, "состояния FSM", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)",
+    ]),
+    (7, "счётчики достижений achievement_state", [
+        """
+        CREATE TABLE IF NOT EXISTS achievement_state (
+            tg_id INTEGER PRIMARY KEY,
+            cnt INTEGER NOT NULL,
+            grade_sum REAL NOT NULL,
+            streak5 INTEGER NOT NULL
+        )
+        """,
+        """
+        INSERT OR REPLACE INTO achievement_state(tg_id, cnt, grade_sum, streak5)
+        SELECT s.tg_id, s.cnt, s.grade_sum,
+               (SELECT COUNT(*) FROM grades g
+                WHERE g.tg_id = s.tg_id
+                  AND g.id > COALESCE((SELECT MAX(id) FROM grades g2 WHERE g2.tg_id = s.tg_id AND g2.grade < 5.0), 0))
+        FROM user_stats s
+        """,
+    ]),
+    (8, "недоставленные сообщения outbox_dead", [
+        """
+        CREATE TABLE IF NOT EXISTS outbox_dead (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            error TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (9, "индекс users по имени и поиск users_fts (FTS5)", [
+        "CREATE INDEX IF NOT EXISTS idx_users_full_name ON users(full_name, tg_id)",
+        # rowid = tg_id; в индекс кладём имя с ё -> е (unicode61 их не склеивает)
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(name, tokenize='unicode61 remove_diacritics 2')",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_ai AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts(rowid, name) VALUES (NEW.tg_id, {_fts_name("NEW.full_name")});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_au AFTER UPDATE OF full_name ON users
+        WHEN OLD.full_name IS NOT NEW.full_name
+        BEGIN
+            DELETE FROM users_fts WHERE rowid = OLD.tg_id;
+            INSERT INTO users_fts(rowid, name) VALUES (NEW.tg_id, {_fts_name("NEW.full_name")});
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_ad AFTER DELETE ON users
+        BEGIN
+            DELETE FROM users_fts WHERE rowid = OLD.tg_id;
+        END
+        """,
+        f"INSERT INTO users_fts(rowid, name) SELECT tg_id, {_fts_name('full_name')} FROM users",
+    ]),
+    (10, "дневные роллапы grade_daily для графиков динамики", [
+        # day — дата created_at (UTC, как и CURRENT_TIMESTAMP)
+        """
+        CREATE TABLE IF NOT EXISTS grade_daily (
+            tg_id INTEGER NOT NULL,
+            subject TEXT NOT NULL,
+            day TEXT NOT NULL,
+            grade_sum REAL NOT NULL,
+            cnt INTEGER NOT NULL,
+            PRIMARY KEY (tg_id, subject, day)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_grades_daily_insert AFTER INSERT ON grades
+        BEGIN
+            INSERT INTO grade_daily(tg_id, subject, day, grade_sum, cnt)
+            VALUES(NEW.tg_id, NEW.subject, date(COALESCE(NEW.created_at, CURRENT_TIMESTAMP)), NEW.grade, 1)
+            ON CONFLICT(tg_id, subject, day) DO UPDATE SET
+                grade_sum = grade_sum + excluded.grade_sum,
+                cnt = cnt + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_grades_daily_delete AFTER DELETE ON grades
+        BEGIN
+            UPDATE grade_daily
+            SET grade_sum = grade_sum - OLD.grade, cnt = cnt - 1
+            WHERE tg_id = OLD.tg_id AND subject = OLD.subject
+              AND day = date(COALESCE(OLD.created_at, CURRENT_TIMESTAMP));
+            DELETE FROM grade_daily
+            WHERE tg_id = OLD.tg_id AND subject = OLD.subject
+              AND day = date(COALESCE(OLD.created_at, CURRENT_TIMESTAMP)) AND cnt <= 0;
+        END
+        """,
+        """
+        INSERT OR REPLACE INTO grade_daily(tg_id, subject, day, grade_sum, cnt)
+        SELECT tg_id, subject, date(COALESCE(created_at, CURRENT_TIMESTAMP)), SUM(grade), COUNT(*)
+        FROM grades
+        GROUP BY 1, 2, 3
+        """,
+    ]),
+]
+
+
+def _describe_step(step) -> str:
+    if callable(step):
+        return (step.__doc__ or step.__name__).strip()
+    return " ".join(step.split())
+
+
+def get_schema_version(conn) -> int:
+    """Версия схемы; 0 — миграции ещё не применялись. Только читает."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='schema_version'").fetchone() is None:
+        return 0
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return int(row[0] or 0)
+
+
+def _schema_version_readonly() -> int:
+    """Версия схемы для dry-run: база открывается только на чтение, отсутствующая не создаётся."""
+    path = Path(DB_NAME)
+    if not path.exists():
+        return 0
+    conn = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True)
     try:
-        cur.execute("ALTER TABLE users ADD COLUMN is_verified INTEGER NOT NULL DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass
+        return get_schema_version(conn)
+    finally:
+        conn.close()
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_achievements (
-        tg_id INTEGER NOT NULL,
-        code TEXT NOT NULL,
-        unlocked_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        PRIMARY KEY (tg_id, code),
-        FOREIGN KEY(tg_id) REFERENCES users(tg_id)
-    )
-    """)
-    
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS access_requests (
-        tg_id INTEGER PRIMARY KEY,
-        full_name TEXT NOT NULL,
-        username TEXT,
-        status TEXT NOT NULL,
-        requested_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        last_request_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        handled_by INTEGER,
-        handled_at TEXT
-    )
-    """)
 
-    conn.commit()
-    conn.close()
+def db_migrate(dry_run: bool = False) -> list[tuple[int, str, list[str]]]:
+    """
+    Применяет недостающие миграции. Возвращает список применённых
+    (или, при dry_run, ожидающих) миграций с описанием шагов;
+    dry_run ничего не пишет на диск и не создаёт файл базы.
+    """
+    if dry_run:
+        current = _schema_version_readonly()
+        return [
+            (version, description, [_describe_step(s) for s in steps])
+            for version, description, steps in MIGRATIONS
+            if version > current
+        ]
+    pending = []
+    with db_write() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        current = get_schema_version(conn)
+        conn.commit()
+        for version, description, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            pending.append((version, description, [_describe_step(s) for s in steps]))
+            conn.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(
+                "INSERT INTO schema_version(version, description) VALUES(?, ?)",
+                (version, description)
+            )
+            conn.commit()
+            log.info("migration %s applied: %s", version, description)
+    return pending
+
 
+def db_init():
+    db_migrate()
     seed_default_subjects()
+    warm_caches()
 
 
+@db_write_op
+@db_timed
 def seed_default_subjects():
     defaults = ["Русский", "Математика", "История", "Английский", "Информатика"]
-    conn = db_connect()
-    cur = conn.cursor()
-    for s in defaults:
-        cur.execute("INSERT OR IGNORE INTO subjects(name) VALUES(?)", (s,))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.executemany("INSERT OR IGNORE INTO subjects(name) VALUES(?)", [(s,) for s in defaults])
+        SUBJECTS.load(conn)
 
 
+@db_write_op
+@db_timed
 def seed_demo_data_force():
     """
     Админ-команда: удаляет старые демо (tg_id < 0) и создаёт 5 демо-пользователей с оценками.
@@ -280,12 +1071,6 @@ def seed_demo_data_force():
              "София", "Анна", "Мария", "Екатерина", "Виктория", "Полина", "Алиса", "Дарья", "Ксения", "Елена"]
     last = ["Иванов", "Петров", "Сидоров", "Смирнов", "Кузнецов", "Попов", "Васильев", "Соколов", "Морозов", "Новиков",
             "Фёдоров", "Михайлов", "Алексеев", "Орлов", "Макаров", "Зайцев", "Павлов", "Семёнов", "Волков", "Громов"]
-    conn = db_connect()
-    cur = conn.cursor()
-
-    # удалить старых демо
-    cur.execute("DELETE FROM grades WHERE tg_id < 0")
-    cur.execute("DELETE FROM users WHERE tg_id < 0")
 
     subjects = get_subjects()
     if not subjects:
@@ -301,50 +1086,216 @@ def seed_demo_data_force():
                 demo_users.append((-i, name))
                 break
 
-    for tg_id, name in demo_users:
-        cur.execute("INSERT INTO users(tg_id, full_name) VALUES(?, ?)", (tg_id, name))
+    with db_write() as conn:
+        cur = conn.cursor()
+
+        # удалить старых демо
+        cur.execute("DELETE FROM grades WHERE tg_id < 0")
+        cur.execute("DELETE FROM users WHERE tg_id < 0")
+        for (old_id,) in cur.execute("SELECT tg_id FROM achievement_state WHERE tg_id < 0").fetchall():
+            ACHIEVEMENT_ENGINE.forget(conn, old_id)
+
+        for tg_id, name in demo_users:
+            cur.execute("INSERT INTO users(tg_id, full_name) VALUES(?, ?)", (tg_id, name))
+
+        # каждому демо — случайные оценки
+        for tg_id, _name in demo_users:
+            for _ in range(random.randint(8, 14)):
+                subj = random.choice(subjects)
+                # случайная оценка с дробной частью
+                g = round(random.uniform(2.0, 5.0), 2)
+                cur.execute("INSERT OR IGNORE INTO subjects(name) VALUES(?)", (subj,))
+                cur.execute("INSERT INTO grades(tg_id, subject, grade) VALUES(?, ?, ?)", (tg_id, subj, g))
+                ACHIEVEMENT_ENGINE.grade_added(conn, tg_id, g)
+
+        LEADERBOARD.load(conn)
+        PERCENTILES.load(conn)
+        SUBJECTS.load(conn)
+        USER_NAMES.load(conn)
+    USER_CACHE.invalidate()
+
+
+# ====== Синхронизация кэшей между процессами ======
+class CacheSync:
+    """
+    Многопроцессный режим: пишущий процесс записывает, какие in-memory
+    структуры поменял каждый write-хелпер (события (вид, tg_id | None)),
+    и рассылает их воркерам; воркеры перечитывают затронутое из базы.
+    События собираются только внутри capture() — в обычном режиме emit ничего не делает.
+    Те же события говорят, что перечитать, если запись откатилась (restore).
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @contextmanager
+    def capture(self):
+        # события — ключи dict: импорт на миллион строк даёт по одному на пользователя, а не на строку;
+        # вложенный capture отдаёт свои события и внешнему (пишущий процесс + group commit / импорт)
+        outer = getattr(self._local, "events", None)
+        self._local.events = events = {}
+        try:
+            yield events
+        finally:
+            self._local.events = outer
+            if outer is not None:
+                outer.update(events)
+
+    def emit(self, kind: str, key: int | None = None):
+        events = getattr(self._local, "events", None)
+        if events is not None:
+            events[(kind, key)] = None
+
+    def apply(self, events: list[tuple[str, int | None]]):
+        with db_read() as conn:
+            for kind, key in dict.fromkeys(events):
+                if kind == "user":
+                    USER_CACHE.invalidate(key)
+                elif kind == "subjects":
+                    SUBJECTS.load(conn)
+                elif kind == "leaderboard":
+                    if key is None:
+                        LEADERBOARD.load(conn)
+                    else:
+                        LEADERBOARD.refresh_user(conn, key)
+                elif kind == "percentiles":
+                    if key is None:
+                        PERCENTILES.load(conn)
+                    else:
+                        PERCENTILES.refresh_user(conn, key)
+                elif kind == "names":
+                    if key is None:
+                        USER_NAMES.load(conn)
+                    else:
+                        USER_NAMES.refresh_user(conn, key)
+                elif kind == "achievements":
+                    if key is None:
+                        ACHIEVEMENT_ENGINE.load(conn)
+                    else:
+                        ACHIEVEMENT_ENGINE.load_user(conn, key)
+
+    def restore(self, events: list[tuple[str, int | None]]):
+        """
+        Кэши меняются внутри пишущей транзакции, до commit. Если она (или
+        SAVEPOINT одной записи) откатилась, перечитываем из базы всё, что
+        эти записи успели поменять в памяти. Вызывать после отката.
+        """
+        if not events:
+            return
+        try:
+            self.apply(events)
+        except Exception:
+            log.exception("не удалось восстановить кэши после отката: %s", reprlib.repr(events))
+
+
+CACHE_SYNC = CacheSync()
+
+
+# ====== Кэш пользователей ======
+_MISSING = object()
+
 
-    # каждому демо — случайные оценки
-    for tg_id, _name in demo_users:
-        for _ in range(random.randint(8, 14)):
-            subj = random.choice(subjects)
-            # случайная оценка с дробной частью
-            g = round(random.uniform(2.0, 5.0), 2)
-            cur.execute("INSERT OR IGNORE INTO subjects(name) VALUES(?)", (subj,))
-            cur.execute("INSERT INTO grades(tg_id, subject, grade) VALUES(?, ?, ?)", (tg_id, subj, g))
+class UserCache:
+    """
+    LRU-кэш строк users с TTL. Кэшируется и отсутствие пользователя (None).
+    Инвалидируется из upsert_user, set_user_verified и delete_user; счётчик
+    версий не даёт загрузке, начатой до инвалидации, положить в кэш старую строку.
+    """
 
-    conn.commit()
-    conn.close()
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[int, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, tg_id: int):
+        with self._lock:
+            item = self._data.get(tg_id)
+            if item is not None and item[0] > time.monotonic():
+                self._data.move_to_end(tg_id)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[tg_id]
+            self.misses += 1
+            return _MISSING
+
+    def put(self, tg_id: int, row, version: int):
+        with self._lock:
+            if version != self._version:
+                return
+            self._data[tg_id] = (time.monotonic() + self.ttl, row)
+            self._data.move_to_end(tg_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, tg_id: int | None = None):
+        with self._lock:
+            self._version += 1
+            if tg_id is None:
+                self._data.clear()
+            else:
+                self._data.pop(tg_id, None)
+        CACHE_SYNC.emit("user", tg_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+USER_CACHE = UserCache()
+
+
+@db_timed
+def load_user(tg_id: int):
+    """Читает пользователя из базы мимо кэша и кладёт результат в кэш."""
+    version = USER_CACHE.version
+    with db_read() as conn:
+        row = conn.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,)).fetchone()
+    USER_CACHE.put(tg_id, row, version)
+    return row
 
 
 def get_user(tg_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = USER_CACHE.get(tg_id)
+    if row is _MISSING:
+        row = load_user(tg_id)
     return row
 
 
+@db_write_op
+@db_timed
 def upsert_user(tg_id: int, full_name: str):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO users(tg_id, full_name)
-        VALUES(?, ?)
-        ON CONFLICT(tg_id) DO UPDATE SET full_name=excluded.full_name
-    """, (tg_id, full_name))
-    conn.commit()
-    conn.close()
-
+    with db_write() as conn:
+        conn.execute("""
+            INSERT INTO users(tg_id, full_name)
+            VALUES(?, ?)
+            ON CONFLICT(tg_id) DO UPDATE SET full_name=excluded.full_name
+        """, (tg_id, full_name))
+        LEADERBOARD.refresh_user(conn, tg_id)
+        USER_NAMES.refresh_user(conn, tg_id)
+    USER_CACHE.invalidate(tg_id)
+
+
+@db_write_op
+@db_timed
 def set_user_verified(tg_id: int, verified: int = 1):
-    conn = db_connect()
-    cur = conn.cursor()
-    try:
-        cur.execute("UPDATE users SET is_verified=? WHERE tg_id=?", (verified, tg_id))
-        conn.commit()
-    finally:
-        conn.close()
+    with db_write() as conn:
+        conn.execute("UPDATE users SET is_verified=? WHERE tg_id=?", (verified, tg_id))
+    USER_CACHE.invalidate(tg_id)
 
 
 def parse_sqlite_ts(value: str):
@@ -359,45 +1310,48 @@ def parse_sqlite_ts(value: str):
             return None
 
 
+@db_timed
 def get_access_request(tg_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM access_requests WHERE tg_id=?", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    with db_read() as conn:
+        return conn.execute("SELECT * FROM access_requests WHERE tg_id=?", (tg_id,)).fetchone()
 
 
+@db_write_op
+@db_timed
 def upsert_access_request_pending(tg_id: int, full_name: str, username: str | None):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO access_requests(tg_id, full_name, username, status, requested_at, last_request_at)
-        VALUES(?, ?, ?, 'pending', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        ON CONFLICT(tg_id) DO UPDATE SET
-            full_name=excluded.full_name,
-            username=excluded.username,
-            status='pending',
-            requested_at=CURRENT_TIMESTAMP,
-            last_request_at=CURRENT_TIMESTAMP
-    """, (tg_id, full_name, username))
-    conn.commit()
-    conn.close()
-
-
+    with db_write() as conn:
+        conn.execute("""
+            INSERT INTO access_requests(tg_id, full_name, username, status, requested_at, last_request_at)
+            VALUES(?, ?, ?, 'pending', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ON CONFLICT(tg_id) DO UPDATE SET
+                full_name=excluded.full_name,
+                username=excluded.username,
+                status='pending',
+                requested_at=CURRENT_TIMESTAMP,
+                last_request_at=CURRENT_TIMESTAMP
+        """, (tg_id, full_name, username))
+
+
+@db_write_op
+@db_timed
+def drop_pending_access_request(tg_id: int):
+    """Снимает заявку, которую не удалось доставить ни одному админу, чтобы её можно было отправить снова."""
+    with db_write() as conn:
+        conn.execute("DELETE FROM access_requests WHERE tg_id=? AND status='pending'", (tg_id,))
+
+
+@db_write_op
+@db_timed
 def set_access_request_status(tg_id: int, status: str, admin_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE access_requests
-        SET status=?, handled_by=?, handled_at=CURRENT_TIMESTAMP
-        WHERE tg_id=?
-    """, (status, admin_id, tg_id))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("""
+            UPDATE access_requests
+            SET status=?, handled_by=?, handled_at=CURRENT_TIMESTAMP
+            WHERE tg_id=?
+        """, (status, admin_id, tg_id))
 
-def is_user_verified(tg_id: int) -> bool:
-    u = get_user(tg_id)
+
+def user_verified(u) -> bool:
     if not u:
         return False
     try:
@@ -405,7 +1359,13 @@ def is_user_verified(tg_id: int) -> bool:
     except Exception:
         return True
 
+
+def is_user_verified(tg_id: int) -> bool:
+    return user_verified(get_user(tg_id))
+
 # ====== Достижения ======
+
+
 ACHIEVEMENTS = {
     "first_grade": ("🥉 Первый тест", "Добавь первую оценку"),
     "ten_tests": ("🥈 10 тестов", "Добавь 10 оценок"),
@@ -413,1000 +1373,4171 @@ ACHIEVEMENTS = {
     "avg_45": ("🏅 Отличник", "Достичь общей средней 4.50+ (минимум 5 оценок)"),
 }
 
-def unlock_achievement(tg_id: int, code: str) -> bool:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO user_achievements(tg_id, code) VALUES(?, ?)",
-        (tg_id, code)
+# Правила — чистые функции от счётчиков пользователя: проверка каждого
+# правила после оценки стоит O(1) и не требует запросов к базе.
+ACHIEVEMENT_RULES = {
+    "first_grade": lambda s: s.cnt >= 1,
+    "ten_tests": lambda s: s.cnt >= 10,
+    "streak3_5": lambda s: s.streak5 >= 3,
+    "avg_45": lambda s: s.cnt >= 5 and s.grade_sum / s.cnt >= 4.5,
+}
+
+# Текущая серия пятёрок: сколько оценок после последней оценки ниже 5
+SQL_STREAK5 = """
+    SELECT COUNT(*) AS streak5
+    FROM grades
+    WHERE tg_id=? AND id > COALESCE((SELECT MAX(id) FROM grades WHERE tg_id=? AND grade < 5.0), 0)
+"""
+
+
+class AchievementState:
+    """Счётчики пользователя, от которых зависят правила."""
+
+    __slots__ = ("cnt", "grade_sum", "streak5")
+
+    def __init__(self, cnt: int = 0, grade_sum: float = 0.0, streak5: int = 0):
+        self.cnt = cnt
+        self.grade_sum = grade_sum
+        self.streak5 = streak5
+
+    def add(self, grade: float) -> "AchievementState":
+        return AchievementState(self.cnt + 1, self.grade_sum + grade, self.streak5 + 1 if grade >= 5.0 else 0)
+
+
+class AchievementEngine:
+    """
+    Достижения по событиям «оценка добавлена / оценки удалены».
+    Счётчики (количество, сумма, текущая серия пятёрок) и выданные достижения
+    держатся в памяти и в таблице achievement_state. Методы вызываются внутри
+    пишущей транзакции (как LEADERBOARD.refresh_user), поэтому события одного
+    пользователя сериализованы блокировкой записи, а новые достижения
+    вставляются одним executemany в ту же транзакцию.
+    """
+
+    SQL_SAVE_STATE = """
+        INSERT INTO achievement_state(tg_id, cnt, grade_sum, streak5) VALUES(?, ?, ?, ?)
+        ON CONFLICT(tg_id) DO UPDATE SET
+            cnt = excluded.cnt, grade_sum = excluded.grade_sum, streak5 = excluded.streak5
+    """
+
+    def __init__(self, rules: dict):
+        self.rules = rules
+        self._lock = threading.Lock()
+        self._state: dict[int, AchievementState] = {}
+        self._unlocked: dict[int, set[str]] = {}
+
+    def load(self, conn):
+        state = {
+            r["tg_id"]: AchievementState(r["cnt"], r["grade_sum"], r["streak5"])
+            for r in conn.execute("SELECT tg_id, cnt, grade_sum, streak5 FROM achievement_state")
+        }
+        unlocked: dict[int, set[str]] = {}
+        for r in conn.execute("SELECT tg_id, code FROM user_achievements"):
+            unlocked.setdefault(r["tg_id"], set()).add(r["code"])
+        with self._lock:
+            self._state = state
+            self._unlocked = unlocked
+        CACHE_SYNC.emit("achievements")
+
+    def load_user(self, conn, tg_id: int):
+        """Перечитывает одного пользователя (воркер после записи в пишущем процессе)."""
+        row = conn.execute("SELECT cnt, grade_sum, streak5 FROM achievement_state WHERE tg_id=?", (tg_id,)).fetchone()
+        codes = {r["code"] for r in conn.execute("SELECT code FROM user_achievements WHERE tg_id=?", (tg_id,))}
+        with self._lock:
+            if row is None:
+                self._state.pop(tg_id, None)
+            else:
+                self._state[tg_id] = AchievementState(row["cnt"], row["grade_sum"], row["streak5"])
+            if codes:
+                self._unlocked[tg_id] = codes
+            else:
+                self._unlocked.pop(tg_id, None)
+
+    def grade_added(self, conn, tg_id: int, grade: float) -> list[str]:
+        """Обновляет счётчики за O(1); возвращает коды новых достижений."""
+        with self._lock:
+            old = self._state.get(tg_id) or AchievementState()
+        return self._apply(conn, tg_id, old.add(grade))
+
+    def grades_deleted(self, conn, tg_id: int) -> list[str]:
+        """Пересчитывает счётчики после удаления (из user_stats и хвоста оценок)."""
+        row = conn.execute("SELECT cnt, grade_sum FROM user_stats WHERE tg_id=?", (tg_id,)).fetchone()
+        if row is None:
+            conn.execute("DELETE FROM achievement_state WHERE tg_id=?", (tg_id,))
+            with self._lock:
+                self._state.pop(tg_id, None)
+            CACHE_SYNC.emit("achievements", tg_id)
+            return []
+        streak5 = conn.execute(SQL_STREAK5, (tg_id, tg_id)).fetchone()["streak5"]
+        return self._apply(conn, tg_id, AchievementState(row["cnt"], row["grade_sum"], streak5))
+
+    def forget(self, conn, tg_id: int):
+        """Пользователь удалён: убираем и счётчики, и выданные достижения."""
+        conn.execute("DELETE FROM achievement_state WHERE tg_id=?", (tg_id,))
+        conn.execute("DELETE FROM user_achievements WHERE tg_id=?", (tg_id,))
+        with self._lock:
+            self._state.pop(tg_id, None)
+            self._unlocked.pop(tg_id, None)
+        CACHE_SYNC.emit("achievements", tg_id)
+
+    def _apply(self, conn, tg_id: int, new: AchievementState) -> list[str]:
+        with self._lock:
+            have = self._unlocked.get(tg_id, set())
+            newly = [code for code, rule in self.rules.items() if code not in have and rule(new)]
+        conn.execute(self.SQL_SAVE_STATE, (tg_id, new.cnt, new.grade_sum, new.streak5))
+        if newly:
+            conn.executemany(
+                "INSERT OR IGNORE INTO user_achievements(tg_id, code) VALUES(?, ?)",
+                [(tg_id, code) for code in newly]
+            )
+        with self._lock:
+            self._state[tg_id] = new
+            if newly:
+                self._unlocked.setdefault(tg_id, set()).update(newly)
+        CACHE_SYNC.emit("achievements", tg_id)
+        return newly
+
+    def apply_recomputed(self, conn, states: list[tuple[int, AchievementState]], unlocks: list[tuple[int, str, str]]) -> int:
+        """
+        Записывает результат пересчёта по истории: счётчики целиком заменяются,
+        достижения добавляются, а у уже выданных unlocked_at сдвигается на более
+        раннее время. Возвращает число добавленных/исправленных достижений.
+        """
+        conn.executemany(self.SQL_SAVE_STATE, [(tg_id, st.cnt, st.grade_sum, st.streak5) for tg_id, st in states])
+        changed = 0
+        if unlocks:
+            cur = conn.executemany("""
+                INSERT INTO user_achievements(tg_id, code, unlocked_at) VALUES(?, ?, ?)
+                ON CONFLICT(tg_id, code) DO UPDATE SET unlocked_at = excluded.unlocked_at
+                WHERE excluded.unlocked_at < user_achievements.unlocked_at
+            """, unlocks)
+            changed = cur.rowcount
+        with self._lock:
+            for tg_id, st in states:
+                self._state[tg_id] = st
+            for tg_id, code, _ in unlocks:
+                self._unlocked.setdefault(tg_id, set()).add(code)
+        CACHE_SYNC.emit("achievements")
+        return changed
+
+    def grades_imported(self, conn, grades: dict[int, list[tuple[float, str | None]]]) -> int:
+        """
+        Импорт: оценки каждого пользователя (grade, created_at) в порядке дат
+        проходят через правила в памяти, а счётчики и новые достижения пишутся
+        двумя executemany на всех. unlocked_at — дата оценки, на которой правило
+        выполнилось. Возвращает число новых достижений.
+        """
+        states, unlocks = [], []
+        with self._lock:
+            for tg_id, user_grades in grades.items():
+                state = self._state.get(tg_id) or AchievementState()
+                have = set(self._unlocked.get(tg_id, ()))
+                for grade, created_at in user_grades:
+                    state = state.add(grade)
+                    for code, rule in self.rules.items():
+                        if code not in have and rule(state):
+                            have.add(code)
+                            unlocks.append((tg_id, code, created_at))
+                states.append((tg_id, state))
+        conn.executemany(self.SQL_SAVE_STATE, [(tg_id, st.cnt, st.grade_sum, st.streak5) for tg_id, st in states])
+        if unlocks:
+            conn.executemany(
+                "INSERT OR IGNORE INTO user_achievements(tg_id, code, unlocked_at) VALUES(?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+                unlocks
+            )
+        with self._lock:
+            for tg_id, st in states:
+                self._state[tg_id] = st
+            for tg_id, code, _ in unlocks:
+                self._unlocked.setdefault(tg_id, set()).add(code)
+        for tg_id, _ in states:
+            CACHE_SYNC.emit("achievements", tg_id)
+        return len(unlocks)
+
+    def drop_stale(self, conn, after: int, upto: int) -> int:
+        """
+        Пересчёт: счётчики пользователей с tg_id в (after, upto], у которых не
+        осталось оценок, удаляются (как в grades_deleted). Возвращает их число.
+        """
+        stale = [r["tg_id"] for r in conn.execute("""
+            DELETE FROM achievement_state
+            WHERE tg_id > ? AND tg_id <= ?
+              AND NOT EXISTS (SELECT 1 FROM grades g WHERE g.tg_id = achievement_state.tg_id)
+            RETURNING tg_id
+        """, (after, upto))]
+        if stale:
+            with self._lock:
+                for tg_id in stale:
+                    self._state.pop(tg_id, None)
+            CACHE_SYNC.emit("achievements")
+        return len(stale)
+
+    def unlocked(self, tg_id: int) -> list[str]:
+        with self._lock:
+            have = self._unlocked.get(tg_id, set())
+        return [code for code in ACHIEVEMENTS if code in have]
+
+
+ACHIEVEMENT_ENGINE = AchievementEngine(ACHIEVEMENT_RULES)
+
+
+def achievements_text(codes: list[str]) -> str:
+    return "".join(f"\n🏆 Новое достижение: {ACHIEVEMENTS[c][0]} — {ACHIEVEMENTS[c][1]}" for c in codes)
+
+
+# Keyset-пагинация по (tg_id, id) идёт по индексу idx_grades_tg_id (tg_id + rowid)
+SQL_GRADES_CHUNK = """
+    SELECT id, tg_id, grade, created_at
+    FROM grades
+    WHERE (tg_id, id) > (?, ?)
+    ORDER BY tg_id, id
+    LIMIT ?
+"""
+
+_recompute_lock = threading.Lock()
+
+
+@db_write_op
+@db_timed
+def recompute_achievements(chunk_size: int = 20000, progress=None) -> dict | None:
+    """
+    Пересчитывает достижения по всей истории оценок: проигрывает grades
+    в порядке (tg_id, id) кусками по chunk_size, каждый кусок читается
+    и записывается в одной транзакции. В памяти — только текущий кусок
+    и счётчики одного пользователя. unlocked_at берётся из created_at
+    оценки, на которой правило впервые выполнилось. Счётчики пользователей
+    без оценок удаляются в транзакции куска, покрывающего их tg_id.
+    progress(done, total) вызывается после каждого куска.
+    Возвращает None, если пересчёт уже идёт.
+    """
+    if not _recompute_lock.acquire(blocking=False):
+        return None
+    try:
+        with db_read() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(cnt), 0) AS n FROM user_stats").fetchone()["n"]
+
+        last = (-(2 ** 63), 0)
+        cur_id, cur_state, cur_have = None, None, set()
+        done = users = changed = dropped = 0
+        while True:
+            with db_write() as conn:
+                rows = conn.execute(SQL_GRADES_CHUNK, (*last, chunk_size)).fetchall()
+                states, unlocks = [], []
+                for r in rows:
+                    if r["tg_id"] != cur_id:
+                        if cur_id is not None:
+                            states.append((cur_id, cur_state))
+                        cur_id, cur_state, cur_have = r["tg_id"], AchievementState(), set()
+                    cur_state = cur_state.add(r["grade"])
+                    for code, rule in ACHIEVEMENT_RULES.items():
+                        if code not in cur_have and rule(cur_state):
+                            cur_have.add(code)
+                            unlocks.append((cur_id, code, r["created_at"]))
+                finished = len(rows) < chunk_size
+                if finished and cur_id is not None:
+                    states.append((cur_id, cur_state))
+                after = last[0]
+                if rows:
+                    last = (rows[-1]["tg_id"], rows[-1]["id"])
+                changed += ACHIEVEMENT_ENGINE.apply_recomputed(conn, states, unlocks)
+                dropped += ACHIEVEMENT_ENGINE.drop_stale(conn, after, 2 ** 63 - 1 if finished else last[0])
+            done += len(rows)
+            users += len(states)
+            if progress:
+                progress(done, total)
+            if finished:
+                break
+        log.info("achievements recomputed: grades=%s users=%s changed=%s dropped=%s", done, users, changed, dropped)
+        return {"grades": done, "users": users, "changed": changed, "dropped": dropped}
+    finally:
+        _recompute_lock.release()
+
+
+USERS_PAGE_SIZE = 10
+
+SQL_USERS_PAGE = """
+    SELECT u.tg_id, u.full_name, COALESCE(s.cnt, 0) AS grades_count
+    FROM users u
+    LEFT JOIN user_stats s ON s.tg_id = u.tg_id
+    WHERE {where}
+    ORDER BY u.full_name {order}, u.tg_id {order}
+    LIMIT ?
+"""
+
+# keyset: курсор — tg_id крайней строки соседней страницы, ключ (full_name, tg_id)
+SQL_USERS_AFTER = "(u.full_name, u.tg_id) > (SELECT full_name, tg_id FROM users WHERE tg_id = ?)"
+SQL_USERS_BEFORE = "(u.full_name, u.tg_id) < (SELECT full_name, tg_id FROM users WHERE tg_id = ?)"
+SQL_USERS_MATCH = "u.tg_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)"
+SQL_USERS_BY_ID = SQL_USERS_PAGE.format(where="u.tg_id = ?", order="ASC")
+
+
+@functools.lru_cache(maxsize=None)
+def users_page_sql(direction: str = "first", search: bool = False) -> str:
+    """direction: first — с начала, next — после курсора, prev — до курсора (в обратном порядке)."""
+    where = [SQL_USERS_MATCH] if search else []
+    if direction == "next":
+        where.append(SQL_USERS_AFTER)
+    elif direction == "prev":
+        where.append(SQL_USERS_BEFORE)
+    return SQL_USERS_PAGE.format(
+        where=" AND ".join(where) or "1",
+        order="DESC" if direction == "prev" else "ASC",
     )
-    conn.commit()
-    changed = cur.rowcount == 1
-    conn.close()
-    return changed
-
-def get_total_count_and_avg(tg_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS cnt, AVG(grade) AS avg FROM grades WHERE tg_id=?", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
-    return int(row["cnt"] or 0), (row["avg"] if row else None)
-
-def get_last_grades(tg_id: int, limit: int = 3):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT grade FROM grades WHERE tg_id=? ORDER BY id DESC LIMIT ?", (tg_id, limit))
-    rows = cur.fetchall()
-    conn.close()
-    return [float(r["grade"]) for r in rows]
-
-
-def list_users(limit: int = 30):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT u.tg_id, u.full_name,
-               COUNT(g.id) AS grades_count
-        FROM users u
-        LEFT JOIN grades g ON g.tg_id = u.tg_id
-        GROUP BY u.tg_id
-        ORDER BY u.full_name ASC
-        LIMIT ?
-    """, (limit,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
+def users_match_query(text: str) -> str | None:
+    """
+    Запрос FTS5 из строки поиска: каждое слово — префикс, все слова обязательны
+    («иван пет» найдёт «Иванов Пётр»). None, если слов нет.
+    """
+    text = text.replace("ё", "е").replace("Ё", "Е")
+    words = "".join(c if c.isalnum() else " " for c in text).split()
+    if not words:
+        return None
+    return " ".join(f'"{w}"*' for w in words)
+
+
+@db_timed
+def list_users_page(cursor: int | None = None, direction: str = "next",
+                    query: str | None = None, limit: int = USERS_PAGE_SIZE):
+    """
+    Страница пользователей в порядке (full_name, tg_id) с числом оценок из user_stats.
+    Keyset-пагинация: cursor — tg_id последней (direction="next") или первой
+    ("prev") строки показанной страницы, так что любая страница — поиск по индексу
+    и limit строк, без OFFSET. query — поиск по началу слов имени (users_fts) или
+    точный TG ID. Возвращает (строки, есть_предыдущая, есть_следующая).
+    """
+    if query is not None:
+        query = query.strip()
+        if query.lstrip("-").isdigit():
+            with db_read() as conn:
+                rows = conn.execute(SQL_USERS_BY_ID, (int(query), 1)).fetchall()
+            return rows, False, False
+    match = users_match_query(query) if query else None
+    if query and match is None:
+        return [], False, False
+
+    if cursor is None:
+        direction = "first"
+    head = [match] if match else []
+    with db_read() as conn:
+        rows = conn.execute(
+            users_page_sql(direction, bool(match)),
+            (*head, *([cursor] if direction != "first" else []), limit + 1),
+        ).fetchall()
+        if not rows and direction != "first":
+            # пользователя-курсора удалили — начинаем сначала
+            direction = "first"
+            rows = conn.execute(users_page_sql("first", bool(match)), (*head, limit + 1)).fetchall()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        rows.reverse()
+        return rows, more, True
+    return rows, direction == "next", more
+
+
+@db_timed
+def list_verified_user_ids() -> list[int]:
+    """Получатели рассылки: верифицированные пользователи (без демо, у них tg_id < 0)."""
+    with db_read() as conn:
+        return [r["tg_id"] for r in conn.execute("SELECT tg_id FROM users WHERE is_verified=1 AND tg_id > 0")]
+
+
+@db_write_op
+@db_timed
 def delete_user(tg_id: int) -> bool:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM users WHERE tg_id=?", (tg_id,))
-    exists = cur.fetchone() is not None
-    if not exists:
-        conn.close()
-        return False
-    cur.execute("DELETE FROM grades WHERE tg_id=?", (tg_id,))
-    cur.execute("DELETE FROM users WHERE tg_id=?", (tg_id,))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM users WHERE tg_id=?", (tg_id,))
+        exists = cur.fetchone() is not None
+        if not exists:
+            return False
+        cur.execute("DELETE FROM grades WHERE tg_id=?", (tg_id,))
+        cur.execute("DELETE FROM users WHERE tg_id=?", (tg_id,))
+        LEADERBOARD.refresh_user(conn, tg_id)
+        PERCENTILES.refresh_user(conn, tg_id)
+        USER_NAMES.refresh_user(conn, tg_id)
+        ACHIEVEMENT_ENGINE.forget(conn, tg_id)
+    USER_CACHE.invalidate(tg_id)
     return True
 
 
+@db_timed
 def get_subjects() -> list[str]:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM subjects ORDER BY name ASC")
-    rows = cur.fetchall()
-    conn.close()
+    with db_read() as conn:
+        rows = conn.execute("SELECT name FROM subjects ORDER BY name ASC").fetchall()
     return [r["name"] for r in rows]
 
 
+@db_write_op
+@db_timed
 def add_subject(name: str) -> bool:
     name = name.strip()
     if not name:
         return False
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO subjects(name) VALUES(?)", (name,))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        cur = conn.execute("INSERT OR IGNORE INTO subjects(name) VALUES(?)", (name,))
+        if cur.rowcount:
+            SUBJECTS.load(conn)
     return True
 
 
-def add_grade_db(tg_id: int, subject: str, grade: float):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO subjects(name) VALUES(?)", (subject,))
-    cur.execute("INSERT INTO grades(tg_id, subject, grade) VALUES(?, ?, ?)", (tg_id, subject, float(grade)))
-    conn.commit()
-    conn.close()
+def _add_grade(conn, tg_id: int, subject: str, grade: float) -> list[str]:
+    cur = conn.execute("INSERT OR IGNORE INTO subjects(name) VALUES(?)", (subject,))
+    if cur.rowcount:
+        SUBJECTS.load(conn)
+    conn.execute("INSERT INTO grades(tg_id, subject, grade) VALUES(?, ?, ?)", (tg_id, subject, float(grade)))
+    LEADERBOARD.refresh_user(conn, tg_id)
+    PERCENTILES.refresh_user(conn, tg_id, subject)
+    return ACHIEVEMENT_ENGINE.grade_added(conn, tg_id, float(grade))
 
 
-def get_cabinet_stats(tg_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
+@db_write_op
+@db_timed
+def add_grade_db(tg_id: int, subject: str, grade: float) -> list[str]:
+    """
+    Добавляет оценку; возвращает коды достижений, открытых этой оценкой.
+    Запись идёт через GROUP_COMMIT (вместе с одновременными), возврат — после commit.
+    """
+    return GROUP_COMMIT.submit(_add_grade, tg_id, subject, grade).result()
 
-    cur.execute("""
-        SELECT ROUND(AVG(grade), 2) AS avg_total, COUNT(*) AS cnt_total
-        FROM grades
-        WHERE tg_id=?
-    """, (tg_id,))
-    total = cur.fetchone()
-
-    cur.execute("""
-        SELECT
-            g.subject AS subject,
-            ROUND(AVG(g.grade), 2) AS avg_subj,
-            COUNT(*) AS cnt,
-            MAX(g.grade) AS best_grade,
-            (SELECT grade
-             FROM grades g2
-             WHERE g2.tg_id = g.tg_id AND g2.subject = g.subject
-             ORDER BY g2.id DESC
-             LIMIT 1) AS last_grade
-        FROM grades g
-        WHERE g.tg_id=?
-        GROUP BY g.subject
-        ORDER BY g.subject ASC
-    """, (tg_id,))
-    by_subject = cur.fetchall()
-
-    conn.close()
-    return total, by_subject
 
+# run_db ставит мутацию в очередь сам и не держит поток пула на ожидании commit
+add_grade_db.mutation = _add_grade
 
-def get_top(limit: int = 10):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT u.full_name,
-               ROUND(AVG(g.grade), 2) AS avg,
-               COUNT(g.id) AS cnt
-        FROM users u
-        JOIN grades g ON g.tg_id = u.tg_id
-        GROUP BY u.tg_id
-        ORDER BY avg DESC, cnt DESC, u.full_name ASC
-        LIMIT ?
-    """, (limit,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
+# Кабинет читает готовые агрегаты (см. миграцию 4), а не всю историю оценок.
+# SUM/COALESCE по одной строке — чтобы для пользователя без оценок тоже вернулась строка.
+SQL_CABINET_TOTAL = """
+    SELECT ROUND(SUM(grade_sum) / SUM(cnt), 2) AS avg_total, COALESCE(SUM(cnt), 0) AS cnt_total
+    FROM user_stats
+    WHERE tg_id=?
+"""
 
+SQL_CABINET_BY_SUBJECT = """
+    SELECT
+        subject,
+        ROUND(grade_sum / cnt, 2) AS avg_subj,
+        cnt,
+        max_grade AS best_grade,
+        last_grade
+    FROM user_subject_stats
+    WHERE tg_id=?
+    ORDER BY subject ASC
+"""
+
+
+@db_timed
+def get_cabinet_stats(tg_id: int):
+    with db_read() as conn:
+        total = conn.execute(SQL_CABINET_TOTAL, (tg_id,)).fetchone()
+        by_subject = conn.execute(SQL_CABINET_BY_SUBJECT, (tg_id,)).fetchall()
+
+    return total, by_subject
+
+
+# Версия истории пользователя: меняется при любом добавлении или удалении оценки
+SQL_HISTORY_VERSION = """
+    SELECT (SELECT MAX(id) FROM grades WHERE tg_id=?) AS last_id,
+           (SELECT cnt FROM user_stats WHERE tg_id=?) AS cnt
+"""
+
+SQL_GRADE_DAILY = "SELECT subject, day, grade_sum, cnt FROM grade_daily WHERE tg_id=? ORDER BY subject, day"
+
+
+@db_timed
+def get_history_version(tg_id: int) -> tuple[int, int] | None:
+    with db_read() as conn:
+        row = conn.execute(SQL_HISTORY_VERSION, (tg_id, tg_id)).fetchone()
+    return None if row["last_id"] is None else (row["last_id"], row["cnt"])
+
+
+@db_timed
+def get_grade_daily(tg_id: int) -> list[tuple]:
+    """Дневные роллапы пользователя (предмет, день, сумма, количество) — кортежами, для пула графиков."""
+    with db_read() as conn:
+        return [tuple(r) for r in conn.execute(SQL_GRADE_DAILY, (tg_id,))]
+
+
+SQL_PERIOD_TOP = """
+    SELECT u.full_name,
+           ROUND(r.grade_sum / r.cnt, 2) AS avg,
+           r.cnt AS cnt
+    FROM grade_rollups r
+    JOIN users u ON u.tg_id = r.tg_id
+    WHERE r.subject=? AND r.period=?
+    ORDER BY avg DESC, cnt DESC, u.full_name ASC
+    LIMIT ?
+"""
+
+SQL_MOST_IMPROVED = """
+    SELECT u.full_name,
+           ROUND(c.grade_sum / c.cnt - p.grade_sum / p.cnt, 2) AS delta,
+           ROUND(c.grade_sum / c.cnt, 2) AS avg,
+           c.cnt AS cnt
+    FROM grade_rollups c
+    JOIN grade_rollups p ON p.subject = c.subject AND p.period = ? AND p.tg_id = c.tg_id
+    JOIN users u ON u.tg_id = c.tg_id
+    WHERE c.subject=? AND c.period=?
+    ORDER BY delta DESC, cnt DESC, u.full_name ASC
+    LIMIT ?
+"""
+
+
+@db_timed
+def get_period_top(subject: str = "*", period: str = "all", limit: int = 10):
+    """Топ по предмету (или '*' — все предметы) за период: 'all', 'w', 'm', 't' (текущие неделя/месяц/четверть)."""
+    key = period_keys(datetime.utcnow())[period]
+    with db_read() as conn:
+        return conn.execute(SQL_PERIOD_TOP, (subject, key, limit)).fetchall()
+
+
+@db_timed
+def get_most_improved(subject: str = "*", limit: int = 10):
+    """Рост средней за текущий месяц относительно прошлого."""
+    now = datetime.utcnow()
+    prev = now.replace(day=1) - timedelta(days=1)
+    with db_read() as conn:
+        return conn.execute(
+            SQL_MOST_IMPROVED,
+            (period_keys(prev)["m"], subject, period_keys(now)["m"], limit)
+        ).fetchall()
+
+
+SQL_LIST_LAST_GRADES = """
+    SELECT id, subject, grade, created_at
+    FROM grades
+    WHERE tg_id=?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+
+@db_timed
 def list_last_grades(tg_id: int, limit: int = 10):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, subject, grade, created_at
-        FROM grades
-        WHERE tg_id=?
-        ORDER BY id DESC
-        LIMIT ?
-    """, (tg_id, limit))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    with db_read() as conn:
+        return conn.execute(SQL_LIST_LAST_GRADES, (tg_id, limit)).fetchall()
 
 
+@db_write_op
+@db_timed
 def delete_grade_by_id(tg_id: int, grade_id: int) -> bool:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM grades WHERE id=? AND tg_id=?", (grade_id, tg_id))
-    deleted = cur.rowcount > 0
-    conn.commit()
-    conn.close()
-    return deleted
+    with db_write() as conn:
+        cur = conn.execute("DELETE FROM grades WHERE id=? AND tg_id=?", (grade_id, tg_id))
+        if cur.rowcount:
+            LEADERBOARD.refresh_user(conn, tg_id)
+            PERCENTILES.refresh_user(conn, tg_id)
+            ACHIEVEMENT_ENGINE.grades_deleted(conn, tg_id)
+        return cur.rowcount > 0
 
 
+SQL_DELETE_ALL_GRADES = "DELETE FROM grades WHERE tg_id=?"
+
+
+@db_write_op
+@db_timed
 def delete_all_grades(tg_id: int) -> int:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM grades WHERE tg_id=?", (tg_id,))
-    cnt = cur.rowcount
-    conn.commit()
-    conn.close()
-    return cnt
+    with db_write() as conn:
+        cur = conn.execute(SQL_DELETE_ALL_GRADES, (tg_id,))
+        LEADERBOARD.refresh_user(conn, tg_id)
+        PERCENTILES.refresh_user(conn, tg_id)
+        ACHIEVEMENT_ENGINE.grades_deleted(conn, tg_id)
+        return cur.rowcount
 
 
+@db_write_op
+@db_timed
 def delete_grade_for_user(target_id: int, grade_id: int) -> bool:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM grades WHERE id=? AND tg_id=?", (grade_id, target_id))
-    deleted = cur.rowcount > 0
-    conn.commit()
-    conn.close()
-    return deleted
+    with db_write() as conn:
+        cur = conn.execute("DELETE FROM grades WHERE id=? AND tg_id=?", (grade_id, target_id))
+        if cur.rowcount:
+            LEADERBOARD.refresh_user(conn, target_id)
+            PERCENTILES.refresh_user(conn, target_id)
+            ACHIEVEMENT_ENGINE.grades_deleted(conn, target_id)
+        return cur.rowcount > 0
 
 
+@db_write_op
 def delete_all_grades_for_user(target_id: int) -> int:
     return delete_all_grades(target_id)
 
 
-# ========= FSM =========
-class Reg(StatesGroup):
-    full_name = State()
+# ====== Импорт оценок ======
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # больше Bot API всё равно не даст скачать
+IMPORT_CHUNK_ROWS = 5000
+IMPORT_MAX_ERRORS = 20  # столько строк с ошибками хранится и показывается, остальные только считаются
+IMPORT_DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%d.%m.%Y", "%d.%m.%Y %H:%M", "%d.%m.%y")
+IMPORT_COLUMNS = {
+    "user": {"tg_id", "id", "user", "full_name", "name", "пользователь", "ученик", "имя", "фио"},
+    "subject": {"subject", "предмет"},
+    "grade": {"grade", "оценка"},
+    "date": {"date", "created_at", "дата"},
+}
 
 
-class AddGrade(StatesGroup):
-    subject_choice = State()
-    new_subject = State()
-    grade_pick = State()
-    grade_input = State()
-    after = State()
+def _import_text_stream(fileobj) -> io.TextIOWrapper:
+    """Бинарный файл -> текстовый поток: UTF-8 (с BOM или без), иначе cp1251 (Excel)."""
+    import codecs
 
+    head = fileobj.read(64 * 1024)
+    fileobj.seek(0)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1251"
+    return io.TextIOWrapper(fileobj, encoding=encoding, newline="")
 
-class Admin(StatesGroup):
-    del_wait_id = State()
 
-    add_grade_wait_user_id = State()
-    add_grade_subject_choice = State()
-    add_grade_new_subject = State()
-    add_grade_pick = State()
-    add_grade_input = State()
+def _import_delimiter(sample: str) -> str:
+    """Разделитель по первой непустой строке: «;» (русский Excel), табуляция или «,»."""
+    first = next((line for line in sample.splitlines() if line.strip()), "")
+    return max((";", "\t", ","), key=first.count)
 
-    del_grade_wait_user_id = State()
-    del_grade_wait_grade_id = State()
 
-    clear_grades_wait_user_id = State()
-    clear_grades_confirm = State()
+def _parse_import_date(text: str) -> str | None:
+    for fmt in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+    return None
 
 
-class UserDelete(StatesGroup):
-    del_one_wait_id = State()
-    del_all_confirm = State()
+def _import_csv_rows(fileobj):
+    import csv
 
+    text = _import_text_stream(fileobj)
+    delimiter = _import_delimiter(text.read(8192))
+    text.seek(0)
+    try:
+        for raw in csv.reader(text, delimiter=delimiter):
+            yield [c.strip() for c in raw]
+    finally:
+        text.detach()
 
-# ========= BOT =========
-async def main():
-    if TOKEN == "PASTE_YOUR_TOKEN_HERE":
-        raise SystemExit("Вставь токен в переменную TOKEN в начале файла.")
 
-    db_init()
+def _xlsx_cell(value) -> str:
+    """Значение ячейки как в CSV: даты — строкой, целые числа (TG ID, оценка 5) — без «.0»."""
+    if value is None:
+        return ""
+    if hasattr(value, "strftime"):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
 
-    bot = Bot(TOKEN)
-    dp = Dispatcher()
 
-    me = await bot.get_me()
-    log.info("✅ Bot started as @%s (id=%s)", me.username, me.id)
-    # сообщение админу о запуске
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, f"✅ Бот запущен: @{me.username}")
-        except Exception as e:
-            log.warning("Не смог отправить стартовое сообщение админу %s: %s", admin_id, e)
+def _import_xlsx_rows(fileobj):
+    """Строки первого листа XLSX (openpyxl в режиме read_only — лист не грузится в память целиком)."""
+    from openpyxl import load_workbook
 
-    # --- Отмена в любом месте
-    @dp.message(F.text == BTN_CANCEL)
-    async def cancel(m: Message, state: FSMContext):
-        await state.clear()
-        await m.answer("Ок, отменил. Выбирай действие 👇", reply_markup=main_kb(m.from_user.id))
-
-    # --- HELP
-    @dp.message(Command("help"))
-    @dp.message(F.text == BTN_HELP)
-    async def help_cmd(m: Message):
-        txt = (
-            "Доступно:\n"
-            f"• {BTN_ADD} — добавить оценку\n"
-            f"• {BTN_CAB} — личный кабинет (средняя + по предметам)\n"
-            f"• {BTN_TOP} — лидерборд (общая средняя)\n"
-            f"• {BTN_DEL_ONE} — удалить одну свою оценку\n"
-            f"• {BTN_DEL_ALL} — удалить все свои оценки\n\n"
-            "Если не зарегистрирован — /start\n"
-        )
-        if is_admin(m.from_user.id):
-            txt += "\nАдмин:\n• 🛠 Админка — управление пользователями/демо/оценки"
-        await m.answer(txt, reply_markup=main_kb(m.from_user.id))
+    try:
+        book = load_workbook(fileobj, read_only=True, data_only=True)
+    except Exception as e:
+        raise ValueError(f"не удалось открыть XLSX: {e}") from e
+    try:
+        for values in book.worksheets[0].iter_rows(values_only=True):
+            yield [_xlsx_cell(v) for v in values]
+    finally:
+        book.close()
 
-    # --- START / регистрация
-    @dp.message(Command("start"))
-    async def start(m: Message, state: FSMContext):
-        await state.clear()
-        user = get_user(m.from_user.id)
-
-        # Уже авторизован
-        if user and is_user_verified(m.from_user.id):
-            log.info("start: verified user tg_id=%s name=%s", m.from_user.id, user["full_name"])
-            await m.answer(
-                f"Привет, {user['full_name']}! 👇",
-                reply_markup=main_kb(m.from_user.id)
-            )
-            return
 
-        # Есть в базе, но не авторизован -> только заявка
-        if user and not is_user_verified(m.from_user.id):
-            log.info("start: not verified tg_id=%s name=%s", m.from_user.id, user["full_name"])
-            await m.answer(
-                "🔒 Доступ к функциям бота пока не выдан.\n"
-                "Нажми «📩 Запросить доступ», чтобы отправить заявку админу.",
-                reply_markup=unauth_kb()
-            )
-            return
+class ImportErrors:
+    """Ошибки импорта: первые limit строк с причиной и общее число."""
 
-        # Новый пользователь -> регистрация (Имя Фамилия)
-        log.info("start: new user tg_id=%s username=@%s", m.from_user.id, m.from_user.username)
-        await m.answer(
-            "Привет! Зарегистрируйся.\n"
-            "Напиши *Имя Фамилия* (пример: Иван Иванов):",
-            parse_mode="Markdown",
-            reply_markup=cancel_kb()
-        )
-        await state.set_state(Reg.full_name)
-    @dp.message(Reg.full_name)
-    async def reg_full_name(m: Message, state: FSMContext):
-        full_name = (m.text or "").strip()
-        parts = [p for p in full_name.split() if p]
-        if len(parts) < 2:
-            await m.answer("Нужно *Имя Фамилия* (2 слова). Пример: Иван Иванов", parse_mode="Markdown")
-            return
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.items: list[tuple[int, str]] = []
+        self.count = 0
 
-        upsert_user(m.from_user.id, full_name)
-        log.info("registered tg_id=%s name=%s", m.from_user.id, full_name)
+    def add(self, line_no: int, message: str):
+        self.count += 1
+        if len(self.items) < self.limit:
+            self.items.append((line_no, message))
 
-        await state.clear()
-        await m.answer(
-            f"✅ Регистрация сохранена: *{full_name}*.\n"
-            "Теперь запроси доступ у администратора кнопкой ниже.",
-            parse_mode="Markdown",
-            reply_markup=unauth_kb()
-        )
-    @dp.message(F.text == BTN_GET_CODE)
-    async def request_access(m: Message):
-        """
-        Авторизация по заявкам (без кода).
-        Пользователь нажимает "Запросить доступ" -> бот отправляет заявку админу.
-        Защита от спама: повторная заявка запрещена, если уже pending; после отказа действует кулдаун.
-        """
-        user_row = get_user(m.from_user.id)
-        if not user_row:
-            await m.answer("Сначала зарегистрируйся через /start (Имя Фамилия).", reply_markup=cancel_kb())
-            return
 
-        # если уже верифицирован — просто показать меню
-        if is_user_verified(m.from_user.id):
-            await m.answer("✅ Ты уже авторизован.", reply_markup=main_kb(m.from_user.id))
-            return
+def _import_rows(fileobj):
+    """Строки файла списками строк: XLSX узнаём по сигнатуре zip, остальное читаем как CSV."""
+    head = fileobj.read(4)
+    fileobj.seek(0)
+    return _import_xlsx_rows(fileobj) if head == b"PK\x03\x04" else _import_csv_rows(fileobj)
+
+
+def _parse_import(rows, known_ids: set[int], by_name: dict[str, list[int]], subjects: dict[str, str],
+                  errors: ImportErrors, new_subjects: list[str]):
+    """
+    Проверяет строки по одной и отдаёт корректные (tg_id, предмет, оценка, дата | None).
+    Заголовок ищется в первой непустой строке.
+    """
+    now = datetime.utcnow()
+    columns = {"user": 0, "subject": 1, "grade": 2, "date": 3}
+    header_checked = False
+    for line_no, cells in enumerate(rows, start=1):
+        if not any(cells):
+            continue
+        if not header_checked:
+            header_checked = True
+            header = {c.casefold(): i for i, c in enumerate(cells)}
+            found = {col: i for col, names in IMPORT_COLUMNS.items() for name, i in header.items() if name in names}
+            if {"user", "subject", "grade"} <= found.keys():
+                columns = {"date": None, **found}
+                continue
+
+        def cell(col: str) -> str:
+            i = columns.get(col)
+            return cells[i] if i is not None and i < len(cells) else ""
+
+        who = cell("user")
+        if who.lstrip("-").isdigit():
+            tg_id = int(who)
+            if tg_id not in known_ids:
+                errors.add(line_no, f"нет пользователя с id={tg_id}")
+                continue
+        else:
+            ids = by_name.get(" ".join(who.split()).casefold(), [])
+            if len(ids) != 1:
+                errors.add(line_no, f"пользователь «{who}» не найден" if not ids else f"«{who}» — несколько пользователей, укажи tg_id")
+                continue
+            tg_id = ids[0]
+
+        subject = " ".join(cell("subject").split())
+        if len(subject) < 2:
+            errors.add(line_no, "не указан предмет")
+            continue
+        subject = subjects.get(subject.casefold(), subject)
+
+        grade = parse_grade(cell("grade"))
+        if grade is None:
+            errors.add(line_no, f"оценка «{cell('grade')}» не число 2–5")
+            continue
+
+        created_at = None
+        if cell("date"):
+            created_at = _parse_import_date(cell("date"))
+            if created_at is None:
+                errors.add(line_no, f"не понял дату «{cell('date')}»")
+                continue
+            if created_at > (now + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"):
+                errors.add(line_no, "дата в будущем")
+                continue
+
+        if subject.casefold() not in subjects:
+            subjects[subject.casefold()] = subject
+            new_subjects.append(subject)
+        yield tg_id, subject, grade, created_at
+
+
+@db_write_op
+@db_timed
+def import_grades(fileobj) -> dict:
+    """
+    Импорт оценок из CSV или XLSX (первый лист): пользователь (tg_id или
+    «Имя Фамилия»), предмет, оценка, дата (необязательно). Строка заголовка
+    необязательна; у CSV разделитель («;», «,» или табуляция) и кодировка
+    определяются сами. Имена ищутся по индексу, загруженному одним запросом.
+    Файл читается потоком и пишется кусками по IMPORT_CHUNK_ROWS строк, но
+    в одной транзакции (агрегаты, роллапы, лидерборд и достижения
+    обновляются там же). Внутри куска оценки пишутся по пользователям в порядке
+    дат, счётчики достижений сдвигаются один раз на пользователя. Строки с
+    ошибками пропускаются: в errors — первые IMPORT_MAX_ERRORS (номер строки,
+    причина), в error_count — сколько всего. Нечитаемый XLSX — ValueError.
+    """
+    with db_read() as conn:
+        known_ids = set()
+        by_name: dict[str, list[int]] = {}
+        for r in conn.execute("SELECT tg_id, full_name FROM users"):
+            known_ids.add(r["tg_id"])
+            by_name.setdefault(r["full_name"].strip().casefold(), []).append(r["tg_id"])
+    subjects = {name.casefold(): name for name in SUBJECTS.names()}
+    errors = ImportErrors(IMPORT_MAX_ERRORS)
+    new_subjects: list[str] = []
+    parsed = _parse_import(_import_rows(fileobj), known_ids, by_name, subjects, errors, new_subjects)
+
+    imported = unlocked = 0
+    users: set[int] = set()
+    touched = {}
+    try:
+        with CACHE_SYNC.capture() as touched, db_write() as conn:
+            stored_subjects = 0
+            while chunk := list(itertools.islice(parsed, IMPORT_CHUNK_ROWS)):
+                if len(new_subjects) > stored_subjects:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO subjects(name) VALUES(?)",
+                        [(n,) for n in new_subjects[stored_subjects:]]
+                    )
+                    stored_subjects = len(new_subjects)
+                # без даты — «сейчас», то есть после всех датированных
+                chunk.sort(key=lambda row: (row[0], row[3] is None, row[3] or ""))
+                conn.executemany(
+                    "INSERT INTO grades(tg_id, subject, grade, created_at) VALUES(?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+                    chunk
+                )
+                by_user: dict[int, list[tuple[float, str | None]]] = {}
+                for tg_id, _subject, grade, created_at in chunk:
+                    by_user.setdefault(tg_id, []).append((grade, created_at))
+                unlocked += ACHIEVEMENT_ENGINE.grades_imported(conn, by_user)
+                users.update(by_user)
+                imported += len(chunk)
+            if new_subjects:
+                SUBJECTS.load(conn)
+            for tg_id in users:
+                LEADERBOARD.refresh_user(conn, tg_id)
+                PERCENTILES.refresh_user(conn, tg_id)
+    except Exception:
+        # счётчики достижений уже сдвинуты кусками, которые откатились вместе с транзакцией
+        CACHE_SYNC.restore(list(touched))
+        raise
+
+    return {
+        "imported": imported,
+        "users": len(users),
+        "errors": errors.items,
+        "error_count": errors.count,
+        "new_subjects": new_subjects,
+        "achievements": unlocked,
+    }
+
+
+# ====== Экспорт оценок ======
+EXPORT_FETCH_SIZE = 1000
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Bot API на отправку документа
+EXPORT_COLUMNS = ("id", "tg_id", "full_name", "subject", "grade", "created_at")
+
+SQL_EXPORT_GRADES = """
+    SELECT g.id, g.tg_id, u.full_name, g.subject, g.grade, g.created_at
+    FROM grades g
+    LEFT JOIN users u ON u.tg_id = g.tg_id
+"""
+
+
+@db_timed
+def export_grades(
+    fmt: str = "csv",
+    tg_id: int | None = None,
+    subject: str | None = None,
+    date_from: str | None = None,
+    date_to: str | None = None,
+    compress: bool = False,
+):
+    """
+    Выгружает оценки (все или с фильтрами) в CSV или JSON.
+    Строки читаются через fetchmany порциями по EXPORT_FETCH_SIZE и сразу
+    пишутся в SpooledTemporaryFile (до 1 МБ в памяти, дальше — на диске),
+    при compress — через gzip. Чтение идёт читающим соединением: в WAL оно
+    не держит блокировку записи, добавление оценок не ждёт экспорт.
+    date_from/date_to — ГГГГ-ММ-ДД включительно.
+    Возвращает (файл, перемотанный в начало; число строк).
+    """
+    import csv
+    import gzip
+    import tempfile
+
+    where, params = [], []
+    if tg_id is not None:
+        where.append("g.tg_id = ?")
+        params.append(tg_id)
+    if subject is not None:
+        where.append("g.subject = ?")
+        params.append(subject)
+    if date_from is not None:
+        where.append("g.created_at >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        where.append("g.created_at < date(?, '+1 day')")
+        params.append(date_to)
+    sql = SQL_EXPORT_GRADES + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY g.id"
+
+    out = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    raw = gzip.GzipFile(fileobj=out, mode="wb") if compress else out
+    # BOM — чтобы Excel открыл CSV в UTF-8 без вопросов
+    text = io.TextIOWrapper(raw, encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+    count = 0
+    with db_read() as conn:
+        cur = conn.execute(sql, params)
+        if fmt == "csv":
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS)
+        else:
+            text.write("[")
+        while rows := cur.fetchmany(EXPORT_FETCH_SIZE):
+            for r in rows:
+                if fmt == "csv":
+                    writer.writerow(tuple(r))
+                else:
+                    text.write(("," if count else "") + "\n" + json.dumps(dict(r), ensure_ascii=False))
+                count += 1
+        if fmt != "csv":
+            text.write("\n]\n")
+    text.detach()
+    if compress:
+        raw.close()  # дописывает хвост gzip, сам out не закрывает
+    out.seek(0)
+    return out, count
+
+
+def parse_export_filter(text: str) -> tuple[str | None, str | None, str | None, str] | None:
+    """
+    «Математика 01.09.2025 31.12.2025 json» -> (предмет, с, по, формат).
+    Даты и слово json/csv можно не указывать; «все» — без фильтра.
+    None, если предмет не найден.
+    """
+    dates, words, fmt = [], [], "csv"
+    for token in text.split():
+        low = token.casefold()
+        if low in ("json", "csv"):
+            fmt = low
+        elif low in ("все", "всё", "*", "-"):
+            continue
+        elif (d := _parse_import_date(token)) is not None:
+            dates.append(d[:10])
+        else:
+            words.append(token)
+    subject = None
+    if words:
+        wanted = " ".join(words).casefold()
+        subject = next((n for n in SUBJECTS.names() if n.casefold() == wanted), None)
+        if subject is None:
+            return None
+    dates.sort()
+    date_from = dates[0] if dates else None
+    date_to = dates[-1] if len(dates) > 1 else None
+    return subject, date_from, date_to, fmt
+
+
+class SpooledInputFile(InputFile):
+    """Документ для Bot API из временного файла экспорта, читается кусками."""
 
-        # анти-спам и кулдаун
-        req = get_access_request(m.from_user.id)
-        now = datetime.utcnow()
+    def __init__(self, file, filename: str):
+        super().__init__(filename=filename)
+        self.file = file
 
-        if req and req["status"] == "pending":
-            await m.answer("⏳ Твоя заявка уже отправлена и ожидает решения администратора.", reply_markup=unauth_kb())
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+
+# ====== Поиск по именам (триграммы) ======
+class TrigramIndex:
+    """
+    Нечёткий поиск по коротким строкам (имена, предметы) в памяти.
+    Строка раскладывается на триграммы слов (слово с двумя пробелами в начале,
+    как в pg_trgm), у запроса конец слова не учитывается — «петр» находит «Петров».
+    Кандидаты берутся из самых редких списков триграмм запроса: строка, где
+    совпала хотя бы половина триграмм запроса, обязательно есть в одном из них,
+    а к ним обращаемся, только если строк со всеми триграммами запроса нет.
+    Ранг: число совпавших триграмм запроса, затем сходство строк целиком.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grams: dict[str, set] = {}
+        self._items: dict = {}  # ключ -> (текст, триграммы)
+
+    @staticmethod
+    def trigrams(text: str, word_end: bool = True) -> frozenset[str]:
+        text = text.casefold().replace("ё", "е")
+        grams = set()
+        for word in "".join(c if c.isalnum() else " " for c in text).split():
+            padded = "  " + word + (" " if word_end else "")
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return frozenset(grams)
+
+    def _add(self, key, text: str):
+        grams = self.trigrams(text)
+        self._items[key] = (text, grams)
+        for g in grams:
+            self._grams.setdefault(g, set()).add(key)
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is None:
             return
+        for g in item[1]:
+            keys = self._grams[g]
+            keys.discard(key)
+            if not keys:
+                del self._grams[g]
+
+    def put(self, key, text: str | None):
+        """Добавляет или заменяет строку; text=None — удаляет."""
+        with self._lock:
+            self._remove(key)
+            if text is not None:
+                self._add(key, text)
+
+    def reset(self, items):
+        """Строит индекс заново из пар (ключ, текст)."""
+        with self._lock:
+            self._grams = {}
+            self._items = {}
+            for key, text in items:
+                self._add(key, text)
+
+    def search(self, query: str, limit: int = 8) -> list[tuple]:
+        """До limit пар (ключ, текст), лучшие первыми."""
+        q = self.trigrams(query, word_end=False)
+        if not q:
+            return []
+        n = len(q)
+        scored, seen = [], set()
+
+        def take(keys):
+            for key in keys - seen:
+                seen.add(key)
+                text, grams = self._items[key]
+                common = len(q & grams)
+                if common >= (n + 1) // 2:
+                    scored.append((-common, -common / (n + len(grams) - common), text, key))
+
+        with self._lock:
+            lists = sorted((self._grams.get(g, frozenset()) for g in q), key=len)
+            # строки со всеми триграммами запроса; если таких нет (опечатка) —
+            # добавляем по одному самому редкому списку: после lists[:i + 1]
+            # известны все строки, где совпало не меньше n - i триграмм
+            take(lists[0].intersection(*lists[1:]))
+            known, i = n, 0
+            while not (scored and known == n) and i <= n - (n + 1) // 2 \
+                    and sum(1 for s in scored if -s[0] >= known) < limit:
+                take(lists[i])
+                known, i = n - i, i + 1
+        return [(key, text) for *_, text, key in heapq.nsmallest(limit, scored)]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class UserNameIndex(TrigramIndex):
+    """Триграммы users.full_name. Обновляется в upsert_user, delete_user и seed_demo_data_force."""
+
+    def load(self, conn):
+        self.reset((r["tg_id"], r["full_name"]) for r in conn.execute("SELECT tg_id, full_name FROM users"))
+        CACHE_SYNC.emit("names")
+
+    def refresh_user(self, conn, tg_id: int):
+        row = conn.execute("SELECT full_name FROM users WHERE tg_id=?", (tg_id,)).fetchone()
+        self.put(tg_id, row["full_name"] if row else None)
+        CACHE_SYNC.emit("names", tg_id)
+
+
+USER_NAMES = UserNameIndex()
+
+
+# ====== Лидерборд в памяти ======
+class Leaderboard:
+    """
+    Общий лидерборд в памяти: SortedList по ключу (-avg, -cnt, full_name, tg_id),
+    тот же порядок, что и в get_period_top. Строится один раз при старте из user_stats
+    и обновляется точечно внутри каждой записи, затрагивающей оценки или имя,
+    поэтому топ, место пользователя и соседи отдаются без запросов к SQLite.
+    """
 
-        if req and req["status"] == "denied":
-            last = req["last_request_at"] or req["handled_at"] or req["requested_at"]
-            last_dt = parse_sqlite_ts(last)
-            if last_dt:
-                seconds = int((now - last_dt).total_seconds())
-                if seconds < REQUEST_COOLDOWN_SEC:
-                    wait = REQUEST_COOLDOWN_SEC - seconds
-                    mins = (wait + 59) // 60
-                    await m.answer(f"⛔ Заявка недавно отклонена. Попробуй снова через ~{mins} мин.", reply_markup=unauth_kb())
-                    return
-
-        full_name = user_row["full_name"]
-        username = f"@{m.from_user.username}" if m.from_user.username else None
-
-        upsert_access_request_pending(m.from_user.id, full_name, username)
-
-        # сообщение админу с кнопками
-        kb = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="✅ Принять", callback_data=f"auth:accept:{m.from_user.id}"),
-            InlineKeyboardButton(text="❌ Отклонить", callback_data=f"auth:deny:{m.from_user.id}")
-        ]])
-
-        admin_text = (
-            "📩 Заявка на доступ\n"
-            f"ID: {m.from_user.id}\n"
-            f"Имя (в боте): {full_name}\n"
-            f"Username: {username or '(нет username)'}"
-        )
+    SQL = """
+        SELECT u.tg_id, u.full_name, ROUND(s.grade_sum / s.cnt, 2) AS avg, s.cnt
+        FROM user_stats s
+        JOIN users u ON u.tg_id = s.tg_id
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sorted = ()  # SortedList заводится в load() или при первой вставке
+        self._keys: dict[int, tuple] = {}
+
+    @staticmethod
+    def _new_sorted(keys=()):
+        from sortedcontainers import SortedList
+        return SortedList(keys)
+
+    @staticmethod
+    def _key(row) -> tuple:
+        return (-row["avg"], -row["cnt"], row["full_name"], row["tg_id"])
+
+    @staticmethod
+    def _entry(key: tuple, rank: int) -> dict:
+        return {"rank": rank, "tg_id": key[3], "full_name": key[2], "avg": -key[0], "cnt": -key[1]}
+
+    def load(self, conn):
+        keys = {row["tg_id"]: self._key(row) for row in conn.execute(self.SQL)}
+        with self._lock:
+            self._keys = keys
+            self._sorted = self._new_sorted(keys.values())
+        CACHE_SYNC.emit("leaderboard")
+
+    def refresh_user(self, conn, tg_id: int):
+        row = conn.execute(self.SQL + " WHERE s.tg_id=?", (tg_id,)).fetchone()
+        with self._lock:
+            old = self._keys.pop(tg_id, None)
+            if old is not None:
+                self._sorted.remove(old)
+            if row is not None:
+                key = self._key(row)
+                self._keys[tg_id] = key
+                if not self._sorted:
+                    self._sorted = self._new_sorted()
+                self._sorted.add(key)
+        CACHE_SYNC.emit("leaderboard", tg_id)
+
+    def top(self, limit: int = 10) -> list[dict]:
+        with self._lock:
+            return [self._entry(k, i) for i, k in enumerate(self._sorted[:limit], start=1)]
+
+    def rank(self, tg_id: int) -> int | None:
+        with self._lock:
+            key = self._keys.get(tg_id)
+            return None if key is None else self._sorted.index(key) + 1
+
+    def around(self, tg_id: int, radius: int = 2) -> list[dict]:
+        """Пользователь и до radius соседей сверху и снизу."""
+        with self._lock:
+            key = self._keys.get(tg_id)
+            if key is None:
+                return []
+            pos = self._sorted.index(key)
+            lo = max(0, pos - radius)
+            return [self._entry(k, i) for i, k in enumerate(self._sorted[lo:pos + radius + 1], start=lo + 1)]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+LEADERBOARD = Leaderboard()
+
+
+# ====== Перцентили ======
+class GradeHistogram:
+    """
+    Распределение средних по корзинам шириной 0.01 на отрезке 2.00–5.00
+    (301 корзина — столько же, сколько различных средних видно в боте).
+    Добавление и удаление — O(1), квантиль и доля «выше» — проход по 301 корзине.
+    """
+
+    BINS = 301
+
+    def __init__(self):
+        self.counts = [0] * self.BINS
+        self.total = 0
+
+    @staticmethod
+    def bin(avg: float) -> int:
+        return min(max(round((avg - 2.0) * 100), 0), GradeHistogram.BINS - 1)
+
+    def add(self, b: int, n: int = 1):
+        self.counts[b] += n
+        self.total += n
+
+    def above(self, b: int) -> int:
+        """Сколько значений строго выше корзины b."""
+        return sum(self.counts[b + 1:])
+
+    def quantile(self, q: float) -> float | None:
+        if not self.total:
+            return None
+        rank = q * (self.total - 1)
+        seen = 0
+        for b, n in enumerate(self.counts):
+            seen += n
+            if seen > rank:
+                return 2.0 + b / 100
+        return 5.0
+
+
+# «топ X%» и медиана показываются, когда средних в разрезе не меньше стольких
+PERCENTILE_MIN_USERS = 5
 
-        sent_any = False
-        for admin_id in ADMIN_IDS:
-            try:
-                await m.bot.send_message(admin_id, admin_text, reply_markup=kb)
-                sent_any = True
-            except Exception:
-                pass
 
-        if sent_any:
-            await m.answer("✅ Заявка отправлена администратору. Ожидай решения.", reply_markup=unauth_kb())
+class PercentileEngine:
+    """
+    Гистограммы средних пользователей: общая ("*") и по каждому предмету.
+    Строится при старте из user_stats / user_subject_stats и обновляется
+    точечно в тех же записях, что и LEADERBOARD (чтение строк по ключу), поэтому
+    кабинет показывает «топ X%» и медианы без агрегатных запросов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hists: dict[str, GradeHistogram] = {}
+        self._bins: dict[tuple[str, int], int] = {}
+
+    def _set(self, scope: str, tg_id: int, avg: float | None):
+        old = self._bins.pop((scope, tg_id), None)
+        if old is not None:
+            self._hists[scope].add(old, -1)
+        if avg is not None:
+            b = GradeHistogram.bin(avg)
+            self._bins[(scope, tg_id)] = b
+            self._hists.setdefault(scope, GradeHistogram()).add(b)
+
+    def load(self, conn):
+        with self._lock:
+            self._hists = {}
+            self._bins = {}
+            for r in conn.execute("SELECT tg_id, grade_sum / cnt AS avg FROM user_stats"):
+                self._set("*", r["tg_id"], r["avg"])
+            for r in conn.execute("SELECT tg_id, subject, grade_sum / cnt AS avg FROM user_subject_stats"):
+                self._set(r["subject"], r["tg_id"], r["avg"])
+        CACHE_SYNC.emit("percentiles")
+
+    def refresh_user(self, conn, tg_id: int, subject: str | None = None):
+        """Перечитывает средние пользователя: общую и по subject (или по всем его предметам)."""
+        total = conn.execute("SELECT grade_sum / cnt AS avg FROM user_stats WHERE tg_id=?", (tg_id,)).fetchone()
+        if subject is not None:
+            rows = conn.execute(
+                "SELECT subject, grade_sum / cnt AS avg FROM user_subject_stats WHERE tg_id=? AND subject=?",
+                (tg_id, subject)
+            ).fetchall()
         else:
-            await m.answer("⚠️ Не удалось отправить заявку админу. Попробуй позже.", reply_markup=unauth_kb())
+            rows = conn.execute(
+                "SELECT subject, grade_sum / cnt AS avg FROM user_subject_stats WHERE tg_id=?", (tg_id,)
+            ).fetchall()
+        fresh = {r["subject"]: r["avg"] for r in rows}
+        with self._lock:
+            self._set("*", tg_id, total["avg"] if total else None)
+            scopes = [subject] if subject is not None else [s for s in self._hists if s != "*"]
+            for scope in {*scopes, *fresh}:
+                self._set(scope, tg_id, fresh.get(scope))
+        CACHE_SYNC.emit("percentiles", tg_id)
+
+    def top_percent(self, tg_id: int, scope: str = "*") -> tuple[int, int] | None:
+        """(X, всего) для «ты в топ-X%»: доля пользователей не ниже тебя, с округлением вверх."""
+        with self._lock:
+            b = self._bins.get((scope, tg_id))
+            hist = self._hists.get(scope)
+            if b is None or hist is None:
+                return None
+            above, total = hist.above(b), hist.total
+        return max(1, -(-(above + 1) * 100 // total)), total
+
+    def median(self, scope: str = "*") -> float | None:
+        with self._lock:
+            hist = self._hists.get(scope)
+            return hist.quantile(0.5) if hist else None
+
+
+PERCENTILES = PercentileEngine()
+
+
+# ====== Графики динамики ======
+def rolling_averages(rows, window_days: int, max_points: int) -> dict[str, tuple[list, list]]:
+    """
+    Скользящая средняя по предметам из дневных роллапов (отсортированы по предмету
+    и дню): в точке дня d — средняя всех оценок за [d - window_days + 1, d].
+    Точки — дни с оценками; если их больше max_points, берутся равномерно
+    (первая и последняя — всегда).
+    """
+    series = {}
+    for subject, group in itertools.groupby(rows, key=lambda r: r[0]):
+        days, sums, cnts = [], [], []
+        for _subject, day, grade_sum, cnt in group:
+            days.append(datetime.fromisoformat(day))
+            sums.append(grade_sum)
+            cnts.append(cnt)
+        xs, ys = [], []
+        lo, window_sum, window_cnt = 0, 0.0, 0
+        for hi, day in enumerate(days):
+            window_sum += sums[hi]
+            window_cnt += cnts[hi]
+            while (day - days[lo]).days >= window_days:
+                window_sum -= sums[lo]
+                window_cnt -= cnts[lo]
+                lo += 1
+            xs.append(day)
+            ys.append(window_sum / window_cnt)
+        if len(xs) > max_points:
+            step = (len(xs) - 1) / (max_points - 1)
+            keep = sorted({round(i * step) for i in range(max_points)})
+            xs = [xs[i] for i in keep]
+            ys = [ys[i] for i in keep]
+        series[subject] = (xs, ys)
+    return series
+
+
+def render_dynamics_png(rows, title: str, window_days: int, max_points: int) -> bytes:
+    """Рисует PNG со скользящими средними по предметам. Выполняется в процессе chart_pool()."""
+    import matplotlib.dates as mdates
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 4.5), dpi=100)
+    ax = fig.subplots()
+    for subject, (xs, ys) in rolling_averages(rows, window_days, max_points).items():
+        ax.plot(xs, ys, label=subject, linewidth=1.5, marker="o" if len(xs) <= 20 else None, markersize=3)
+    ax.set_ylim(1.95, 5.05)
+    ax.set_title(title, fontsize=11)
+    ax.set_ylabel(f"средняя за {window_days} дн.")
+    ax.grid(alpha=0.3)
+    locator = mdates.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+    ax.legend(loc="lower left", fontsize=8, ncols=2)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+_chart_pool = None
+
+
+def chart_pool():
+    """Пул процессов для графиков (создаётся при первом графике): рендер не держит event loop и GIL."""
+    global _chart_pool
+    if _chart_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _chart_pool
+
+
+async def close_chart_pool():
+    global _chart_pool
+    if _chart_pool is not None:
+        pool, _chart_pool = _chart_pool, None
+        await asyncio.to_thread(pool.shutdown, cancel_futures=True)
+
+
+class ChartCache:
+    """
+    Готовые графики: tg_id -> (версия истории, PNG или file_id уже отправленного фото).
+    Версия — (id последней оценки, число оценок) из get_history_version, поэтому
+    после добавления или удаления оценки старый график не отдаётся.
+    """
 
-    @dp.callback_query(F.data.startswith("auth:"))
-    async def auth_decision(q: CallbackQuery):
-        # доступ только админу
-        if not is_admin(q.from_user.id):
-            await q.answer("Нет доступа.", show_alert=True)
-            return
+    def __init__(self, maxsize: int = CHART_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: OrderedDict[int, tuple[tuple, bytes | str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tg_id: int, version: tuple) -> bytes | str | None:
+        with self._lock:
+            item = self._data.get(tg_id)
+            if item is None or item[0] != version:
+                return None
+            self._data.move_to_end(tg_id)
+            return item[1]
+
+    def put(self, tg_id: int, version: tuple, payload: bytes | str):
+        with self._lock:
+            self._data[tg_id] = (version, payload)
+            self._data.move_to_end(tg_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+CHARTS = ChartCache()
+METRICS.describe("bot_chart_render_seconds", "histogram", "Рендер графиков динамики в пуле процессов")
+
+
+# ====== Кэш предметов ======
+class SubjectCache:
+    """
+    Каталог предметов в памяти с номером версии, готовой клавиатурой и триграммным поиском.
+    Перечитывается внутри тех записей, которые меняют subjects (add_subject,
+    add_grade_db, seed_default_subjects, seed_demo_data_force), поэтому
+    сценарий добавления оценки не читает базу до самой записи оценки.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._names: tuple[str, ...] = ()
+        self._set: frozenset[str] = frozenset()
+        self._kb: ReplyKeyboardMarkup | None = None
+        self._index = TrigramIndex()
+
+    def load(self, conn):
+        names = tuple(r["name"] for r in conn.execute("SELECT name FROM subjects ORDER BY name ASC"))
+        with self._lock:
+            self._names = names
+            self._set = frozenset(names)
+            self._kb = None
+            self.version += 1
+        self._index.reset((n, n) for n in names)
+        CACHE_SYNC.emit("subjects")
+
+    def search(self, query: str, limit: int = 8) -> list[str]:
+        """Предметы, похожие на query (опечатки, начало слова), лучшие первыми."""
+        return [name for name, _ in self._index.search(query, limit)]
+
+    def names(self) -> list[str]:
+        return list(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._set
+
+    def keyboard(self) -> ReplyKeyboardMarkup:
+        with self._lock:
+            if self._kb is None:
+                self._kb = subject_kb(list(self._names))
+            return self._kb
+
+
+SUBJECTS = SubjectCache()
+
+
+def warm_cache(cache):
+    """Загружает одну in-memory структуру (LEADERBOARD, SUBJECTS, ...) своим читающим соединением."""
+    with db_read() as conn:
+        cache.load(conn)
+
+
+def warm_caches():
+    """Строит in-memory структуры по текущему состоянию базы (при старте и после массовых изменений)."""
+    for cache in (LEADERBOARD, SUBJECTS, ACHIEVEMENT_ENGINE, USER_NAMES, PERCENTILES):
+        warm_cache(cache)
+
+
+# ====== Аналитика: колоночный снимок grades ======
+SQL_SNAPSHOT_VERSION = """
+    SELECT (SELECT MAX(id) FROM grades) AS last_id,
+           (SELECT COALESCE(SUM(cnt), 0) FROM user_stats) AS cnt
+"""
+
+# один проход по rowid, без сортировок и группировок; код предмета — subjects.rowid
+SQL_SNAPSHOT_GRADES = """
+    SELECT g.tg_id, COALESCE(s.rowid, 0), g.grade, COALESCE(CAST(strftime('%s', g.created_at) AS INTEGER), 0)
+    FROM grades g
+    LEFT JOIN subjects s ON s.name = g.subject
+"""
+
+SNAPSHOT_FETCH_SIZE = 50_000
+
+
+class GradesSnapshot:
+    """
+    Колоночный снимок grades для отчёта «📊 Аналитика»: массивы NumPy tg_id (int64),
+    subject (int32, subjects.rowid — индекс в списке предметов), grade (float32) и ts (int64,
+    unix-время), каждый — отдельный .npy в ANALYTICS_DIR, открытый как memmap.
+    Версия — (MAX(id), число оценок): снимок перестраивается, если она изменилась
+    и с прошлой сборки прошло ANALYTICS_REFRESH_SEC (или force). После перезапуска
+    снимок той же версии подхватывается с диска без чтения grades.
+    Рядом хранятся производные по пользователям (код пользователя у каждой
+    оценки, месяц первой оценки) — считаются один раз на снимок.
+    """
+
+    COLUMNS = {"tg_id": "int64", "subject": "int32", "grade": "float32", "ts": "int64"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.view: dict | None = None
+        self.checked_at = 0.0
+
+    @staticmethod
+    def directory() -> str:
+        return ANALYTICS_DIR or f"{DB_NAME}.analytics"
+
+    def current(self, force: bool = False) -> dict:
+        with self._lock:
+            if self.view is not None and not force and time.time() - self.checked_at < ANALYTICS_REFRESH_SEC:
+                return self.view
+            with db_read() as conn:
+                row = conn.execute(SQL_SNAPSHOT_VERSION).fetchone()
+                version = [row["last_id"] or 0, row["cnt"]]
+                if self.view is None:
+                    self.view = self._open_saved(version)
+                if self.view is None or self.view["version"] != version:
+                    self.view = self._build(conn, version)
+            self.checked_at = time.time()
+            return self.view
+
+    def _open_saved(self, version: list) -> dict | None:
+        path = os.path.join(self.directory(), "meta.json")
         try:
-            _, action, tg_id_str = (q.data or "").split(":")
-            target_id = int(tg_id_str)
-        except Exception:
-            await q.answer("Неверные данные.", show_alert=True)
-            return
+            with open(path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["version"] != version:
+                return None
+            return self._open(meta)
+        except (OSError, ValueError, KeyError):
+            return None
 
-        target_user = get_user(target_id)
-        target_name = target_user["full_name"] if target_user else f"tg_id={target_id}"
+    def _build(self, conn, version: list) -> dict:
+        import numpy as np
+
+        started = time.perf_counter()
+        subjects = {r[0]: r[1] for r in conn.execute("SELECT rowid, name FROM subjects")}
+        parts = {name: [] for name in self.COLUMNS}
+        cur = conn.cursor()
+        cur.row_factory = None  # кортежи вместо sqlite3.Row — вдвое быстрее на миллионах строк
+        cur.execute(SQL_SNAPSHOT_GRADES)
+        while rows := cur.fetchmany(SNAPSHOT_FETCH_SIZE):
+            for (name, dtype), values in zip(self.COLUMNS.items(), zip(*rows)):
+                parts[name].append(np.array(values, dtype=dtype))
+
+        directory = self.directory()
+        os.makedirs(directory, exist_ok=True)
+        generation = f"{time.time_ns()}-{os.getpid()}"
+        for name, dtype in self.COLUMNS.items():
+            column = np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype)
+            np.save(os.path.join(directory, f"{name}.{generation}.npy"), column)
+        names = [subjects.get(code, "?") for code in range(max(subjects, default=0) + 1)]
+        meta = {"generation": generation, "version": version, "built_at": time.time(), "subjects": names}
+        tmp = os.path.join(directory, f"meta.{generation}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(directory, "meta.json"))
+        # старые поколения: на Windows занятые другим процессом файлы останутся до следующей сборки
+        for name in os.listdir(directory):
+            if name.endswith(".npy") and f".{generation}." not in name:
+                with suppress(OSError):
+                    os.remove(os.path.join(directory, name))
+
+        view = self._open(meta)
+        log.info("analytics snapshot: %s оценок за %.0f мс", len(view["grade"]), (time.perf_counter() - started) * 1000)
+        return view
+
+    def _open(self, meta: dict) -> dict:
+        import numpy as np
+
+        directory = self.directory()
+        view = {
+            name: np.load(os.path.join(directory, f"{name}.{meta['generation']}.npy"), mmap_mode="r")
+            for name in self.COLUMNS
+        }
+        # пользователь каждой оценки (0..U-1) и месяц его первой оценки (месяцы от 1970-01)
+        users, view["user"] = np.unique(view["tg_id"], return_inverse=True)
+        first_ts = np.full(len(users), np.iinfo(np.int64).max)
+        np.minimum.at(first_ts, view["user"], view["ts"])
+        view["user_cohort"] = first_ts.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+        view.update(
+            version=meta["version"],
+            built_at=meta["built_at"],
+            subjects=meta["subjects"],
+            users=len(users),
+        )
+        return view
+
+
+GRADES_SNAPSHOT = GradesSnapshot()
+
+ANALYTICS_GRADE_BINS = (2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0)
+ANALYTICS_WEEKS = 8
+ANALYTICS_COHORTS = 6
+ANALYTICS_SUBJECTS = 15  # больше — только самые частые (лимит длины сообщения)
+
+
+def _bar(share: float, width: int = 12) -> str:
+    return "▇" * max(1 if share > 0 else 0, round(share * width))
+
+
+def format_analytics(view: dict, now: float | None = None) -> str:
+    """Отчёт по снимку: всё — векторные операции над колонками, без запросов к базе."""
+    import numpy as np
+
+    started = time.perf_counter()
+    now = now or view["built_at"]
+    grade, subject, ts, user = view["grade"], view["subject"], view["ts"], view["user"]
+    total = len(grade)
+    stamp = datetime.fromtimestamp(view["built_at"]).strftime("%d.%m.%Y %H:%M")
+    n_subj = len(view["subjects"])
+    cnt = np.bincount(subject, minlength=n_subj)
+    text = f"📊 Аналитика\nСнимок на {stamp}: оценок {total}, учеников {view['users']}, предметов {np.count_nonzero(cnt)}\n"
+    if not total:
+        return text + "\nОценок пока нет."
+
+    g = grade.astype(np.float64)
+    text += f"Средняя по всем: {g.mean():.2f} ± {g.std():.2f}\n"
+
+    # по предметам: средняя, σ и число оценок через bincount по коду предмета
+    s1 = np.bincount(subject, weights=g, minlength=n_subj)
+    s2 = np.bincount(subject, weights=g * g, minlength=n_subj)
+    mean = s1 / np.maximum(cnt, 1)
+    std = np.sqrt(np.maximum(s2 / np.maximum(cnt, 1) - mean * mean, 0))
+    text += "\nПо предметам (средняя ± σ, оценок):\n"
+    top = np.argsort(-cnt, kind="stable")[:ANALYTICS_SUBJECTS]
+    for code in top[np.argsort(-mean[top], kind="stable")]:
+        if cnt[code]:
+            text += f"• {view['subjects'][code]}: {mean[code]:.2f} ± {std[code]:.2f} ({cnt[code]})\n"
+
+    hist, _ = np.histogram(g, bins=ANALYTICS_GRADE_BINS)
+    text += "\nРаспределение оценок:\n"
+    for lo, hi, n in zip(ANALYTICS_GRADE_BINS, ANALYTICS_GRADE_BINS[1:], hist):
+        text += f"{fmt_grade(lo)}–{fmt_grade(hi)}: {_bar(n / total)} {n / total:.0%}\n"
+
+    # активность: оценок за каждую из последних недель (0 — последние 7 дней)
+    age = (int(now) - ts) // (7 * 86400)
+    recent = age[(age >= 0) & (age < ANALYTICS_WEEKS)]
+    weeks = np.bincount(recent, minlength=ANALYTICS_WEEKS)
+    text += "\nАктивность по неделям (оценок):\n"
+    peak = max(int(weeks.max()), 1)
+    for k in range(ANALYTICS_WEEKS - 1, -1, -1):
+        end = datetime.fromtimestamp(now - k * 7 * 86400)
+        start = end - timedelta(days=6)
+        text += f"{start:%d.%m}–{end:%d.%m}: {_bar(weeks[k] / peak)} {weeks[k]}\n"
+
+    # когорты по месяцу первой оценки: ученики, средняя их оценок, оценок на ученика
+    user_cohort = view["user_cohort"]
+    row_cohort = user_cohort[user]
+    first = int(user_cohort.min())
+    users_in = np.bincount(user_cohort - first)
+    grades_in = np.bincount(row_cohort - first)
+    mean_in = np.bincount(row_cohort - first, weights=g) / np.maximum(grades_in, 1)
+    text += "\nКогорты по месяцу первой оценки (учеников, средняя, оценок на ученика):\n"
+    for idx in np.flatnonzero(users_in)[-ANALYTICS_COHORTS:]:
+        month = np.datetime64(first + int(idx), "M")
+        text += f"{month}: {users_in[idx]}, {mean_in[idx]:.2f}, {grades_in[idx] / users_in[idx]:.1f}\n"
+
+    text += f"\nПосчитано за {(time.perf_counter() - started) * 1000:.1f} мс"
+    return text
+
+
+@db_timed
+def analytics_report(force: bool = False) -> str:
+    # снимок неизменяем, поэтому и отчёт по нему считается один раз
+    view = GRADES_SNAPSHOT.current(force)
+    if "report" not in view:
+        view["report"] = format_analytics(view)
+    return view["report"]
+
+
+# ====== Планы запросов ======
+# Регрессионная проверка индексов: ни один запрос хелперов не должен
+# делать полный проход по grades.
+QUERY_PLAN_CHECKS = {
+    "get_cabinet_stats (итого)": (SQL_CABINET_TOTAL, (1,)),
+    "get_cabinet_stats (по предметам)": (SQL_CABINET_BY_SUBJECT, (1,)),
+    "Leaderboard.load": (Leaderboard.SQL, ()),
+    "Leaderboard.refresh_user": (Leaderboard.SQL + " WHERE s.tg_id=?", (1,)),
+    "get_history_version": (SQL_HISTORY_VERSION, (1, 1)),
+    "get_grade_daily": (SQL_GRADE_DAILY, (1,)),
+    "снимок аналитики (версия)": (SQL_SNAPSHOT_VERSION, ()),
+    "серия пятёрок (после удаления)": (SQL_STREAK5, (1, 1)),
+    "recompute_achievements": (SQL_GRADES_CHUNK, (1, 0, 20000)),
+    "list_last_grades": (SQL_LIST_LAST_GRADES, (1, 10)),
+    "list_users_page (первая)": (users_page_sql(), (USERS_PAGE_SIZE + 1,)),
+    "list_users_page (следующая)": (users_page_sql("next"), (1, USERS_PAGE_SIZE + 1)),
+    "list_users_page (предыдущая)": (users_page_sql("prev"), (1, USERS_PAGE_SIZE + 1)),
+    "list_users_page (поиск)": (users_page_sql("next", True), ('"иван"*', 1, USERS_PAGE_SIZE + 1)),
+    "delete_all_grades": (SQL_DELETE_ALL_GRADES, (1,)),
+    "get_period_top": (SQL_PERIOD_TOP, ("*", "m:2026-01", 10)),
+    "get_most_improved": (SQL_MOST_IMPROVED, ("m:2025-12", "*", "m:2026-01", 10)),
+}
 
-        admin_username = f"@{q.from_user.username}" if q.from_user.username else f"ID {q.from_user.id}"
 
-        if action == "accept":
-            set_user_verified(target_id, 1)
-            set_access_request_status(target_id, "approved", q.from_user.id)
+GRADES_ALIASES = {"grades", "g", "g2"}
 
-            try:
-                await q.bot.send_message(
-                    target_id,
-                    f"✅ Доступ одобрен администратором {admin_username}.\n"
-                    "Нажми /start, чтобы открыть меню."
-                )
-            except Exception:
-                pass
 
+def explain_queries() -> dict[str, tuple[list[str], bool]]:
+    """Возвращает {хелпер: (строки EXPLAIN QUERY PLAN, есть ли полный проход по grades)}."""
+    result = {}
+    with db_read() as conn:
+        for name, (sql, params) in QUERY_PLAN_CHECKS.items():
+            plan = [r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            full_scan = any(d.split()[:1] == ["SCAN"] and d.split()[1] in GRADES_ALIASES for d in plan)
+            result[name] = (plan, full_scan)
+    return result
+
+
+# ====== Group commit ======
+class GroupCommitQueue:
+    """
+    Write-behind очередь мелких записей. Вызывающий ставит мутацию
+    func(conn, *args) и получает Future; один поток-писатель забирает всё, что
+    накопилось (до max_batch, добирая не дольше max_delay), и выполняет пачку
+    одной транзакцией — один commit на пачку вместо одного на запись. Каждая
+    мутация идёт под SAVEPOINT: ошибка откатывает только её. Кэши, которые
+    откатившиеся мутации успели поменять, перечитываются из базы (CACHE_SYNC.restore).
+    Future завершается после commit; в future.cache_events — события CACHE_SYNC мутации.
+    """
+
+    def __init__(self, max_batch: int = GROUP_COMMIT_MAX, max_delay: float = GROUP_COMMIT_DELAY_MS / 1000):
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.batches = 0
+        self.items = 0
+        self.largest = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args) -> Future:
+        future = Future()
+        self._queue.put((func, args, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="db-group-commit", daemon=True)
+                    self._thread.start()
+        return future
+
+    def _take_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
             try:
-                await q.message.edit_text(
-                    (q.message.text or "") + f"\n\n✅ Принято админом {admin_username}",
-                    reply_markup=None
-                )
-            except Exception:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
                 pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._commit(self._take_batch())
+
+    def _commit(self, batch: list):
+        started = time.perf_counter()
+        outcomes = []
+        touched = []  # события всех мутаций пачки — что перечитать, если пачка откатится
+        rolled_back = []  # события мутаций, откатившихся по SAVEPOINT
+        try:
+            with db_write() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for func, args, future in batch:
+                    conn.execute("SAVEPOINT mutation")
+                    with CACHE_SYNC.capture() as events:
+                        try:
+                            result = func(conn, *args)
+                        except Exception as e:
+                            touched.extend(events)
+                            conn.execute("ROLLBACK TO mutation")
+                            rolled_back.extend(events)
+                            outcomes.append((future, None, e, []))
+                        else:
+                            touched.extend(events)
+                            outcomes.append((future, result, None, list(events)))
+                    conn.execute("RELEASE mutation")
+        except Exception as e:
+            CACHE_SYNC.restore(touched)
+            for _, _, future in batch:
+                future.cache_events = []
+                future.set_exception(e)
+            return
+        finally:
+            METRICS.observe("bot_db_seconds", time.perf_counter() - started, helper="group_commit")
+        # после commit база видит и успешные записи пачки, так что перечитанное совпадёт с ней
+        CACHE_SYNC.restore(rolled_back)
+        self.batches += 1
+        self.items += len(batch)
+        self.largest = max(self.largest, len(batch))
+        METRICS.inc("bot_group_commit_batches_total")
+        METRICS.inc("bot_group_commit_items_total", len(batch))
+        for future, result, error, events in outcomes:
+            future.cache_events = events
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 1) if self.batches else 0.0,
+            "largest": self.largest,
+            "queued": self._queue.qsize(),
+        }
+
+
+GROUP_COMMIT = GroupCommitQueue()
+METRICS.describe("bot_group_commit_batches_total", "counter", "Транзакции group commit")
+METRICS.describe("bot_group_commit_items_total", "counter", "Записи, прошедшие через group commit")
+
+
+# ========= ASYNC DB =========
+# Все обращения к SQLite из хендлеров идут через пул потоков: читатели
+# работают параллельно, запись сериализуется блокировкой пишущего соединения.
+# Медленный запрос или блокировка записи не останавливают event loop.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_READERS + 1, thread_name_prefix="db")
+# В процессе-воркере (--workers) — клиент пишущего процесса: write-хелперы уходят туда.
+DB_WRITER: "WriterClient | None" = None
+
+
+async def run_db(func, *args, **kwargs):
+    if DB_WRITER is not None and getattr(func, "db_write_op", False):
+        return await DB_WRITER.call(func, args, kwargs)
+    mutation = getattr(func, "mutation", None)
+    if mutation is not None:
+        return await asyncio.wrap_future(db_timed_future(func.__name__, GROUP_COMMIT.submit(mutation, *args), args))
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def call():
+        METRICS.observe("bot_db_queue_seconds", time.perf_counter() - submitted)
+        return func(*args, **kwargs)
+
+    return await loop.run_in_executor(DB_EXECUTOR, call)
+
+
+# ========= FSM =========
+class Reg(StatesGroup):
+    full_name = State()
+
+
+class AddGrade(StatesGroup):
+    subject_choice = State()
+    new_subject = State()
+    grade_pick = State()
+    grade_input = State()
+    after = State()
 
-            await q.answer("Принято.")
 
-        elif action == "deny":
-            set_access_request_status(target_id, "denied", q.from_user.id)
+class Admin(StatesGroup):
+    del_wait_id = State()
 
+    add_grade_wait_user_id = State()
+    add_grade_subject_choice = State()
+    add_grade_new_subject = State()
+    add_grade_pick = State()
+    add_grade_input = State()
+
+    del_grade_wait_user_id = State()
+    del_grade_wait_grade_id = State()
+
+    clear_grades_wait_user_id = State()
+    clear_grades_confirm = State()
+
+    broadcast_text = State()
+
+    import_wait_file = State()
+
+    export_filter = State()
+
+    users_search = State()
+
+
+class UserDelete(StatesGroup):
+    del_one_wait_id = State()
+    del_all_confirm = State()
+
+
+# ========= FSM STORAGE =========
+@db_timed
+def fsm_load(key: str, min_updated_at: float) -> tuple[str | None, dict, float] | None:
+    with db_read() as conn:
+        row = conn.execute(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ? AND updated_at >= ?",
+            (key, min_updated_at)
+        ).fetchone()
+    if row is None:
+        return None
+    return row["state"], json.loads(row["data"]), row["updated_at"]
+
+
+@db_write_op
+@db_timed
+def fsm_save_batch(items: list[tuple[str, str | None, dict, float]]):
+    """Записывает пачку состояний одной транзакцией; пустые состояния удаляются."""
+    upserts = [
+        (key, state, json.dumps(data, ensure_ascii=False), ts)
+        for key, state, data, ts in items
+        if state is not None or data
+    ]
+    deletes = [(key,) for key, state, data, _ in items if state is None and not data]
+    with db_write() as conn:
+        if upserts:
+            conn.executemany("""
+                INSERT INTO fsm_states(key, state, data, updated_at) VALUES(?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """, upserts)
+        if deletes:
+            conn.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+
+
+@db_write_op
+@db_timed
+def fsm_expire(min_updated_at: float) -> int:
+    with db_write() as conn:
+        return conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (min_updated_at,)).rowcount
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states той же базы.
+
+    Запись идёт сквозь ограниченный LRU-кэш: set_state/set_data сразу меняют
+    кэш и помечают ключ «грязным», а фоновая задача раз в flush_interval
+    сбрасывает накопленное одной транзакцией. Чтение горячих чатов базу не
+    трогает. Состояния, не менявшиеся дольше ttl, считаются пустыми и
+    периодически удаляются из таблицы. При аварийном падении теряется
+    не больше flush_interval последних переходов; close() дописывает всё.
+    """
+
+    def __init__(
+        self,
+        ttl: float = FSM_TTL,
+        cache_size: int = 5000,
+        flush_interval: float = 0.5,
+        expire_interval: float = 600.0,
+    ):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.expire_interval = expire_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> (state, data, updated_at)
+        self._cache: OrderedDict[str, tuple[str | None, dict, float]] = OrderedDict()
+        self._dirty: dict[str, tuple[str | None, dict, float]] = {}
+        self._flusher: asyncio.Task | None = None
+        self._last_expire = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    async def _load(self, key: StorageKey) -> tuple[str, str | None, dict]:
+        k = self.key_builder.build(key)
+        now = time.time()
+        entry = self._cache.get(k) or self._dirty.get(k)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            row = await run_db(fsm_load, k, now - self.ttl)
+            # время берём из базы: иначе почти истёкшее состояние получит полный ttl заново
+            entry = row if row else (None, {}, now)
+            # пока ходили в базу, ключ мог быть записан — свежая запись важнее
+            entry = self._cache.get(k) or self._dirty.get(k) or entry
+        state, data, updated_at = entry
+        if now - updated_at > self.ttl:
+            state, data = None, {}
+        self._remember(k, (state, data, updated_at))
+        return k, state, data
+
+    def _remember(self, k: str, entry: tuple[str | None, dict, float]):
+        self._cache[k] = entry
+        self._cache.move_to_end(k)
+        # вытесняем только из кэша: несброшенные записи лежат ещё и в _dirty
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _store(self, k: str, state: str | None, data: dict):
+        entry = (state, data, time.time())
+        self._remember(k, entry)
+        self._dirty[k] = entry
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._dirty:
+                return
+
+    async def flush(self):
+        if self._dirty:
+            batch, self._dirty = self._dirty, {}
             try:
-                await q.bot.send_message(
-                    target_id,
-                    f"❌ Доступ отклонён администратором {admin_username}.\n"
-                    f"По вопросам напиши: {admin_username}"
-                )
+                await run_db(fsm_save_batch, [(k, st, d, ts) for k, (st, d, ts) in batch.items()])
+                self.flushes += 1
             except Exception:
+                log.exception("FSM: не удалось сохранить %s состояний", len(batch))
+                # вернём то, что не успели перезаписать заново
+                for k, entry in batch.items():
+                    self._dirty.setdefault(k, entry)
+        now = time.time()
+        if now - self._last_expire >= self.expire_interval:
+            self._last_expire = now
+            removed = await run_db(fsm_expire, now - self.ttl)
+            if removed:
+                log.info("FSM: удалено устаревших состояний: %s", removed)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        k, _, data = await self._load(key)
+        self._store(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        _, state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        if not isinstance(data, dict):
+            raise ValueError(f"Data must be a dict, got {type(data).__name__}")
+        k, state, _ = await self._load(key)
+        self._store(k, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, _, data = await self._load(key)
+        return data.copy()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+        }
+
+    async def close(self) -> None:
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
                 pass
+        self._flusher = None
+        await self.flush()
+
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        from aiogram.fsm.storage.memory import MemoryStorage
 
+        return MemoryStorage()
+    return SQLiteStorage()
+
+
+# ========= OUTBOX =========
+@db_write_op
+@db_timed
+def save_dead_letter(chat_id: int, text: str, error: str, attempts: int):
+    with db_write() as conn:
+        conn.execute(
+            "INSERT INTO outbox_dead(chat_id, text, error, attempts) VALUES(?, ?, ?, ?)",
+            (chat_id, text, error, attempts)
+        )
+
+
+@db_timed
+def count_dead_letters() -> int:
+    with db_read() as conn:
+        return conn.execute("SELECT COUNT(*) AS n FROM outbox_dead").fetchone()["n"]
+
+
+class TokenBucket:
+    """
+    Ведро токенов с резервированием: reserve() сразу списывает токен и
+    возвращает, сколько секунд подождать, пока он станет «настоящим».
+    Баланс может уходить в минус — так очередь ждущих выстраивается сама.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Ни одного токена ближайшие seconds секунд (после RetryAfter)."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutgoingMessage:
+    __slots__ = ("bot", "chat_id", "text", "kwargs", "attempts", "future")
+
+    def __init__(self, bot: Bot, chat_id: int, text: str, kwargs: dict, future: asyncio.Future):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.future = future
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений: пул воркеров, общий лимит на бота и лимит
+    на каждый чат (TokenBucket). RetryAfter приостанавливает всю отправку на
+    указанное Telegram время, сетевые ошибки и 5xx повторяются с
+    экспоненциальной задержкой. Что не доставилось за max_attempts (или
+    не может быть доставлено вовсе: бот заблокирован, чат не найден),
+    пишется в outbox_dead. Воркеры стартуют при первой отправке.
+    """
+
+    def __init__(
+        self,
+        workers: int = OUTBOX_WORKERS,
+        rate: float = OUTBOX_RATE,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        max_chats: int = 10000,
+    ):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        self.max_chats = max_chats
+        self._global = TokenBucket(rate, max(1.0, rate / 5))
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._idle: asyncio.Event | None = None
+        self._pending = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._workers:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._pending = 0
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def send(self, bot: Bot, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """
+        Ставит сообщение в очередь и сразу возвращает future: результат —
+        отправленный Message или None, если доставить не удалось.
+        Ждать его не обязательно.
+        """
+        self._ensure_started()
+        future = self._loop.create_future()
+        self._pending += 1
+        self._idle.clear()
+        self._queue.put_nowait(OutgoingMessage(bot, chat_id, text, kwargs, future))
+        return future
+
+    async def broadcast(self, bot: Bot, chat_ids: list[int], text: str) -> tuple[int, int]:
+        """Отправляет text всем chat_ids; возвращает (доставлено, не доставлено)."""
+        results = await asyncio.gather(*(self.send(bot, chat_id, text) for chat_id in chat_ids))
+        ok = sum(r is not None for r in results)
+        return ok, len(results) - ok
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, 1.0)
+            if len(self._chats) > self.max_chats:
+                # выбрасываем самое старое ведро, если оно уже восстановилось
+                old_id, old = next(iter(self._chats.items()))
+                if old.full():
+                    del self._chats[old_id]
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
             try:
-                await q.message.edit_text(
-                    (q.message.text or "") + f"\n\n❌ Отклонено админом {admin_username}",
-                    reply_markup=None
-                )
+                await self._deliver(item)
             except Exception:
-                pass
-
-            await q.answer("Отклонено.")
+                log.exception("outbox: ошибка воркера")
+                self._finish(item, None)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, item: OutgoingMessage):
+        delay = self._chat_bucket(item.chat_id).reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        delay = self._global.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+        item.attempts += 1
+        try:
+            result = await item.bot.send_message(item.chat_id, item.text, **item.kwargs)
+        except TelegramRetryAfter as e:
+            # flood control: притормаживаем всю отправку, а не только этот чат
+            self._global.pause(e.retry_after)
+            await self._retry(item, e.retry_after, e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            await self._retry(item, min(30.0, 0.5 * 2 ** item.attempts), e)
+        except Exception as e:
+            # бот заблокирован, чат не найден, неверный запрос — повтор не поможет
+            await self._dead(item, e)
         else:
-            await q.answer("Неизвестное действие.", show_alert=True)
+            self.sent += 1
+            self._finish(item, result)
 
-    @dp.message(F.text == BTN_CAB)
-    async def cabinet(m: Message):
-        user = get_user(m.from_user.id)
-        if not user:
-            await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+    async def _retry(self, item: OutgoingMessage, delay: float, error: Exception):
+        if item.attempts >= self.max_attempts:
+            await self._dead(item, error)
             return
-        if not is_user_verified(m.from_user.id):
-            await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        self.retried += 1
+        self._loop.call_later(delay, self._queue.put_nowait, item)
+
+    async def _dead(self, item: OutgoingMessage, error: Exception):
+        self.failed += 1
+        log.warning("outbox: не доставлено chat=%s attempts=%s: %s", item.chat_id, item.attempts, error)
+        try:
+            await run_db(save_dead_letter, item.chat_id, item.text, f"{type(error).__name__}: {error}", item.attempts)
+        except Exception:
+            log.exception("outbox: не удалось записать в outbox_dead")
+        self._finish(item, None)
+
+    def _finish(self, item: OutgoingMessage, result):
+        if not item.future.done():
+            item.future.set_result(result)
+        self._pending -= 1
+        if self._pending <= 0:
+            self._idle.set()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "pending": self._pending,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    async def close(self, timeout: float = 10.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеров."""
+        if not self._workers or self._loop is not asyncio.get_running_loop():
             return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("outbox: при остановке не отправлено %s сообщений", self._pending)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
 
-        total, by_subject = get_cabinet_stats(m.from_user.id)
-        avg_total = total["avg_total"]
-        cnt_total = total["cnt_total"]
 
-        text = f"📊 Личный кабинет\n👤 {user['full_name']}\n\n"
-        text += f"Общая средняя: {fmt_grade(avg_total)}\n"
-        text += f"Оценок всего: {cnt_total}\n\n"
+OUTBOX = Outbox()
 
-        if by_subject:
-            text += "По предметам:\n"
-            for r in by_subject:
-                text += f"• {r['subject']}: средн. {fmt_grade(r['avg_subj'])} (оценок {r['cnt']})\n"
-        else:
-            text += "Пока нет оценок. Добавь через «Добавить оценку»."
+# фоновые задачи хендлеров (например, ожидание итогов рассылки)
+_background_tasks: set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# ========= MIDDLEWARE =========
+class UserMiddleware(BaseMiddleware):
+    """
+    Загружает строку пользователя один раз на апдейт (через USER_CACHE)
+    и передаёт её хендлерам аргументом `user`.
+    """
+
+    async def __call__(self, handler, event, data):
+        from_user = data.get("event_from_user")
+        user = None
+        if from_user is not None:
+            user = USER_CACHE.get(from_user.id)
+            if user is _MISSING:
+                user = await run_db(load_user, from_user.id)
+        data["user"] = user
+        return await handler(event, data)
 
-        await m.answer(text, reply_markup=main_kb(m.from_user.id))
 
-    # --- Лидерборд
-    @dp.message(F.text == BTN_TOP)
-    async def top(m: Message):
-        user = get_user(m.from_user.id)
-        if not user:
-            await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Inner-middleware (срабатывает, когда хендлер уже выбран): время хендлера
+    с метками handler и state, счётчик по результату, in-flight и slow-лог.
+    """
+
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        state = data.get("raw_state") or "-"
+        METRICS.inc("bot_handler_in_flight", handler=name)
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            METRICS.inc("bot_handler_in_flight", -1, handler=name)
+            METRICS.observe("bot_handler_seconds", elapsed, handler=name, state=state)
+            METRICS.inc("bot_handler_total", handler=name, state=state, status=status)
+            if elapsed * 1000 >= SLOW_HANDLER_MS:
+                METRICS.inc("bot_slow_total", kind="handler")
+                log.warning("slow handler %s state=%s: %.1f ms", name, state, elapsed * 1000)
+
+
+# ========= ROUTERS =========
+# Хендлеры объявлены на уровне модуля: их можно импортировать и гонять через
+# Dispatcher без запуска бота (bench.py, воркеры). Порядок роутеров важен:
+# отмена и пользовательские сценарии, затем админка, затем fallback.
+user_router = Router(name="user")
+admin_router = Router(name="admin")
+fallback_router = Router(name="fallback")
+ROUTERS = (user_router, admin_router, fallback_router)
+
+
+# --- Отмена в любом месте
+@user_router.message(F.text == BTN_CANCEL)
+async def cancel(m: Message, state: FSMContext):
+    await state.clear()
+    await m.answer("Ок, отменил. Выбирай действие 👇", reply_markup=main_kb(m.from_user.id))
+
+
+# --- HELP
+@user_router.message(Command("help"))
+@user_router.message(F.text == BTN_HELP)
+async def help_cmd(m: Message):
+    txt = (
+        "Доступно:\n"
+        f"• {BTN_ADD} — добавить оценку\n"
+        f"• {BTN_CAB} — личный кабинет (средняя + по предметам)\n"
+        f"• {BTN_TOP} — лидерборд (общая средняя)\n"
+        f"• {BTN_DYNAMICS} — график средней по предметам за последние недели\n"
+        f"• {BTN_DEL_ONE} — удалить одну свою оценку\n"
+        f"• {BTN_DEL_ALL} — удалить все свои оценки\n\n"
+        "Если не зарегистрирован — /start\n"
+    )
+    if is_admin(m.from_user.id):
+        txt += "\nАдмин:\n• 🛠 Админка — управление пользователями/демо/оценки"
+    await m.answer(txt, reply_markup=main_kb(m.from_user.id))
+
+
+# --- START / регистрация
+@user_router.message(Command("start"))
+async def start(m: Message, state: FSMContext, user):
+    await state.clear()
+
+    # Уже авторизован
+    if user and user_verified(user):
+        log.info("start: verified user tg_id=%s name=%s", m.from_user.id, user["full_name"])
+        await m.answer(
+            f"Привет, {user['full_name']}! 👇",
+            reply_markup=main_kb(m.from_user.id)
+        )
+        return
+
+    # Есть в базе, но не авторизован -> только заявка
+    if user and not user_verified(user):
+        log.info("start: not verified tg_id=%s name=%s", m.from_user.id, user["full_name"])
+        await m.answer(
+            "🔒 Доступ к функциям бота пока не выдан.\n"
+            "Нажми «📩 Запросить доступ», чтобы отправить заявку админу.",
+            reply_markup=unauth_kb()
+        )
+        return
+
+    # Новый пользователь -> регистрация (Имя Фамилия)
+    log.info("start: new user tg_id=%s username=@%s", m.from_user.id, m.from_user.username)
+    await m.answer(
+        "Привет! Зарегистрируйся.\n"
+        "Напиши *Имя Фамилия* (пример: Иван Иванов):",
+        parse_mode="Markdown",
+        reply_markup=cancel_kb()
+    )
+    await state.set_state(Reg.full_name)
+
+
+@user_router.message(Reg.full_name)
+async def reg_full_name(m: Message, state: FSMContext):
+    full_name = (m.text or "").strip()
+    parts = [p for p in full_name.split() if p]
+    if len(parts) < 2:
+        await m.answer("Нужно *Имя Фамилия* (2 слова). Пример: Иван Иванов", parse_mode="Markdown")
+        return
+
+    await run_db(upsert_user, m.from_user.id, full_name)
+    log.info("registered tg_id=%s name=%s", m.from_user.id, full_name)
+
+    await state.clear()
+    await m.answer(
+        f"✅ Регистрация сохранена: *{full_name}*.\n"
+        "Теперь запроси доступ у администратора кнопкой ниже.",
+        parse_mode="Markdown",
+        reply_markup=unauth_kb()
+    )
+
+
+@user_router.message(F.text == BTN_GET_CODE)
+async def request_access(m: Message, user):
+    """
+    Авторизация по заявкам (без кода).
+    Пользователь нажимает "Запросить доступ" -> бот отправляет заявку админу.
+    Защита от спама: повторная заявка запрещена, если уже pending; после отказа действует кулдаун.
+    """
+    if not user:
+        await m.answer("Сначала зарегистрируйся через /start (Имя Фамилия).", reply_markup=cancel_kb())
+        return
+
+    # если уже верифицирован — просто показать меню
+    if user_verified(user):
+        await m.answer("✅ Ты уже авторизован.", reply_markup=main_kb(m.from_user.id))
+        return
+
+    # анти-спам и кулдаун
+    req = await run_db(get_access_request, m.from_user.id)
+    now = datetime.utcnow()
+
+    if req and req["status"] == "pending":
+        await m.answer("⏳ Твоя заявка уже отправлена и ожидает решения администратора.", reply_markup=unauth_kb())
+        return
+
+    if req and req["status"] == "denied":
+        last = req["last_request_at"] or req["handled_at"] or req["requested_at"]
+        last_dt = parse_sqlite_ts(last)
+        if last_dt:
+            seconds = int((now - last_dt).total_seconds())
+            if seconds < REQUEST_COOLDOWN_SEC:
+                wait = REQUEST_COOLDOWN_SEC - seconds
+                mins = (wait + 59) // 60
+                await m.answer(f"⛔ Заявка недавно отклонена. Попробуй снова через ~{mins} мин.", reply_markup=unauth_kb())
+                return
+
+    full_name = user["full_name"]
+    username = f"@{m.from_user.username}" if m.from_user.username else None
+
+    await run_db(upsert_access_request_pending, m.from_user.id, full_name, username)
+
+    # сообщение админу с кнопками
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Принять", callback_data=f"auth:accept:{m.from_user.id}"),
+        InlineKeyboardButton(text="❌ Отклонить", callback_data=f"auth:deny:{m.from_user.id}")
+    ]])
+
+    admin_text = (
+        "📩 Заявка на доступ\n"
+        f"ID: {m.from_user.id}\n"
+        f"Имя (в боте): {full_name}\n"
+        f"Username: {username or '(нет username)'}"
+    )
+
+    if not ADMIN_IDS:
+        await run_db(drop_pending_access_request, m.from_user.id)
+        await m.answer(ACCESS_REQUEST_FAILED, reply_markup=unauth_kb())
+        return
+
+    # не ждём доставку: с лимитами и ретраями очереди это могут быть десятки секунд
+    deliveries = [OUTBOX.send(m.bot, admin_id, admin_text, reply_markup=kb) for admin_id in ADMIN_IDS]
+    spawn(_watch_access_request(m.bot, m.from_user.id, deliveries))
+    await m.answer("✅ Заявка отправлена администратору. Ожидай решения.", reply_markup=unauth_kb())
+
+
+ACCESS_REQUEST_FAILED = "⚠️ Не удалось отправить заявку админу. Попробуй позже."
+
+
+async def _watch_access_request(bot: Bot, tg_id: int, deliveries: list[asyncio.Future]):
+    """Если заявка не дошла ни до одного админа — снимает её и сообщает пользователю."""
+    results = await asyncio.gather(*deliveries)
+    if any(r is not None for r in results):
+        return
+    log.warning("access request tg_id=%s not delivered to any admin", tg_id)
+    await run_db(drop_pending_access_request, tg_id)
+    OUTBOX.send(bot, tg_id, ACCESS_REQUEST_FAILED, reply_markup=unauth_kb())
+
+
+@user_router.callback_query(F.data.startswith("auth:"))
+async def auth_decision(q: CallbackQuery):
+    # доступ только админу
+    if not is_admin(q.from_user.id):
+        await q.answer("Нет доступа.", show_alert=True)
+        return
+
+    try:
+        _, action, tg_id_str = (q.data or "").split(":")
+        target_id = int(tg_id_str)
+    except Exception:
+        await q.answer("Неверные данные.", show_alert=True)
+        return
+
+    target_user = await run_db(get_user, target_id)
+    target_name = target_user["full_name"] if target_user else f"tg_id={target_id}"
+
+    admin_username = f"@{q.from_user.username}" if q.from_user.username else f"ID {q.from_user.id}"
+
+    if action == "accept":
+        await run_db(set_user_verified, target_id, 1)
+        await run_db(set_access_request_status, target_id, "approved", q.from_user.id)
+
+        OUTBOX.send(
+            q.bot,
+            target_id,
+            f"✅ Доступ одобрен администратором {admin_username}.\n"
+            "Нажми /start, чтобы открыть меню."
+        )
+
+        try:
+            await q.message.edit_text(
+                (q.message.text or "") + f"\n\n✅ Принято админом {admin_username}",
+                reply_markup=None
+            )
+        except Exception:
+            pass
+
+        await q.answer("Принято.")
+
+    elif action == "deny":
+        await run_db(set_access_request_status, target_id, "denied", q.from_user.id)
+
+        OUTBOX.send(
+            q.bot,
+            target_id,
+            f"❌ Доступ отклонён администратором {admin_username}.\n"
+            f"По вопросам напиши: {admin_username}"
+        )
+
+        try:
+            await q.message.edit_text(
+                (q.message.text or "") + f"\n\n❌ Отклонено админом {admin_username}",
+                reply_markup=None
+            )
+        except Exception:
+            pass
+
+        await q.answer("Отклонено.")
+    else:
+        await q.answer("Неизвестное действие.", show_alert=True)
+
+
+@user_router.message(F.text == BTN_CAB)
+async def cabinet(m: Message, user):
+    if not user:
+        await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+        return
+    if not user_verified(user):
+        await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        return
+
+    total, by_subject = await run_db(get_cabinet_stats, m.from_user.id)
+    avg_total = total["avg_total"]
+    cnt_total = total["cnt_total"]
+
+    text = f"📊 Личный кабинет\n👤 {user['full_name']}\n\n"
+    text += f"Общая средняя: {fmt_grade(avg_total)}\n"
+    text += f"Оценок всего: {cnt_total}\n"
+    place = PERCENTILES.top_percent(m.from_user.id)
+    if place and place[1] >= PERCENTILE_MIN_USERS:
+        text += f"Ты в топ-{place[0]}% (из {place[1]}), медиана {fmt_grade(PERCENTILES.median())}\n"
+    text += "\n"
+
+    if by_subject:
+        text += "По предметам:\n"
+        for r in by_subject:
+            text += f"• {r['subject']}: средн. {fmt_grade(r['avg_subj'])} (оценок {r['cnt']})"
+            place = PERCENTILES.top_percent(m.from_user.id, r["subject"])
+            if place and place[1] >= PERCENTILE_MIN_USERS:
+                text += f", топ-{place[0]}%, медиана {fmt_grade(PERCENTILES.median(r['subject']))}"
+            text += "\n"
+    else:
+        text += "Пока нет оценок. Добавь через «Добавить оценку»."
+
+    unlocked = ACHIEVEMENT_ENGINE.unlocked(m.from_user.id)
+    if unlocked:
+        text = text.rstrip("\n") + "\n\nДостижения: " + ", ".join(ACHIEVEMENTS[c][0] for c in unlocked)
+
+    await m.answer(text, reply_markup=export_kb() if cnt_total else main_kb(m.from_user.id))
+
+
+@user_router.message(F.text == BTN_DYNAMICS)
+async def dynamics(m: Message, user):
+    if not user:
+        await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+        return
+    if not user_verified(user):
+        await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        return
+
+    tg_id = m.from_user.id
+    version = await run_db(get_history_version, tg_id)
+    if version is None:
+        await m.answer("Пока нет оценок. Добавь через «Добавить оценку».", reply_markup=main_kb(tg_id))
+        return
+
+    chart = CHARTS.get(tg_id, version)
+    if chart is None:
+        rows = await run_db(get_grade_daily, tg_id)
+        started = time.perf_counter()
+        try:
+            chart = await asyncio.get_running_loop().run_in_executor(
+                chart_pool(), render_dynamics_png, rows,
+                f"Динамика: {user['full_name']}", CHART_WINDOW_DAYS, CHART_MAX_POINTS
+            )
+        except ImportError:
+            log.error("charts: matplotlib не установлен (pip install -r requirements.txt)")
+            await m.answer("Графики сейчас недоступны.", reply_markup=main_kb(tg_id))
             return
-        if not is_user_verified(m.from_user.id):
-            await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        METRICS.observe("bot_chart_render_seconds", time.perf_counter() - started)
+        CHARTS.put(tg_id, version, chart)
+
+    photo = chart if isinstance(chart, str) else BufferedInputFile(chart, "dynamics.png")
+    sent = await m.answer_photo(
+        photo,
+        caption=f"Скользящая средняя по предметам за {CHART_WINDOW_DAYS} дн.",
+        reply_markup=main_kb(tg_id),
+    )
+    # дальше до новой оценки отправляем по file_id, без повторной загрузки
+    if isinstance(sent, Message) and sent.photo:
+        CHARTS.put(tg_id, version, sent.photo[-1].file_id)
+
+
+@user_router.callback_query(F.data.startswith("export:"))
+async def export_my_grades(q: CallbackQuery, user):
+    if not user_verified(user):
+        await q.answer("Нет доступа.", show_alert=True)
+        return
+    fmt = (q.data or "").split(":", 1)[1]
+    if fmt not in ("csv", "json"):
+        await q.answer("Неверные данные.", show_alert=True)
+        return
+    await q.answer("Готовлю файл…")
+    file, count = await run_db(export_grades, fmt, tg_id=q.from_user.id)
+    with file:
+        if not count:
+            await q.message.answer("Пока нет оценок.")
             return
+        stamp = datetime.now().strftime("%Y%m%d")
+        await q.message.answer_document(
+            SpooledInputFile(file, f"grades_{q.from_user.id}_{stamp}.{fmt}"),
+            caption=f"📥 Твои оценки: {count}"
+        )
 
-        rows = get_top(limit=10)
-        if not rows:
-            await m.answer("Пока нет оценок ни у кого. Добавь первую 🙂", reply_markup=main_kb(m.from_user.id))
-            return
 
-        text = "🏆 Лидерборд (общая средняя):\n\n"
-        for i, r in enumerate(rows, start=1):
+# --- Лидерборд
+@user_router.message(F.text == BTN_TOP)
+async def top(m: Message, user):
+    if not user:
+        await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+        return
+    if not user_verified(user):
+        await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        return
+
+    rows = LEADERBOARD.top(10)
+    if not rows:
+        await m.answer("Пока нет оценок ни у кого. Добавь первую 🙂", reply_markup=main_kb(m.from_user.id))
+        return
+
+    text = "🏆 Лидерборд (общая средняя):\n\n"
+    for r in rows:
+        text += f"{r['rank']}) {r['full_name']} — {fmt_grade(r['avg'])} (оценок {r['cnt']})\n"
+
+    # место пользователя и соседи, если он не попал в топ
+    near = LEADERBOARD.around(m.from_user.id, radius=1)
+    if near and near[-1]["rank"] > len(rows):
+        text += "…\n"
+        for r in near:
+            if r["rank"] > len(rows):
+                mark = "👉 " if r["tg_id"] == m.from_user.id else ""
+                text += f"{mark}{r['rank']}) {r['full_name']} — {fmt_grade(r['avg'])} (оценок {r['cnt']})\n"
+    rank = LEADERBOARD.rank(m.from_user.id)
+    if rank:
+        text += f"\n📍 Твоё место: {rank} из {len(LEADERBOARD)}"
+    await m.answer(text, reply_markup=top_periods_kb())
+
+
+@user_router.callback_query(F.data.startswith("top:"))
+async def top_period(q: CallbackQuery, user):
+    if not user_verified(user):
+        await q.answer("Нет доступа.", show_alert=True)
+        return
+
+    _, period, subject = (q.data or "").split(":", 2)
+    if period == "subj":
+        try:
+            await q.message.edit_text("📚 Выбери предмет:", reply_markup=top_subjects_kb(SUBJECTS.names()))
+        except Exception:
+            pass
+        await q.answer()
+        return
+    if period not in TOP_PERIODS:
+        await q.answer("Неверные данные.", show_alert=True)
+        return
+
+    if period == "imp":
+        rows = await run_db(get_most_improved, subject)
+    elif period == "all" and subject == "*":
+        rows = LEADERBOARD.top(10)
+    else:
+        rows = await run_db(get_period_top, subject, period)
+
+    title = "все предметы" if subject == "*" else subject
+    text = f"🏆 Лидерборд: {title}, {TOP_PERIODS[period]}\n\n"
+    if not rows:
+        text += "Пока нет оценок за этот период."
+    for i, r in enumerate(rows, start=1):
+        if period == "imp":
+            text += f"{i}) {r['full_name']} — {r['delta']:+.2f} (средн. {fmt_grade(r['avg'])})\n"
+        else:
             text += f"{i}) {r['full_name']} — {fmt_grade(r['avg'])} (оценок {r['cnt']})\n"
-        await m.answer(text, reply_markup=main_kb(m.from_user.id))
-
-    # --- Добавить оценку (пользователь)
-    @dp.message(Command("add"))
-    @dp.message(F.text == BTN_ADD)
-    async def add(m: Message, state: FSMContext):
-        user = get_user(m.from_user.id)
-        if not user:
-            await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
-            return
-        if not is_user_verified(m.from_user.id):
-            await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
-            return
 
-        await state.clear()
-        subjects = get_subjects()
-        await m.answer("Выбери предмет:", reply_markup=subject_kb(subjects))
-        await state.set_state(AddGrade.subject_choice)
+    try:
+        await q.message.edit_text(text, reply_markup=top_periods_kb(subject))
+    except Exception:
+        pass
+    await q.answer()
 
-    @dp.message(AddGrade.subject_choice)
-    async def choose_subject(m: Message, state: FSMContext):
-        txt = (m.text or "").strip()
 
-        if txt == BTN_NEW_SUBJ:
-            await m.answer("Напиши название нового предмета:", reply_markup=cancel_kb())
-            await state.set_state(AddGrade.new_subject)
-            return
+# --- Добавить оценку (пользователь)
+@user_router.message(Command("add"))
+@user_router.message(F.text == BTN_ADD)
+async def add(m: Message, state: FSMContext, user):
+    if not user:
+        await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+        return
+    if not user_verified(user):
+        await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        return
 
-        subjects = set(get_subjects())
-        if txt not in subjects:
-            await m.answer("Выбери предмет кнопкой или нажми «➕ Новый предмет».")
-            return
+    await state.clear()
+    await m.answer("Выбери предмет:", reply_markup=SUBJECTS.keyboard())
+    await state.set_state(AddGrade.subject_choice)
 
-        await state.update_data(subject=txt)
-        await m.answer(f"Предмет: {txt}\nВыбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
-        await state.set_state(AddGrade.grade_pick)
 
-    @dp.message(AddGrade.new_subject)
-    async def new_subject(m: Message, state: FSMContext):
-        name = (m.text or "").strip()
-        if len(name) < 2:
-            await m.answer("Слишком коротко. Напиши название предмета нормально:")
-            return
+@user_router.message(AddGrade.subject_choice)
+async def choose_subject(m: Message, state: FSMContext):
+    txt = (m.text or "").strip()
+
+    if txt == BTN_NEW_SUBJ:
+        await m.answer("Напиши название нового предмета:", reply_markup=cancel_kb())
+        await state.set_state(AddGrade.new_subject)
+        return
+
+    if txt not in SUBJECTS:
+        await m.answer("Выбери предмет кнопкой или нажми «➕ Новый предмет».")
+        return
+
+    await state.update_data(subject=txt)
+    await m.answer(f"Предмет: {txt}\nВыбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
+    await state.set_state(AddGrade.grade_pick)
+
+
+@user_router.message(AddGrade.new_subject)
+async def new_subject(m: Message, state: FSMContext):
+    name = (m.text or "").strip()
+    if len(name) < 2:
+        await m.answer("Слишком коротко. Напиши название предмета нормально:")
+        return
+
+    await run_db(add_subject, name)
+    await state.update_data(subject=name)
+    await m.answer(f"✅ Добавил предмет: {name}\nВыбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
+    await state.set_state(AddGrade.grade_pick)
+
+
+@user_router.message(AddGrade.grade_pick)
+async def grade_pick(m: Message, state: FSMContext):
+    txt = (m.text or "").strip()
+    if txt == BTN_GOTHER:
+        await m.answer("Введи оценку (пример: 4,35 или 3.2). Диапазон 2–5:", reply_markup=cancel_kb())
+        await state.set_state(AddGrade.grade_input)
+        return
+
+    g = parse_grade(txt)
+    if g is None:
+        await m.answer("Нажми 2/3/4/5 или «Другая».", reply_markup=grade_pick_kb())
+        return
+
+    data = await state.get_data()
+    subject = data["subject"]
+    newly = await run_db(add_grade_db, m.from_user.id, subject, g)
+    log.info("grade added user=%s subject=%s grade=%s", m.from_user.id, subject, g)
+
+    await state.update_data(last_subject=subject)
+    await m.answer(
+        f"✅ Добавлено: {subject} — {fmt_grade(g)}{achievements_text(newly)}\nЧто дальше?",
+        reply_markup=after_add_kb()
+    )
+    await state.set_state(AddGrade.after)
+
+
+@user_router.message(AddGrade.grade_input)
+async def grade_input(m: Message, state: FSMContext):
+    g = parse_grade((m.text or "").strip())
+    if g is None:
+        await m.answer("Не понял. Введи число 2–5, можно с дробью (4,35).")
+        return
+
+    data = await state.get_data()
+    subject = data["subject"]
+    newly = await run_db(add_grade_db, m.from_user.id, subject, g)
+    log.info("grade added user=%s subject=%s grade=%s", m.from_user.id, subject, g)
+
+    await state.update_data(last_subject=subject)
+    await m.answer(
+        f"✅ Добавлено: {subject} — {fmt_grade(g)}{achievements_text(newly)}\nЧто дальше?",
+        reply_markup=after_add_kb()
+    )
+    await state.set_state(AddGrade.after)
+
 
-        add_subject(name)
-        await state.update_data(subject=name)
-        await m.answer(f"✅ Добавил предмет: {name}\nВыбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
+@user_router.message(AddGrade.after)
+async def after_add(m: Message, state: FSMContext):
+    txt = (m.text or "").strip()
+    data = await state.get_data()
+    last_subject = data.get("last_subject")
+
+    if txt == BTN_ADD_SAME and last_subject:
+        await state.update_data(subject=last_subject)
+        await m.answer(f"Ок, снова {last_subject}. Выбери оценку:", reply_markup=grade_pick_kb())
         await state.set_state(AddGrade.grade_pick)
+        return
 
-    @dp.message(AddGrade.grade_pick)
-    async def grade_pick(m: Message, state: FSMContext):
-        txt = (m.text or "").strip()
-        if txt == BTN_GOTHER:
-            await m.answer("Введи оценку (пример: 4,35 или 3.2). Диапазон 2–5:", reply_markup=cancel_kb())
-            await state.set_state(AddGrade.grade_input)
-            return
+    if txt == BTN_OTHER_SUBJ:
+        await m.answer("Выбери другой предмет:", reply_markup=SUBJECTS.keyboard())
+        await state.set_state(AddGrade.subject_choice)
+        return
 
-        g = parse_grade(txt)
-        if g is None:
-            await m.answer("Нажми 2/3/4/5 или «Другая».", reply_markup=grade_pick_kb())
+    if txt == BTN_TO_MENU:
+        await state.clear()
+        await m.answer("Меню 👇", reply_markup=main_kb(m.from_user.id))
+        return
+
+    await m.answer("Выбери действие кнопками ниже 👇", reply_markup=after_add_kb())
+
+
+# --- Удалить одну оценку (пользователь)
+@user_router.message(F.text == BTN_DEL_ONE)
+async def user_del_one_start(m: Message, state: FSMContext, user):
+    if not user:
+        await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+        return
+    if not user_verified(user):
+        await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        return
+
+    rows = await run_db(list_last_grades, m.from_user.id, limit=10)
+    if not rows:
+        await m.answer("У тебя пока нет оценок.", reply_markup=main_kb(m.from_user.id))
+        return
+
+    text = "🗑 Удаление одной оценки\n\nПоследние оценки (ID):\n"
+    for r in rows:
+        text += f"ID {r['id']} — {r['subject']}: {fmt_grade(r['grade'])}\n"
+    text += "\nНапиши ID оценки, которую удалить:"
+    await state.clear()
+    await m.answer(text, reply_markup=cancel_kb())
+    await state.set_state(UserDelete.del_one_wait_id)
+
+
+@user_router.message(UserDelete.del_one_wait_id)
+async def user_del_one_do(m: Message, state: FSMContext):
+    txt = (m.text or "").strip()
+    try:
+        grade_id = int(txt)
+    except ValueError:
+        await m.answer("Нужно число (ID). Попробуй ещё раз:")
+        return
+
+    ok = await run_db(delete_grade_by_id, m.from_user.id, grade_id)
+    log.info("user delete one tg_id=%s grade_id=%s ok=%s", m.from_user.id, grade_id, ok)
+    await state.clear()
+    if ok:
+        await m.answer(f"✅ Оценка ID {grade_id} удалена.", reply_markup=main_kb(m.from_user.id))
+    else:
+        await m.answer("❌ Не нашёл такую оценку (или она не твоя).", reply_markup=main_kb(m.from_user.id))
+
+
+# --- Удалить все оценки (пользователь)
+@user_router.message(F.text == BTN_DEL_ALL)
+async def user_del_all_start(m: Message, state: FSMContext, user):
+    if not user:
+        await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
+        return
+    if not user_verified(user):
+        await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
+        return
+    await state.clear()
+    await m.answer("⚠️ Удалить ВСЕ твои оценки?\nНапиши: ДА (или нажми Отмена)", reply_markup=cancel_kb())
+    await state.set_state(UserDelete.del_all_confirm)
+
+
+@user_router.message(UserDelete.del_all_confirm)
+async def user_del_all_do(m: Message, state: FSMContext):
+    txt = (m.text or "").strip().upper()
+    if txt != "ДА":
+        await m.answer("Не удаляю. Если хочешь удалить — напиши: ДА")
+        return
+    cnt = await run_db(delete_all_grades, m.from_user.id)
+    log.info("user delete all tg_id=%s count=%s", m.from_user.id, cnt)
+    await state.clear()
+    await m.answer(f"✅ Удалено оценок: {cnt}", reply_markup=main_kb(m.from_user.id))
+
+
+# --- Админка
+@admin_router.message(F.text == BTN_ADMIN)
+async def admin_menu(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        await m.answer("Нет доступа.", reply_markup=main_kb(m.from_user.id))
+        return
+    await state.clear()
+    await m.answer("🛠 Админка:", reply_markup=admin_kb())
+
+
+@admin_router.message(Command("recompute_achievements"))
+async def admin_recompute_achievements(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    msg = await m.answer("⏳ Пересчёт достижений по всей истории оценок...")
+    loop = asyncio.get_running_loop()
+    last_report = 0.0
+
+    async def report(text: str):
+        await msg.edit_text(text)
+
+    def progress(done: int, total: int):
+        # вызывается из потока БД: в чат пишем не чаще раза в 3 секунды
+        nonlocal last_report
+        now = time.monotonic()
+        if now - last_report < 3:
             return
+        last_report = now
+        asyncio.run_coroutine_threadsafe(report(f"⏳ Пересчёт достижений: {done}/{total} оценок"), loop)
+
+    result = await run_db(recompute_achievements, progress=progress)
+    if result is None:
+        await m.answer("Пересчёт уже идёт, подожди.", reply_markup=admin_kb())
+        return
+    await m.answer(
+        "✅ Достижения пересчитаны\n"
+        f"Оценок: {result['grades']}\n"
+        f"Пользователей: {result['users']}\n"
+        f"Выдано/исправлено: {result['changed']}\n"
+        f"Сброшено счётчиков без оценок: {result['dropped']}",
+        reply_markup=admin_kb()
+    )
 
-        data = await state.get_data()
-        subject = data["subject"]
-        add_grade_db(m.from_user.id, subject, g)
-        log.info("grade added user=%s subject=%s grade=%s", m.from_user.id, subject, g)
 
-        await state.update_data(last_subject=subject)
-        await m.answer(f"✅ Добавлено: {subject} — {fmt_grade(g)}\nЧто дальше?", reply_markup=after_add_kb())
-        await state.set_state(AddGrade.after)
+@admin_router.message(Command("cache"))
+async def admin_cache_stats(m: Message, fsm_storage: BaseStorage):
+    if not is_admin(m.from_user.id):
+        return
+    s = USER_CACHE.stats()
+    text = (
+        "🗄 Кэш пользователей\n"
+        f"Записей: {s['size']}\n"
+        f"Попаданий: {s['hits']}\n"
+        f"Промахов: {s['misses']}\n"
+        f"Hit rate: {s['hit_rate']:.1%}"
+    )
+    if isinstance(fsm_storage, SQLiteStorage):
+        f = fsm_storage.stats()
+        text += (
+            "\n\n💾 Состояния FSM\n"
+            f"В кэше: {f['size']} (ждут записи: {f['dirty']})\n"
+            f"Попаданий: {f['hits']}, промахов: {f['misses']}\n"
+            f"Сбросов в базу: {f['flushes']}"
+        )
+    g = GROUP_COMMIT.stats()
+    text += (
+        "\n\n✍️ Добавление оценок (group commit)\n"
+        f"Транзакций: {g['batches']}, оценок: {g['items']}\n"
+        f"В среднем за транзакцию: {g['avg_batch']}, максимум: {g['largest']}"
+    )
+    text += f"\n\n🔎 Поиск по именам: {len(USER_NAMES)} пользователей"
+    await m.answer(text, reply_markup=admin_kb())
 
-    @dp.message(AddGrade.grade_input)
-    async def grade_input(m: Message, state: FSMContext):
-        g = parse_grade((m.text or "").strip())
-        if g is None:
-            await m.answer("Не понял. Введи число 2–5, можно с дробью (4,35).")
-            return
 
-        data = await state.get_data()
-        subject = data["subject"]
-        add_grade_db(m.from_user.id, subject, g)
-        log.info("grade added user=%s subject=%s grade=%s", m.from_user.id, subject, g)
-
-        await state.update_data(last_subject=subject)
-        await m.answer(f"✅ Добавлено: {subject} — {fmt_grade(g)}\nЧто дальше?", reply_markup=after_add_kb())
-        await state.set_state(AddGrade.after)
-
-    @dp.message(AddGrade.after)
-    async def after_add(m: Message, state: FSMContext):
-        txt = (m.text or "").strip()
-        data = await state.get_data()
-        last_subject = data.get("last_subject")
-
-        if txt == BTN_ADD_SAME and last_subject:
-            await state.update_data(subject=last_subject)
-            await m.answer(f"Ок, снова {last_subject}. Выбери оценку:", reply_markup=grade_pick_kb())
-            await state.set_state(AddGrade.grade_pick)
-            return
+@admin_router.message(F.text == BTN_ADM_BACK)
+async def admin_back(m: Message, state: FSMContext):
+    await state.clear()
+    await m.answer("Меню 👇", reply_markup=main_kb(m.from_user.id))
 
-        if txt == BTN_OTHER_SUBJ:
-            subjects = get_subjects()
-            await m.answer("Выбери другой предмет:", reply_markup=subject_kb(subjects))
-            await state.set_state(AddGrade.subject_choice)
-            return
 
-        if txt == BTN_TO_MENU:
-            await state.clear()
-            await m.answer("Меню 👇", reply_markup=main_kb(m.from_user.id))
-            return
+def users_page_text(rows, query: str | None = None) -> str:
+    text = f"🔎 Пользователи «{query}»:\n\n" if query else "👥 Пользователи:\n\n"
+    if not rows:
+        text += "Никого не нашлось."
+    for r in rows:
+        text += f"{r['full_name']} | id={r['tg_id']} | оценок={r['grades_count']}\n"
+    return text
 
-        await m.answer("Выбери действие кнопками ниже 👇", reply_markup=after_add_kb())
 
-    # --- Удалить одну оценку (пользователь)
-    @dp.message(F.text == BTN_DEL_ONE)
-    async def user_del_one_start(m: Message, state: FSMContext):
-        user = get_user(m.from_user.id)
-        if not user:
-            await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
-            return
-        if not is_user_verified(m.from_user.id):
-            await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
-            return
+@admin_router.message(F.text == BTN_ADM_LIST)
+async def admin_list(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    rows, has_prev, has_next = await run_db(list_users_page)
+    await m.answer(users_page_text(rows), reply_markup=users_page_kb(rows, has_prev, has_next))
 
-        rows = list_last_grades(m.from_user.id, limit=10)
-        if not rows:
-            await m.answer("У тебя пока нет оценок.", reply_markup=main_kb(m.from_user.id))
-            return
 
-        text = "🗑 Удаление одной оценки\n\nПоследние оценки (ID):\n"
-        for r in rows:
-            text += f"ID {r['id']} — {r['subject']}: {fmt_grade(r['grade'])}\n"
-        text += "\nНапиши ID оценки, которую удалить:"
-        await state.clear()
-        await m.answer(text, reply_markup=cancel_kb())
-        await state.set_state(UserDelete.del_one_wait_id)
+@admin_router.callback_query(F.data.startswith("ul:"))
+async def admin_users_page(q: CallbackQuery, state: FSMContext):
+    if not is_admin(q.from_user.id):
+        await q.answer("Нет доступа.", show_alert=True)
+        return
+
+    parts = (q.data or "").split(":")
+    if parts[1:] == ["find"]:
+        await state.set_state(Admin.users_search)
+        await q.message.answer("Введи начало имени или фамилии (или TG ID):", reply_markup=cancel_kb())
+        await q.answer()
+        return
 
-    @dp.message(UserDelete.del_one_wait_id)
-    async def user_del_one_do(m: Message, state: FSMContext):
-        txt = (m.text or "").strip()
+    query, cursor, direction = None, None, "next"
+    if parts[1:] != ["all"]:
         try:
-            grade_id = int(txt)
+            _, scope, direction, cursor_str = parts
+            cursor = int(cursor_str)
         except ValueError:
-            await m.answer("Нужно число (ID). Попробуй ещё раз:")
+            await q.answer("Неверные данные.", show_alert=True)
             return
+        if scope == "s":
+            query = (await state.get_data()).get("users_query")
+        direction = "prev" if direction == "p" else "next"
 
-        ok = delete_grade_by_id(m.from_user.id, grade_id)
-        log.info("user delete one tg_id=%s grade_id=%s ok=%s", m.from_user.id, grade_id, ok)
-        await state.clear()
-        if ok:
-            await m.answer(f"✅ Оценка ID {grade_id} удалена.", reply_markup=main_kb(m.from_user.id))
-        else:
-            await m.answer("❌ Не нашёл такую оценку (или она не твоя).", reply_markup=main_kb(m.from_user.id))
-
-    # --- Удалить все оценки (пользователь)
-    @dp.message(F.text == BTN_DEL_ALL)
-    async def user_del_all_start(m: Message, state: FSMContext):
-        user = get_user(m.from_user.id)
-        if not user:
-            await m.answer("Сначала /start", reply_markup=ReplyKeyboardRemove())
-            return
-        if not is_user_verified(m.from_user.id):
-            await m.answer("🔒 Доступ не выдан. Нажми «📩 Запросить доступ» и дождись решения админа.", reply_markup=unauth_kb())
-            return
+    rows, has_prev, has_next = await run_db(list_users_page, cursor, direction, query)
+    try:
+        await q.message.edit_text(
+            users_page_text(rows, query),
+            reply_markup=users_page_kb(rows, has_prev, has_next, search=bool(query)),
+        )
+    except Exception:
+        pass
+    await q.answer()
+
+
+@admin_router.message(Admin.users_search)
+async def admin_users_search(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
-        await m.answer("⚠️ Удалить ВСЕ твои оценки?\nНапиши: ДА (или нажми Отмена)", reply_markup=cancel_kb())
-        await state.set_state(UserDelete.del_all_confirm)
-
-    @dp.message(UserDelete.del_all_confirm)
-    async def user_del_all_do(m: Message, state: FSMContext):
-        txt = (m.text or "").strip().upper()
-        if txt != "ДА":
-            await m.answer("Не удаляю. Если хочешь удалить — напиши: ДА")
-            return
-        cnt = delete_all_grades(m.from_user.id)
-        log.info("user delete all tg_id=%s count=%s", m.from_user.id, cnt)
+        return
+    query = (m.text or "").strip()[:64]
+    if not query:
+        await m.answer("Нужен текст: начало имени, фамилии или TG ID:")
+        return
+    # запрос храним в данных FSM — по нему листаются страницы поиска
+    await state.set_state(None)
+    await state.update_data(users_query=query)
+
+    rows, has_prev, has_next = await run_db(list_users_page, query=query)
+    await m.answer(users_page_text(rows, query), reply_markup=users_page_kb(rows, has_prev, has_next, search=True))
+    await m.answer("Готово.", reply_markup=admin_kb())
+
+
+@admin_router.message(F.text == BTN_ADM_DEL)
+async def admin_del_start(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await m.answer("Введи TG ID пользователя для удаления:", reply_markup=cancel_kb())
+    await state.set_state(Admin.del_wait_id)
+
+
+@admin_router.message(Admin.del_wait_id)
+async def admin_del_do(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
-        await m.answer(f"✅ Удалено оценок: {cnt}", reply_markup=main_kb(m.from_user.id))
+        return
 
-    # --- Админка
-    @dp.message(F.text == BTN_ADMIN)
-    async def admin_menu(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await m.answer("Нет доступа.", reply_markup=main_kb(m.from_user.id))
-            return
-        await state.clear()
-        await m.answer("🛠 Админка:", reply_markup=admin_kb())
+    txt = (m.text or "").strip()
+    try:
+        target_id = int(txt)
+    except ValueError:
+        await m.answer("Нужно число (TG ID). Попробуй ещё раз:")
+        return
 
-    @dp.message(F.text == BTN_ADM_BACK)
-    async def admin_back(m: Message, state: FSMContext):
+    if target_id in ADMIN_IDS:
+        await m.answer("Админа удалять нельзя.", reply_markup=admin_kb())
         await state.clear()
-        await m.answer("Меню 👇", reply_markup=main_kb(m.from_user.id))
+        return
+
+    ok = await run_db(delete_user, target_id)
+    log.info("admin delete user admin=%s target=%s ok=%s", m.from_user.id, target_id, ok)
+    await state.clear()
+    if ok:
+        await m.answer(f"✅ Пользователь id={target_id} удалён (и его оценки тоже).", reply_markup=admin_kb())
+    else:
+        await m.answer(f"❌ Пользователь id={target_id} не найден.", reply_markup=admin_kb())
+
+
+# --- Админ: добавить демо
+@admin_router.message(F.text == BTN_ADM_DEMO)
+async def admin_demo(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    await run_db(seed_demo_data_force)
+    log.info("admin demo seed by admin=%s", m.from_user.id)
+    await m.answer("✅ Демо-пользователи добавлены (старые демо заменены). Проверь лидерборд.", reply_markup=admin_kb())
+
+
+# --- Админ: добавить оценку пользователю
+@admin_router.message(F.text == BTN_ADM_ADD_GRADE)
+async def admin_add_grade_start(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await m.answer("Введи TG ID или часть имени пользователя, кому добавить оценку:", reply_markup=cancel_kb())
+    await state.set_state(Admin.add_grade_wait_user_id)
+
+
+async def admin_target_id(m: Message) -> int | None:
+    """
+    TG ID из ответа админа. На часть имени отвечает кнопками с подходящими
+    пользователями (USER_NAMES) и возвращает None — выбор придёт в admin_pick_user.
+    """
+    txt = (m.text or "").strip()
+    try:
+        return int(txt)
+    except ValueError:
+        pass
+    found = USER_NAMES.search(txt)
+    if found:
+        await m.answer("Кого именно? Выбери:", reply_markup=user_candidates_kb(found))
+    else:
+        await m.answer("Никого не нашёл. Введи TG ID или часть имени:")
+    return None
 
-    @dp.message(F.text == BTN_ADM_LIST)
-    async def admin_list(m: Message):
-        if not is_admin(m.from_user.id):
-            return
-        rows = list_users(limit=30)
-        text = "👥 Пользователи (до 30):\n\n"
-        for r in rows:
-            text += f"{r['full_name']} | id={r['tg_id']} | оценок={r['grades_count']}\n"
-        await m.answer(text, reply_markup=admin_kb())
-
-    @dp.message(F.text == BTN_ADM_DEL)
-    async def admin_del_start(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            return
+
+@admin_router.message(Admin.add_grade_wait_user_id)
+async def admin_add_grade_userid(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
-        await m.answer("Введи TG ID пользователя для удаления:", reply_markup=cancel_kb())
-        await state.set_state(Admin.del_wait_id)
+        return
+    target_id = await admin_target_id(m)
+    if target_id is not None:
+        await admin_add_grade_target(m, state, target_id)
 
-    @dp.message(Admin.del_wait_id)
-    async def admin_del_do(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
 
-        txt = (m.text or "").strip()
-        try:
-            target_id = int(txt)
-        except ValueError:
-            await m.answer("Нужно число (TG ID). Попробуй ещё раз:")
-            return
+async def admin_add_grade_target(m: Message, state: FSMContext, target_id: int):
+    u = await run_db(get_user, target_id)
+    if not u:
+        await m.answer("Такого пользователя нет в базе. Пусть он нажмёт /start и зарегистрируется.")
+        return
 
-        if target_id in ADMIN_IDS:
-            await m.answer("Админа удалять нельзя.", reply_markup=admin_kb())
-            await state.clear()
-            return
+    await state.update_data(target_id=target_id)
+    await m.answer(f"Кому: {u['full_name']} (id={target_id})\nВыбери предмет:", reply_markup=SUBJECTS.keyboard())
+    await state.set_state(Admin.add_grade_subject_choice)
 
-        ok = delete_user(target_id)
-        log.info("admin delete user admin=%s target=%s ok=%s", m.from_user.id, target_id, ok)
+
+@admin_router.message(Admin.add_grade_subject_choice)
+async def admin_add_grade_subject(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
-        if ok:
-            await m.answer(f"✅ Пользователь id={target_id} удалён (и его оценки тоже).", reply_markup=admin_kb())
+        return
+    txt = (m.text or "").strip()
+
+    if txt == BTN_NEW_SUBJ:
+        await m.answer("Напиши название нового предмета:", reply_markup=cancel_kb())
+        await state.set_state(Admin.add_grade_new_subject)
+        return
+
+    if txt not in SUBJECTS:
+        found = SUBJECTS.search(txt)
+        if found:
+            await m.answer("Такого предмета нет. Может, один из этих?", reply_markup=subject_candidates_kb(found))
         else:
-            await m.answer(f"❌ Пользователь id={target_id} не найден.", reply_markup=admin_kb())
+            await m.answer("Выбери предмет кнопкой или нажми «➕ Новый предмет».")
+        return
+    await admin_add_grade_subject_chosen(m, state, txt)
 
-    # --- Админ: добавить демо
-    @dp.message(F.text == BTN_ADM_DEMO)
-    async def admin_demo(m: Message):
-        if not is_admin(m.from_user.id):
-            return
-        seed_demo_data_force()
-        log.info("admin demo seed by admin=%s", m.from_user.id)
-        await m.answer("✅ Демо-пользователи добавлены (старые демо заменены). Проверь лидерборд.", reply_markup=admin_kb())
-
-    # --- Админ: добавить оценку пользователю
-    @dp.message(F.text == BTN_ADM_ADD_GRADE)
-    async def admin_add_grade_start(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            return
-        await state.clear()
-        await m.answer("Введи TG ID пользователя, кому добавить оценку:", reply_markup=cancel_kb())
-        await state.set_state(Admin.add_grade_wait_user_id)
 
-    @dp.message(Admin.add_grade_wait_user_id)
-    async def admin_add_grade_userid(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
-        txt = (m.text or "").strip()
-        try:
-            target_id = int(txt)
-        except ValueError:
-            await m.answer("Нужно число (TG ID). Попробуй ещё раз:")
-            return
+async def admin_add_grade_subject_chosen(m: Message, state: FSMContext, subject: str):
+    await state.update_data(subject=subject)
+    await m.answer("Выбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
+    await state.set_state(Admin.add_grade_pick)
 
-        u = get_user(target_id)
-        if not u:
-            await m.answer("Такого пользователя нет в базе. Пусть он нажмёт /start и зарегистрируется.")
-            return
 
-        await state.update_data(target_id=target_id)
-        subjects = get_subjects()
-        await m.answer(f"Кому: {u['full_name']} (id={target_id})\nВыбери предмет:", reply_markup=subject_kb(subjects))
-        await state.set_state(Admin.add_grade_subject_choice)
+@admin_router.message(Admin.add_grade_new_subject)
+async def admin_add_grade_new_subject(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        await state.clear()
+        return
+    name = (m.text or "").strip()
+    if len(name) < 2:
+        await m.answer("Слишком коротко. Напиши название предмета нормально:")
+        return
+    await run_db(add_subject, name)
+    await state.update_data(subject=name)
+    await m.answer("Выбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
+    await state.set_state(Admin.add_grade_pick)
+
+
+@admin_router.message(Admin.add_grade_pick)
+async def admin_add_grade_pick(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        await state.clear()
+        return
+    txt = (m.text or "").strip()
+    if txt == BTN_GOTHER:
+        await m.answer("Введи оценку (пример: 4,35). Диапазон 2–5:", reply_markup=cancel_kb())
+        await state.set_state(Admin.add_grade_input)
+        return
+
+    g = parse_grade(txt)
+    if g is None:
+        await m.answer("Нажми 2/3/4/5 или «Другая».", reply_markup=grade_pick_kb())
+        return
+
+    data = await state.get_data()
+    target_id = data["target_id"]
+    subject = data["subject"]
+    newly = await run_db(add_grade_db, target_id, subject, g)
+    u = await run_db(get_user, target_id)
+    log.info("admin add grade admin=%s target=%s subject=%s grade=%s", m.from_user.id, target_id, subject, g)
+
+    await state.clear()
+    await m.answer(
+        f"✅ Добавлено пользователю {u['full_name']}: {subject} — {fmt_grade(g)}{achievements_text(newly)}",
+        reply_markup=admin_kb()
+    )
 
-    @dp.message(Admin.add_grade_subject_choice)
-    async def admin_add_grade_subject(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
-        txt = (m.text or "").strip()
 
-        if txt == BTN_NEW_SUBJ:
-            await m.answer("Напиши название нового предмета:", reply_markup=cancel_kb())
-            await state.set_state(Admin.add_grade_new_subject)
-            return
+@admin_router.message(Admin.add_grade_input)
+async def admin_add_grade_input(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        await state.clear()
+        return
+    g = parse_grade((m.text or "").strip())
+    if g is None:
+        await m.answer("Не понял. Введи число 2–5, можно с дробью (4,35).")
+        return
+
+    data = await state.get_data()
+    target_id = data["target_id"]
+    subject = data["subject"]
+    newly = await run_db(add_grade_db, target_id, subject, g)
+    u = await run_db(get_user, target_id)
+    log.info("admin add grade admin=%s target=%s subject=%s grade=%s", m.from_user.id, target_id, subject, g)
+
+    await state.clear()
+    await m.answer(
+        f"✅ Добавлено пользователю {u['full_name']}: {subject} — {fmt_grade(g)}{achievements_text(newly)}",
+        reply_markup=admin_kb()
+    )
 
-        subjects = set(get_subjects())
-        if txt not in subjects:
-            await m.answer("Выбери предмет кнопкой или нажми «➕ Новый предмет».")
-            return
 
-        await state.update_data(subject=txt)
-        await m.answer("Выбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
-        await state.set_state(Admin.add_grade_pick)
+# --- Админ: удалить оценку пользователю
+@admin_router.message(F.text == BTN_ADM_DEL_GRADE)
+async def admin_del_grade_start(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await m.answer("Введи TG ID или часть имени пользователя (чтобы удалить одну оценку):", reply_markup=cancel_kb())
+    await state.set_state(Admin.del_grade_wait_user_id)
 
-    @dp.message(Admin.add_grade_new_subject)
-    async def admin_add_grade_new_subject(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
-        name = (m.text or "").strip()
-        if len(name) < 2:
-            await m.answer("Слишком коротко. Напиши название предмета нормально:")
-            return
-        add_subject(name)
-        await state.update_data(subject=name)
-        await m.answer("Выбери оценку (или «Другая»):", reply_markup=grade_pick_kb())
-        await state.set_state(Admin.add_grade_pick)
-
-    @dp.message(Admin.add_grade_pick)
-    async def admin_add_grade_pick(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
-        txt = (m.text or "").strip()
-        if txt == BTN_GOTHER:
-            await m.answer("Введи оценку (пример: 4,35). Диапазон 2–5:", reply_markup=cancel_kb())
-            await state.set_state(Admin.add_grade_input)
-            return
 
-        g = parse_grade(txt)
-        if g is None:
-            await m.answer("Нажми 2/3/4/5 или «Другая».", reply_markup=grade_pick_kb())
-            return
+@admin_router.message(Admin.del_grade_wait_user_id)
+async def admin_del_grade_userid(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        await state.clear()
+        return
+    target_id = await admin_target_id(m)
+    if target_id is not None:
+        await admin_del_grade_target(m, state, target_id)
+
 
-        data = await state.get_data()
-        target_id = data["target_id"]
-        subject = data["subject"]
-        add_grade_db(target_id, subject, g)
-
-        newly = []
-        cnt_total, avg_total2 = get_total_count_and_avg(target_id)
-        if cnt_total == 1 and unlock_achievement(target_id, "first_grade"):
-            newly.append("first_grade")
-        if cnt_total >= 10 and unlock_achievement(target_id, "ten_tests"):
-            newly.append("ten_tests")
-        last3 = get_last_grades(target_id, 3)
-        if len(last3) == 3 and all(x >= 5.0 for x in last3) and unlock_achievement(target_id, "streak3_5"):
-            newly.append("streak3_5")
-        if cnt_total >= 5 and (avg_total2 is not None) and float(avg_total2) >= 4.5 and unlock_achievement(target_id, "avg_45"):
-            newly.append("avg_45")
-
-        u = get_user(target_id)
-        log.info("admin add grade admin=%s target=%s subject=%s grade=%s", m.from_user.id, target_id, subject, g)
+async def admin_del_grade_target(m: Message, state: FSMContext, target_id: int):
+    u = await run_db(get_user, target_id)
+    if not u:
+        await m.answer("Пользователь не найден.")
+        return
 
+    rows = await run_db(list_last_grades, target_id, limit=15)
+    if not rows:
+        await m.answer("У пользователя нет оценок.", reply_markup=admin_kb())
         await state.clear()
-        await m.answer(f"✅ Добавлено пользователю {u['full_name']}: {subject} — {fmt_grade(g)}", reply_markup=admin_kb())
+        return
 
-    @dp.message(Admin.add_grade_input)
-    async def admin_add_grade_input(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
-        g = parse_grade((m.text or "").strip())
-        if g is None:
-            await m.answer("Не понял. Введи число 2–5, можно с дробью (4,35).")
-            return
+    await state.update_data(target_id=target_id)
+    text = f"🗑 Удалить оценку пользователю {u['full_name']} (id={target_id})\n\n"
+    text += "Последние оценки (ID):\n"
+    for r in rows:
+        text += f"ID {r['id']} — {r['subject']}: {fmt_grade(r['grade'])}\n"
+    text += "\nНапиши ID оценки, которую удалить:"
+    await m.answer(text, reply_markup=cancel_kb())
+    await state.set_state(Admin.del_grade_wait_grade_id)
 
-        data = await state.get_data()
-        target_id = data["target_id"]
-        subject = data["subject"]
-        add_grade_db(target_id, subject, g)
-        u = get_user(target_id)
-        log.info("admin add grade admin=%s target=%s subject=%s grade=%s", m.from_user.id, target_id, subject, g)
 
+@admin_router.message(Admin.del_grade_wait_grade_id)
+async def admin_del_grade_do(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
-        await m.answer(f"✅ Добавлено пользователю {u['full_name']}: {subject} — {fmt_grade(g)}", reply_markup=admin_kb())
+        return
 
-    # --- Админ: удалить оценку пользователю
-    @dp.message(F.text == BTN_ADM_DEL_GRADE)
-    async def admin_del_grade_start(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            return
+    txt = (m.text or "").strip()
+    try:
+        grade_id = int(txt)
+    except ValueError:
+        await m.answer("Нужно число (ID). Попробуй ещё раз:")
+        return
+
+    data = await state.get_data()
+    target_id = data["target_id"]
+    ok = await run_db(delete_grade_for_user, target_id, grade_id)
+    log.info("admin delete grade admin=%s target=%s grade_id=%s ok=%s", m.from_user.id, target_id, grade_id, ok)
+    await state.clear()
+
+    if ok:
+        await m.answer(f"✅ Удалено: оценка ID {grade_id} у пользователя id={target_id}", reply_markup=admin_kb())
+    else:
+        await m.answer("❌ Не нашёл такую оценку (или она не принадлежит этому пользователю).", reply_markup=admin_kb())
+
+
+# --- Админ: очистить оценки пользователю
+@admin_router.message(F.text == BTN_ADM_CLEAR_GRADES)
+async def admin_clear_grades_start(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await m.answer("Введи TG ID или часть имени пользователя (чтобы удалить ВСЕ его оценки):", reply_markup=cancel_kb())
+    await state.set_state(Admin.clear_grades_wait_user_id)
+
+
+@admin_router.message(Admin.clear_grades_wait_user_id)
+async def admin_clear_grades_userid(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
-        await m.answer("Введи TG ID пользователя (чтобы удалить одну оценку):", reply_markup=cancel_kb())
-        await state.set_state(Admin.del_grade_wait_user_id)
+        return
+    target_id = await admin_target_id(m)
+    if target_id is not None:
+        await admin_clear_grades_target(m, state, target_id)
 
-    @dp.message(Admin.del_grade_wait_user_id)
-    async def admin_del_grade_userid(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
-        txt = (m.text or "").strip()
-        try:
-            target_id = int(txt)
-        except ValueError:
-            await m.answer("Нужно число (TG ID). Попробуй ещё раз:")
-            return
 
-        u = get_user(target_id)
-        if not u:
-            await m.answer("Пользователь не найден.")
-            return
+async def admin_clear_grades_target(m: Message, state: FSMContext, target_id: int):
+    u = await run_db(get_user, target_id)
+    if not u:
+        await m.answer("Пользователь не найден.")
+        return
 
-        rows = list_last_grades(target_id, limit=15)
-        if not rows:
-            await m.answer("У пользователя нет оценок.", reply_markup=admin_kb())
-            await state.clear()
-            return
+    await state.update_data(target_id=target_id)
+    await m.answer(f"⚠️ Удалить ВСЕ оценки пользователя {u['full_name']} (id={target_id})?\nНапиши: ДА", reply_markup=cancel_kb())
+    await state.set_state(Admin.clear_grades_confirm)
+
+
+@admin_router.message(Admin.clear_grades_confirm)
+async def admin_clear_grades_confirm(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        await state.clear()
+        return
+    txt = (m.text or "").strip().upper()
+    if txt != "ДА":
+        await m.answer("Чтобы подтвердить, напиши: ДА (или нажми Отмена)")
+        return
+    data = await state.get_data()
+    target_id = data["target_id"]
+    cnt = await run_db(delete_all_grades_for_user, target_id)
+    log.info("admin clear grades admin=%s target=%s count=%s", m.from_user.id, target_id, cnt)
+    await state.clear()
+    await m.answer(f"✅ Удалено оценок у пользователя id={target_id}: {cnt}", reply_markup=admin_kb())
+
+
+# --- Админ: выбор пользователя / предмета из найденных по части имени
+PICK_USER_FLOWS = {
+    Admin.add_grade_wait_user_id.state: admin_add_grade_target,
+    Admin.del_grade_wait_user_id.state: admin_del_grade_target,
+    Admin.clear_grades_wait_user_id.state: admin_clear_grades_target,
+}
 
-        await state.update_data(target_id=target_id)
-        text = f"🗑 Удалить оценку пользователю {u['full_name']} (id={target_id})\n\n"
-        text += "Последние оценки (ID):\n"
-        for r in rows:
-            text += f"ID {r['id']} — {r['subject']}: {fmt_grade(r['grade'])}\n"
-        text += "\nНапиши ID оценки, которую удалить:"
-        await m.answer(text, reply_markup=cancel_kb())
-        await state.set_state(Admin.del_grade_wait_grade_id)
-
-    @dp.message(Admin.del_grade_wait_grade_id)
-    async def admin_del_grade_do(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
 
-        txt = (m.text or "").strip()
+@admin_router.callback_query(F.data.startswith("pick:"))
+async def admin_pick(q: CallbackQuery, state: FSMContext):
+    if not is_admin(q.from_user.id):
+        await q.answer("Нет доступа.", show_alert=True)
+        return
+
+    try:
+        _, kind, value = (q.data or "").split(":", 2)
+    except ValueError:
+        await q.answer("Неверные данные.", show_alert=True)
+        return
+    current = await state.get_state()
+    if kind == "u" and current in PICK_USER_FLOWS:
         try:
-            grade_id = int(txt)
+            target_id = int(value)
         except ValueError:
-            await m.answer("Нужно число (ID). Попробуй ещё раз:")
+            await q.answer("Неверные данные.", show_alert=True)
             return
+        await q.answer()
+        await PICK_USER_FLOWS[current](q.message, state, target_id)
+    elif kind == "s" and current == Admin.add_grade_subject_choice.state and value in SUBJECTS:
+        await q.answer()
+        await admin_add_grade_subject_chosen(q.message, state, value)
+    else:
+        await q.answer("Этот выбор уже неактуален.", show_alert=True)
+
+
+# --- Админ: импорт оценок из CSV / XLSX
+@admin_router.message(F.text == BTN_ADM_IMPORT)
+async def admin_import_start(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await m.answer(
+        "📥 Пришли CSV- или XLSX-файл документом.\n"
+        "Колонки: пользователь (TG ID или «Имя Фамилия»), предмет, оценка, дата (необязательно).\n"
+        "Пример строки: Иван Иванов;Математика;4,5;15.09.2025\n"
+        "Первая строка может быть заголовком: user, subject, grade, date.",
+        reply_markup=cancel_kb()
+    )
+    await state.set_state(Admin.import_wait_file)
+
 
-        data = await state.get_data()
-        target_id = data["target_id"]
-        ok = delete_grade_for_user(target_id, grade_id)
-        log.info("admin delete grade admin=%s target=%s grade_id=%s ok=%s", m.from_user.id, target_id, grade_id, ok)
+@admin_router.message(Admin.import_wait_file, F.document)
+async def admin_import_file(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
+        return
+    doc = m.document
+    if (doc.file_name or "").lower().endswith(".xls"):
+        await m.answer("Старый формат .xls не поддерживается: сохрани таблицу как .xlsx или «CSV UTF-8».")
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await m.answer("Файл слишком большой (максимум 20 МБ).")
+        return
+
+    import tempfile
+
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as buf:
+        await m.bot.download(doc, destination=buf)
+        buf.seek(0)
+        try:
+            result = await run_db(import_grades, buf)
+        except ValueError as e:
+            await m.answer(f"⚠️ {e}. Пришли другой файл или нажми Отмена.")
+            return
+    log.info(
+        "admin import admin=%s file=%s imported=%s errors=%s",
+        m.from_user.id, doc.file_name, result["imported"], result["error_count"]
+    )
 
-        if ok:
-            await m.answer(f"✅ Удалено: оценка ID {grade_id} у пользователя id={target_id}", reply_markup=admin_kb())
-        else:
-            await m.answer("❌ Не нашёл такую оценку (или она не принадлежит этому пользователю).", reply_markup=admin_kb())
+    await state.clear()
+    text = f"✅ Импортировано оценок: {result['imported']} (пользователей: {result['users']})"
+    if result["new_subjects"]:
+        text += "\nНовые предметы: " + ", ".join(result["new_subjects"])
+    if result["achievements"]:
+        text += f"\nОткрыто достижений: {result['achievements']}"
+    if result["error_count"]:
+        text += f"\n\n⚠️ Строк с ошибками: {result['error_count']} (они не импортированы):\n"
+        text += "\n".join(f"• строка {line}: {msg}" for line, msg in result["errors"])
+        if result["error_count"] > len(result["errors"]):
+            text += f"\n… и ещё {result['error_count'] - len(result['errors'])}"
+    await m.answer(text, reply_markup=admin_kb())
+
+
+@admin_router.message(Admin.import_wait_file)
+async def admin_import_not_file(m: Message):
+    await m.answer("Пришли CSV- или XLSX-файл документом (скрепка → Файл) или нажми Отмена.")
+
+
+# --- Админ: экспорт оценок
+@admin_router.message(F.text == BTN_ADM_EXPORT)
+async def admin_export_start(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await m.answer(
+        "📤 Экспорт оценок. Напиши фильтр или «все»:\n"
+        "• предмет — «Математика»\n"
+        "• период — «01.09.2025 31.12.2025» (одна дата — начиная с неё)\n"
+        "• добавь «json», чтобы получить JSON вместо CSV\n"
+        "Пример: Математика 01.09.2025 31.12.2025",
+        reply_markup=cancel_kb()
+    )
+    await state.set_state(Admin.export_filter)
 
-    # --- Админ: очистить оценки пользователю
-    @dp.message(F.text == BTN_ADM_CLEAR_GRADES)
-    async def admin_clear_grades_start(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
+
+@admin_router.message(Admin.export_filter)
+async def admin_export_filter(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        await state.clear()
+        return
+    parsed = parse_export_filter(m.text or "")
+    if parsed is None:
+        await m.answer("Не нашёл такой предмет. Напиши предмет как в списке, даты или «все»:")
+        return
+    subject, date_from, date_to, fmt = parsed
+    await state.clear()
+
+    file, count = await run_db(
+        export_grades, fmt, subject=subject, date_from=date_from, date_to=date_to, compress=True
+    )
+    log.info("admin export admin=%s subject=%s from=%s to=%s rows=%s", m.from_user.id, subject, date_from, date_to, count)
+    with file:
+        size = file.seek(0, io.SEEK_END)
+        if not count:
+            await m.answer("По такому фильтру оценок нет.", reply_markup=admin_kb())
+            return
+        if size > EXPORT_MAX_BYTES:
+            await m.answer("Файл больше 50 МБ — сузь фильтр (предмет или период).", reply_markup=admin_kb())
             return
+        stamp = datetime.now().strftime("%Y%m%d_%H%M")
+        caption = f"📤 Оценок: {count}"
+        if subject:
+            caption += f"\nПредмет: {subject}"
+        if date_from:
+            caption += f"\nПериод: {date_from} — {date_to or '…'}"
+        await m.answer_document(SpooledInputFile(file, f"grades_{stamp}.{fmt}.gz"), caption=caption)
+    await m.answer("Готово.", reply_markup=admin_kb())
+
+
+# --- Админ: аналитика по снимку оценок
+@admin_router.message(F.text == BTN_ADM_ANALYTICS)
+async def admin_analytics(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    text = await run_db(analytics_report)
+    await m.answer(text, reply_markup=analytics_kb())
+
+
+@admin_router.callback_query(F.data == "an:refresh")
+async def admin_analytics_refresh(q: CallbackQuery):
+    if not is_admin(q.from_user.id):
+        await q.answer("Нет доступа.", show_alert=True)
+        return
+    await q.answer("Пересчитываю…")
+    text = await run_db(analytics_report, True)
+    try:
+        await q.message.edit_text(text, reply_markup=analytics_kb())
+    except Exception:
+        pass
+
+
+# --- Админ: рассылка всем верифицированным
+@admin_router.message(F.text == BTN_ADM_BROADCAST)
+async def admin_broadcast_start(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await m.answer("Напиши текст рассылки для всех авторизованных пользователей:", reply_markup=cancel_kb())
+    await state.set_state(Admin.broadcast_text)
+
+
+@admin_router.message(Admin.broadcast_text)
+async def admin_broadcast_text(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         await state.clear()
-        await m.answer("Введи TG ID пользователя (чтобы удалить ВСЕ его оценки):", reply_markup=cancel_kb())
-        await state.set_state(Admin.clear_grades_wait_user_id)
+        return
+    text = (m.text or "").strip()
+    if not text:
+        await m.answer("Нужен текст. Напиши сообщение для рассылки:")
+        return
+    chat_ids = await run_db(list_verified_user_ids)
+    await state.clear()
+    if not chat_ids:
+        await m.answer("Некому отправлять: нет авторизованных пользователей.", reply_markup=admin_kb())
+        return
+
+    log.info("broadcast admin=%s recipients=%s", m.from_user.id, len(chat_ids))
+    await m.answer(f"📣 Рассылка поставлена в очередь: {len(chat_ids)} получателей.", reply_markup=admin_kb())
+
+    async def report():
+        ok, failed = await OUTBOX.broadcast(m.bot, chat_ids, text)
+        OUTBOX.send(m.bot, m.from_user.id, f"📣 Рассылка завершена\nДоставлено: {ok}\nНе доставлено: {failed}")
+
+    spawn(report())
+
+
+@admin_router.message(Command("outbox"))
+async def admin_outbox_stats(m: Message):
+    if not is_admin(m.from_user.id):
+        return
+    s = OUTBOX.stats()
+    dead = await run_db(count_dead_letters)
+    await m.answer(
+        "📤 Очередь сообщений\n"
+        f"В очереди: {s['queued']} (всего в работе: {s['pending']})\n"
+        f"Отправлено: {s['sent']}\n"
+        f"Повторов: {s['retried']}\n"
+        f"Не доставлено: {s['failed']} (в outbox_dead всего: {dead})",
+        reply_markup=admin_kb()
+    )
 
-    @dp.message(Admin.clear_grades_wait_user_id)
-    async def admin_clear_grades_userid(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
-            return
-        txt = (m.text or "").strip()
+
+# --- Fallback
+@fallback_router.message()
+async def fallback(m: Message, user):
+    if not user:
+        await m.answer("Нажми /start чтобы зарегистрироваться.")
+    else:
+        await m.answer("Выбирай действие кнопками 👇", reply_markup=main_kb(m.from_user.id))
+
+
+# ========= BOT =========
+def _detach_router(router: Router):
+    """Отвязывает роутер от прошлого Dispatcher (bench.py собирает их несколько в одном процессе)."""
+    parent = router.parent_router
+    if parent is not None:
+        parent.sub_routers.remove(router)
+        router._parent_router = None
+
+
+def build_dispatcher(storage: BaseStorage | None = None) -> Dispatcher:
+    dp = Dispatcher(storage=storage or make_fsm_storage())
+    dp.shutdown.register(OUTBOX.close)
+    dp.shutdown.register(close_chart_pool)
+    dp.message.outer_middleware(UserMiddleware())
+    dp.callback_query.outer_middleware(UserMiddleware())
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    for router in ROUTERS:
+        _detach_router(router)
+    dp.include_routers(*ROUTERS)
+    return dp
+
+
+# ========= WEBHOOK =========
+def build_webhook_app(dp: Dispatcher, bot: Bot):
+    """aiohttp-приложение, которое принимает апдейты на WEBHOOK_PATH."""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    class DrainingRequestHandler(SimpleRequestHandler):
+        async def drain(self, timeout: float):
+            tasks = set(self._background_feed_update_tasks)
+            if tasks:
+                log.info("Жду завершения %s апдейтов...", len(tasks))
+                await asyncio.wait(tasks, timeout=timeout)
+
+    app = web.Application()
+    handler = DrainingRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    app["webhook_handler"] = handler
+    return app
+
+
+def stop_on_signals(stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
         try:
-            target_id = int(txt)
-        except ValueError:
-            await m.answer("Нужно число (TG ID). Попробуй ещё раз:")
-            return
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows
 
-        u = get_user(target_id)
-        if not u:
-            await m.answer("Пользователь не найден.")
-            return
 
-        await state.update_data(target_id=target_id)
-        await m.answer(f"⚠️ Удалить ВСЕ оценки пользователя {u['full_name']} (id={target_id})?\nНапиши: ДА", reply_markup=cancel_kb())
-        await state.set_state(Admin.clear_grades_confirm)
+async def run_webhook(dp: Dispatcher, bot: Bot, stop: asyncio.Event | None = None):
+    """
+    Запускает HTTP-сервер вебхука и ждёт SIGINT/SIGTERM (или stop).
+    Остановка: перестаём принимать запросы, дожидаемся уже принятых апдейтов,
+    затем закрываем приложение (dp.shutdown, сессия бота).
+    """
+    from aiohttp import web
+
+    app = build_webhook_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    log.info("Webhook server on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        log.info("Webhook set: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+    stop = stop or asyncio.Event()
+    stop_on_signals(stop)
 
-    @dp.message(Admin.clear_grades_confirm)
-    async def admin_clear_grades_confirm(m: Message, state: FSMContext):
-        if not is_admin(m.from_user.id):
-            await state.clear()
+    try:
+        await stop.wait()
+    finally:
+        # вебхук в Telegram не снимаем: пока бот перезапускается, апдейты копятся на стороне Telegram
+        await site.stop()
+        await app["webhook_handler"].drain(WEBHOOK_DRAIN_TIMEOUT)
+        await runner.cleanup()
+
+
+# ========= WORKERS =========
+# Многопроцессный режим. Главный процесс принимает апдейты и единственный пишет
+# в базу; воркеры (процессы через spawn) обрабатывают апдейты своих чатов:
+# читают базу сами (WAL), write-хелперы отправляют главному процессу и ждут
+# ответа после commit. Изменения кэшей рассылаются воркерам через CACHE_SYNC.
+#
+# Очередь воркера: ("update", dict) | ("reply", req_id, ok, result, events) | ("sync", events)
+#                  | ("callback", req_id, ref, args) | ("stop",)
+# Очередь писателя: ("ready", worker_id) | ("call", worker_id, req_id, name, args, kwargs) | None — выход
+
+def update_chat_id(update: dict) -> int:
+    """Ключ партиционирования: id чата (у callback — чата сообщения), иначе отправителя."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender["id"]
+    return 0
+
+
+class RemoteCallback:
+    """Колбэк-аргумент write-хелпера (progress): в пишущем процессе его вызовы уходят обратно воркеру."""
+
+    __slots__ = ("ref",)
+
+    def __init__(self, ref: int | str):
+        self.ref = ref
+
+
+def _portable(value, ref: int | str, callbacks: dict):
+    """Аргумент write-хелпера для другого процесса: файлы передаются байтами, колбэки — ссылкой."""
+    if hasattr(value, "read") and not isinstance(value, io.BytesIO):
+        return io.BytesIO(value.read())
+    if callable(value):
+        callbacks[ref] = value
+        return RemoteCallback(ref)
+    return value
+
+
+class WriterClient:
+    """Воркер: вызывает write-хелперы в пишущем процессе и ждёт ответа."""
+
+    def __init__(self, worker_id: int, requests):
+        self.worker_id = worker_id
+        self.requests = requests
+        self._ids = itertools.count()
+        self._futures: dict[int, asyncio.Future] = {}
+        self._callbacks: dict[int, dict] = {}
+
+    async def call(self, func, args: tuple, kwargs: dict):
+        req_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[req_id] = future
+        callbacks = {}
+        args = tuple(_portable(a, i, callbacks) for i, a in enumerate(args))
+        kwargs = {k: _portable(v, k, callbacks) for k, v in kwargs.items()}
+        if callbacks:
+            self._callbacks[req_id] = callbacks
+        self.requests.put(("call", self.worker_id, req_id, func.__name__, args, kwargs))
+        return await future
+
+    def callback(self, req_id: int, ref: int | str, args: tuple):
+        func = self._callbacks.get(req_id, {}).get(ref)
+        if func is None:
             return
-        txt = (m.text or "").strip().upper()
-        if txt != "ДА":
-            await m.answer("Чтобы подтвердить, напиши: ДА (или нажми Отмена)")
+        try:
+            func(*args)
+        except Exception:
+            log.exception("worker %s: ошибка в колбэке write-хелпера", self.worker_id)
+
+    async def resolve(self, req_id: int, ok: bool, result, events: list):
+        # свои изменения попадают в кэши воркера до того, как хендлер продолжит работу
+        if events:
+            await run_db(CACHE_SYNC.apply, events)
+        self._callbacks.pop(req_id, None)
+        future = self._futures.pop(req_id)
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+
+class WriterServer:
+    """
+    Пишущая сторона в главном процессе: поток принимает вызовы write-хелперов
+    от воркеров и раздаёт их так же, как run_db в однопроцессном режиме —
+    мутации в GROUP_COMMIT, остальное в DB_EXECUTOR. Записи сериализует
+    блокировка пишущего соединения, а не этот поток, поэтому долгий пересчёт
+    достижений (он пишет кусками) не останавливает записи других воркеров.
+    """
+
+    def __init__(self, requests, inboxes: list):
+        self.requests = requests
+        self.inboxes = inboxes
+        self.all_ready = threading.Event()
+        self.calls = 0
+        self._ready = 0
+        self._thread = threading.Thread(target=self._serve, name="db-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def _serve(self):
+        while True:
+            msg = self.requests.get()
+            if msg is None:
+                return
+            if msg[0] == "call":
+                self._call(*msg[1:])
+            elif msg[0] == "ready":
+                self._ready += 1
+                if self._ready == len(self.inboxes):
+                    self.all_ready.set()
+
+    def _call(self, worker_id: int, req_id: int, name: str, args: tuple, kwargs: dict):
+        mutation = getattr(WRITE_OPS[name], "mutation", None)
+        if mutation is not None:
+            # group commit: не ждём, ответ уйдёт из потока очереди после commit пачки
+            future = db_timed_future(name, GROUP_COMMIT.submit(mutation, *args), args)
+            future.add_done_callback(lambda f: self._reply_future(worker_id, req_id, f))
             return
-        data = await state.get_data()
-        target_id = data["target_id"]
-        cnt = delete_all_grades_for_user(target_id)
-        log.info("admin clear grades admin=%s target=%s count=%s", m.from_user.id, target_id, cnt)
-        await state.clear()
-        await m.answer(f"✅ Удалено оценок у пользователя id={target_id}: {cnt}", reply_markup=admin_kb())
-
-    # --- Fallback
-    @dp.message()
-    async def fallback(m: Message):
-        user = get_user(m.from_user.id)
-        if not user:
-            await m.answer("Нажми /start чтобы зарегистрироваться.")
+        args = tuple(self._bind(worker_id, req_id, a) for a in args)
+        kwargs = {k: self._bind(worker_id, req_id, v) for k, v in kwargs.items()}
+        DB_EXECUTOR.submit(self._run, worker_id, req_id, name, args, kwargs)
+
+    def _bind(self, worker_id: int, req_id: int, value):
+        if not isinstance(value, RemoteCallback):
+            return value
+        ref, inbox = value.ref, self.inboxes[worker_id]
+        return lambda *a: inbox.put(("callback", req_id, ref, a))
+
+    def _run(self, worker_id: int, req_id: int, name: str, args: tuple, kwargs: dict):
+        with CACHE_SYNC.capture() as events:
+            try:
+                result, ok = WRITE_OPS[name](*args, **kwargs), True
+            except Exception as e:
+                result, ok = e, False
+        self._reply(worker_id, req_id, ok, result, list(events))
+
+    def _reply_future(self, worker_id: int, req_id: int, future: Future):
+        error = future.exception()
+        if error is None:
+            self._reply(worker_id, req_id, True, future.result(), future.cache_events)
         else:
-            await m.answer("Выбирай действие кнопками 👇", reply_markup=main_kb(m.from_user.id))
+            self._reply(worker_id, req_id, False, error, getattr(future, "cache_events", []))
 
-    log.info("Start polling...")
+    def _reply(self, worker_id: int, req_id: int, ok: bool, result, events: list):
+        if not ok:
+            import pickle
+            try:
+                pickle.dumps(result)
+            except Exception:
+                result = RuntimeError(repr(result))
+        self.calls += 1
+        self.inboxes[worker_id].put(("reply", req_id, ok, result, events))
+        if events:
+            for i, inbox in enumerate(self.inboxes):
+                if i != worker_id:
+                    inbox.put(("sync", events))
+
+
+def worker_main(worker_id: int, inbox, requests, workers: int, db_name: str, session_factory=None):
+    """Точка входа процесса-воркера."""
+    global DB_NAME, DB_WRITER, OUTBOX
+    # остановку (Ctrl+C, SIGTERM на всю группу) обрабатывает главный процесс: он дошлёт «stop»
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    DB_NAME = db_name
+    DB_WRITER = WriterClient(worker_id, requests)
+    # общий лимит Telegram на бота делится между воркерами; лимит на чат — нет (чаты разделены)
+    OUTBOX = Outbox(rate=OUTBOX_RATE / workers)
+    asyncio.run(_worker_loop(worker_id, inbox, requests, session_factory))
+
+
+async def _worker_loop(worker_id: int, inbox, requests, session_factory):
+    loop = asyncio.get_running_loop()
+    bot = Bot(TOKEN, session=session_factory() if session_factory else None)
+    dp = build_dispatcher()
+    await run_db(warm_caches)
+    chains: dict[int, asyncio.Task] = {}
+    stopped = asyncio.Event()
+
+    async def handle(chat_id: int, update: dict, previous: asyncio.Task | None):
+        # апдейты одного чата — строго по порядку (FSM), разных чатов — параллельно
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            log.exception("worker %s: ошибка в апдейте %s", worker_id, update.get("update_id"))
+        finally:
+            if chains.get(chat_id) is asyncio.current_task():
+                del chains[chat_id]
+
+    def on_message(msg: tuple):
+        if msg[0] == "update":
+            chat_id = update_chat_id(msg[1])
+            chains[chat_id] = loop.create_task(handle(chat_id, msg[1], chains.get(chat_id)))
+        elif msg[0] == "reply":
+            spawn(DB_WRITER.resolve(*msg[1:]))
+        elif msg[0] == "callback":
+            DB_WRITER.callback(*msg[1:])
+        elif msg[0] == "sync":
+            spawn(run_db(CACHE_SYNC.apply, msg[1]))
+        elif msg[0] == "stop":
+            stopped.set()
+
+    def read_inbox():
+        while True:
+            loop.call_soon_threadsafe(on_message, inbox.get())
+
+    threading.Thread(target=read_inbox, name="inbox", daemon=True).start()
+    requests.put(("ready", worker_id))
+    await stopped.wait()
+    while chains:
+        await asyncio.wait(list(chains.values()))
+    await dp.emit_shutdown(bot=bot)
+    await dp.storage.close()
+    await bot.session.close()
+    await run_db(db_close)
+
+
+class WorkerPool:
+    """Главный процесс: пишущий поток, N воркеров и раздача апдейтов по chat_id."""
+
+    def __init__(self, workers: int, session_factory=None):
+        import multiprocessing
+        ctx = multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.requests = ctx.Queue()
+        self.inboxes = [ctx.Queue() for _ in range(workers)]
+        self.server = WriterServer(self.requests, self.inboxes)
+        self.procs = [
+            ctx.Process(
+                target=worker_main,
+                args=(i, self.inboxes[i], self.requests, workers, DB_NAME, session_factory),
+                name=f"bot-worker-{i}",
+            )
+            for i in range(workers)
+        ]
+
+    async def start(self):
+        """База к этому моменту уже мигрирована (startup)."""
+        started = time.perf_counter()
+        self.server.start()
+        for proc in self.procs:
+            proc.start()
+        while not await asyncio.to_thread(self.server.all_ready.wait, 0.5):
+            dead = [proc.name for proc in self.procs if not proc.is_alive()]
+            if dead:
+                raise RuntimeError(f"Не запустились воркеры: {', '.join(dead)}")
+        log.info("Воркеров: %s, готовы за %.0f мс", self.workers, (time.perf_counter() - started) * 1000)
+
+    def dispatch(self, update: dict):
+        self.inboxes[update_chat_id(update) % self.workers].put(("update", update))
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Воркеры дообрабатывают принятые апдейты и сбрасывают FSM; пишущий поток ждёт их до конца."""
+        for inbox in self.inboxes:
+            inbox.put(("stop",))
+        for proc in self.procs:
+            await asyncio.to_thread(proc.join, timeout)
+            if proc.is_alive():
+                log.warning("%s не остановился за %s с", proc.name, timeout)
+                proc.terminate()
+        self.requests.put(None)
+        await asyncio.to_thread(self.server.join)
+
+
+async def _poll_updates(bot: Bot, dispatch, allowed_updates: list[str]):
+    """Long polling без Dispatcher: апдейты сразу уходят воркерам."""
+    offset = None
     try:
-        await dp.start_polling(bot)
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                log.warning("getUpdates: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            # подтверждаем розданные апдейты, иначе после перезапуска Telegram пришлёт их снова
+            with suppress(Exception):
+                await bot.get_updates(offset=offset, timeout=0, limit=1)
+
+
+async def _serve_webhook_updates(bot: Bot, dispatch, allowed_updates: list[str], stop: asyncio.Event):
+    """Приёмник вебхука: только проверка секрета и раздача апдейта воркеру."""
+    from aiohttp import web
+
+    async def receive(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        dispatch(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    log.info("Webhook server on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=allowed_updates,
+        )
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_workers(dp: Dispatcher, bot: Bot, workers: int, webhook: bool = False):
+    """
+    Приём апдейтов для N воркеров. Апдейты одного чата всегда попадают в один
+    воркер и обрабатываются там по порядку, поэтому FSM-состояние пользователя
+    живёт в одном процессе. dp здесь только для allowed_updates и shutdown.
+    """
+    pool = WorkerPool(workers)
+    await pool.start()
+    allowed = dp.resolve_used_update_types()
+    stop = asyncio.Event()
+    stop_on_signals(stop)
+    try:
+        if webhook:
+            await _serve_webhook_updates(bot, pool.dispatch, allowed, stop)
+        else:
+            log.info("Start polling (%s воркеров)...", workers)
+            poller = asyncio.create_task(_poll_updates(bot, pool.dispatch, allowed))
+            waiter = asyncio.create_task(stop.wait())
+            await asyncio.wait({poller, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            poller.cancel()
+            with suppress(asyncio.CancelledError):
+                await poller
+    finally:
+        await pool.stop()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+# ========= METRICS HTTP =========
+@METRICS.collector
+def _runtime_metrics():
+    users = USER_CACHE.stats()
+    outbox = OUTBOX.stats()
+    return [
+        ("bot_user_cache_hits_total", "counter", "Попадания в кэш пользователей", users["hits"]),
+        ("bot_user_cache_misses_total", "counter", "Промахи кэша пользователей", users["misses"]),
+        ("bot_outbox_pending", "gauge", "Сообщения в очереди отправки", outbox["pending"]),
+        ("bot_outbox_failed_total", "counter", "Недоставленные сообщения", outbox["failed"]),
+        ("bot_leaderboard_users", "gauge", "Пользователей в лидерборде", len(LEADERBOARD)),
+    ]
+
+
+async def start_metrics_server():
+    """Локальный HTTP-сервер с GET /metrics; возвращает AppRunner (для cleanup)."""
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log.info("Metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+
+async def startup(bot: Bot, webhook: bool = False) -> dict:
+    """
+    Подготовка к приёму апдейтов. Миграции, прогрев кэшей (каждый своим
+    читающим соединением), get_me и снятие вебхука идут параллельно;
+    уведомления админам только ставятся в OUTBOX и старт не задерживают.
+    Возвращает тайминги в мс: import (загрузка модуля), из неё aiogram, init (эта функция),
+    total и own = total - aiogram — то, что сравнивается с STARTUP_TARGET_MS.
+    """
+    started = time.perf_counter()
+
+    async def init_db():
+        await run_db(db_migrate)
+        await asyncio.gather(
+            run_db(seed_default_subjects),
+            run_db(warm_cache, LEADERBOARD),
+            run_db(warm_cache, ACHIEVEMENT_ENGINE),
+            run_db(warm_cache, USER_NAMES),
+            run_db(warm_cache, PERCENTILES),
+        )
+
+    calls = [bot.me(), init_db()]  # bot.me() кэширует ответ — start_polling не спросит повторно
+    if not webhook:
+        # если раньше работали через вебхук — polling без этого получит конфликт
+        calls.append(bot.delete_webhook())
+    me, *_ = await asyncio.gather(*calls)
+    log.info("✅ Bot started as @%s (id=%s)", me.username, me.id)
+    # сообщение админу о запуске
+    for admin_id in ADMIN_IDS:
+        OUTBOX.send(bot, admin_id, f"✅ Бот запущен: @{me.username}")
+
+    ready = time.perf_counter()
+    timings = {
+        "import": (started - PROCESS_STARTED) * 1000,
+        "aiogram": (AIOGRAM_LOADED - PROCESS_STARTED) * 1000,
+        "init": (ready - started) * 1000,
+        "total": (ready - PROCESS_STARTED) * 1000,
+    }
+    timings["own"] = timings["total"] - timings["aiogram"]
+    level = logging.WARNING if timings["own"] > STARTUP_TARGET_MS else logging.INFO
+    log.log(level, "Старт за %.0f мс: aiogram %.0f мс, свои %.0f мс (загрузка %.0f мс, подготовка %.0f мс; цель %.0f мс)",
+            timings["total"], timings["aiogram"], timings["own"], timings["import"] - timings["aiogram"],
+            timings["init"], STARTUP_TARGET_MS)
+    return timings
+
+
+async def main(webhook: bool = False, workers: int = WORKERS):
+    if not TOKEN:
+        raise SystemExit("TOKEN не найден. Создай .env и добавь TOKEN=...")
+    if TOKEN == "PASTE_YOUR_TOKEN_HERE":
+        raise SystemExit("Вставь токен в переменную TOKEN в начале файла.")
+
+    bot = Bot(TOKEN)
+    dp = build_dispatcher()
+    await startup(bot, webhook=webhook)
+
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    try:
+        if workers > 1:
+            await run_workers(dp, bot, workers, webhook=webhook)
+        elif webhook:
+            await run_webhook(dp, bot)
+        else:
+            log.info("Start polling...")
+            await dp.start_polling(bot)
     finally:
-        log.info("Polling stopped.")
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await run_db(db_close)
+        log.info("Bot stopped.")
+
+
+def cli(argv=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="TG Grades Bot")
+    parser.add_argument("--migrate", action="store_true", help="применить миграции базы и выйти")
+    parser.add_argument("--dry-run", action="store_true", help="вместе с --migrate: только показать, что будет применено")
+    parser.add_argument("--explain", action="store_true", help="показать EXPLAIN QUERY PLAN запросов хелперов")
+    parser.add_argument("--recompute-achievements", action="store_true", help="пересчитать достижения по истории оценок и выйти")
+    parser.add_argument("--chunk-size", type=int, default=20000, help="вместе с --recompute-achievements: оценок за транзакцию")
+    parser.add_argument("--webhook", action="store_true", help="принимать апдейты через webhook вместо long polling")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="процессов-обработчиков (0/1 — один процесс)")
+    args = parser.parse_args(argv)
+
+    if args.migrate:
+        pending = db_migrate(dry_run=args.dry_run)
+        if not pending:
+            print("Схема актуальна.")
+        for version, description, steps in pending:
+            print(f"{'[dry-run] ' if args.dry_run else ''}#{version}: {description}")
+            for step in steps:
+                print(f"    {step}")
+        return 0
+
+    if args.explain:
+        db_migrate()
+        failed = False
+        for name, (plan, full_scan) in explain_queries().items():
+            print(f"{'❌' if full_scan else '✅'} {name}")
+            for line in plan:
+                print(f"    {line}")
+            failed = failed or full_scan
+        return 1 if failed else 0
+
+    if args.recompute_achievements:
+        db_migrate()
+
+        def progress(done: int, total: int):
+            print(f"\r{done}/{total} оценок", end="", flush=True)
+
+        result = recompute_achievements(chunk_size=args.chunk_size, progress=progress)
+        print(f"\nПользователей: {result['users']}, выдано/исправлено достижений: {result['changed']}, "
+              f"сброшено счётчиков без оценок: {result['dropped']}")
+        return 0
+
+    asyncio.run(main(webhook=args.webhook, workers=args.workers))
+    return 0
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    sys.exit(cli())
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Пустая мигрированная база во временном каталоге; кэши построены по ней."""
+    bot.db_close()
+    monkeypatch.setattr(bot, "DB_NAME", str(tmp_path / "grades.db"))
+    bot.USER_CACHE.invalidate()
+    bot.db_init()
+    yield tmp_path
+    bot.db_close()
+
+
+@pytest.fixture
+def add_users(db):
+    """add_users((tg_id, "Имя Фамилия"), ...) — верифицированные пользователи, индекс имён перестроен."""
+
+    def add(*users: tuple[int, str]):
+        with bot.db_write() as conn:
+            conn.executemany("INSERT INTO users(tg_id, full_name, is_verified) VALUES(?, ?, 1)", users)
+        with bot.db_read() as conn:
+            bot.USER_NAMES.load(conn)
+
+    return add
+
+
+def _rows(conn, sql: str) -> set[tuple]:
+    return {tuple(round(v, 6) if isinstance(v, float) else v for v in r) for r in conn.execute(sql)}
+
+
+@pytest.fixture
+def check_aggregates():
+    """Сверяет таблицы, которые ведут триггеры, с пересчётом по grades с нуля."""
+
+    def check(conn):
+        assert _rows(conn, "SELECT tg_id, grade_sum, cnt FROM user_stats") == _rows(
+            conn, "SELECT tg_id, SUM(grade), COUNT(*) FROM grades GROUP BY tg_id")
+        assert _rows(conn, """
+            SELECT tg_id, subject, grade_sum, cnt, max_grade, last_grade_id, last_grade FROM user_subject_stats
+        """) == _rows(conn, """
+            SELECT a.tg_id, a.subject, a.s, a.c, a.m, a.last_id, g.grade
+            FROM (SELECT tg_id, subject, SUM(grade) AS s, COUNT(*) AS c, MAX(grade) AS m, MAX(id) AS last_id
+                  FROM grades GROUP BY tg_id, subject) a
+            JOIN grades g ON g.id = a.last_id
+        """)
+        assert _rows(conn, "SELECT tg_id, subject, day, grade_sum, cnt FROM grade_daily") == _rows(
+            conn, "SELECT tg_id, subject, date(created_at), SUM(grade), COUNT(*) FROM grades GROUP BY 1, 2, 3")
+
+        rollups: dict[tuple, list] = {}
+        for r in conn.execute("SELECT tg_id, subject, grade, created_at FROM grades"):
+            ts = datetime.strptime(r["created_at"], "%Y-%m-%d %H:%M:%S")
+            for period in bot.period_keys(ts).values():
+                for subject in (r["subject"], "*"):
+                    acc = rollups.setdefault((subject, period, r["tg_id"]), [0.0, 0])
+                    acc[0] += r["grade"]
+                    acc[1] += 1
+        expected = {(*key, round(s, 6), c) for key, (s, c) in rollups.items()}
+        assert _rows(conn, "SELECT subject, period, tg_id, grade_sum, cnt FROM grade_rollups") == expected
+
+    return check
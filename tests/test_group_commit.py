@@ -0,0 +1,78 @@
+from concurrent.futures import Future
+
+import pytest
+
+import bot
+
+
+def _batch(*items) -> list:
+    return [(func, args, Future()) for func, *args in items]
+
+
+def _failing(conn, tg_id: int):
+    """Мутация, которая успевает поменять базу и кэши и только потом падает."""
+    bot._add_grade(conn, tg_id, "Астрономия", 5.0)
+    raise ValueError("boom")
+
+
+def _breaking(conn, tg_id: int):
+    """Мутация, после которой не переживает вся пачка (RELEASE без SAVEPOINT)."""
+    bot._add_grade(conn, tg_id, "Астрономия", 5.0)
+    conn.execute("ROLLBACK")
+
+
+def _grades(tg_id: int) -> int:
+    with bot.db_read() as conn:
+        return conn.execute("SELECT COUNT(*) FROM grades WHERE tg_id=?", (tg_id,)).fetchone()[0]
+
+
+def test_failed_mutation_rolls_back_only_itself(add_users):
+    add_users((1, "Иван Иванов"), (2, "Пётр Петров"), (3, "Анна Орлова"))
+    batch = _batch((bot._add_grade, 1, "Математика", 5.0), (_failing, 2), (bot._add_grade, 3, "История", 4.0))
+    bot.GroupCommitQueue()._commit(batch)
+
+    (_, _, ok1), (_, _, bad), (_, _, ok3) = batch
+    assert ok1.result() == ["first_grade"]
+    assert ok3.result() == ["first_grade"]
+    with pytest.raises(ValueError):
+        bad.result()
+    assert bad.cache_events == []
+    assert ("leaderboard", 1) in ok1.cache_events
+    assert (_grades(1), _grades(2), _grades(3)) == (1, 0, 1)
+
+    # откатившаяся мутация не оставила следов в памяти
+    assert "Астрономия" not in bot.SUBJECTS
+    assert bot.LEADERBOARD.rank(2) is None
+    assert bot.PERCENTILES.top_percent(2) is None
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(2) == []
+    # а успешные — на месте
+    assert bot.LEADERBOARD.rank(1) == 1
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(3) == ["first_grade"]
+
+
+def test_failed_batch_fails_every_future_and_restores_caches(add_users):
+    add_users((1, "Иван Иванов"), (2, "Пётр Петров"))
+    batch = _batch((bot._add_grade, 1, "Математика", 5.0), (_breaking, 2))
+    bot.GroupCommitQueue()._commit(batch)
+
+    for _, _, future in batch:
+        with pytest.raises(Exception):
+            future.result()
+        assert future.cache_events == []
+    assert (_grades(1), _grades(2)) == (0, 0)
+    assert "Астрономия" not in bot.SUBJECTS
+    assert len(bot.LEADERBOARD) == 0
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(1) == []
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(2) == []
+
+
+def test_submit_batches_concurrent_writes(add_users):
+    add_users(*((i, f"Ученик{i} Тестовый") for i in range(1, 21)))
+    queue = bot.GroupCommitQueue(max_batch=8, max_delay=0.05)
+    futures = [queue.submit(bot._add_grade, i, "Математика", 4.0) for i in range(1, 21)]
+    assert all(f.result(timeout=5) == ["first_grade"] for f in futures)
+    stats = queue.stats()
+    assert stats["items"] == 20
+    assert stats["batches"] < 20
+    assert stats["largest"] <= 8
+    assert len(bot.LEADERBOARD) == 20
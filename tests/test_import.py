@@ -0,0 +1,160 @@
+import io
+from datetime import date, datetime
+
+import pytest
+
+import bot
+
+
+def _csv(text: str, encoding: str = "utf-8") -> io.BytesIO:
+    return io.BytesIO(text.encode(encoding))
+
+
+def _grades() -> list[tuple]:
+    with bot.db_read() as conn:
+        return [tuple(r) for r in conn.execute("SELECT tg_id, subject, grade, created_at FROM grades ORDER BY id")]
+
+
+def test_rejects_bad_rows_and_imports_the_rest(add_users):
+    add_users((1, "Иван Иванов"), (2, "Пётр Петров"), (3, "Пётр Петров"))
+    result = bot.import_grades(_csv(
+        "user;subject;grade;date\n"
+        "Иван Иванов;Математика;4,5;15.09.2025\n"
+        "99;История;5;\n"
+        "Пётр Петров;История;5;\n"
+        "Сидор Сидоров;История;5;\n"
+        "1;История;7;\n"
+        "1;История;пять;\n"
+        "1;Х;5;\n"
+        "1;История;5;32.13.2025\n"
+        "1;История;5;31.12.2099\n"
+        "\n"
+        "2;химия;3;2025-09-16\n",
+        encoding="cp1251",
+    ))
+
+    assert result["errors"] == [
+        (3, "нет пользователя с id=99"),
+        (4, "«Пётр Петров» — несколько пользователей, укажи tg_id"),
+        (5, "пользователь «Сидор Сидоров» не найден"),
+        (6, "оценка «7» не число 2–5"),
+        (7, "оценка «пять» не число 2–5"),
+        (8, "не указан предмет"),
+        (9, "не понял дату «32.13.2025»"),
+        (10, "дата в будущем"),
+    ]
+    assert result["imported"] == 2
+    assert result["users"] == 2
+    assert result["new_subjects"] == ["химия"]
+    assert _grades() == [
+        (1, "Математика", 4.5, "2025-09-15 00:00:00"),
+        (2, "химия", 3.0, "2025-09-16 00:00:00"),
+    ]
+    assert "химия" in bot.SUBJECTS
+    assert bot.LEADERBOARD.rank(1) == 1
+
+
+def test_only_bad_rows_import_nothing(add_users):
+    add_users((1, "Иван Иванов"))
+    result = bot.import_grades(_csv("1,Математика,9\nнекто,Математика,5\n"))
+    assert result["imported"] == 0
+    assert [line for line, _ in result["errors"]] == [1, 2]
+    assert _grades() == []
+
+
+def test_existing_subject_keeps_its_spelling(add_users):
+    add_users((1, "Иван Иванов"))
+    result = bot.import_grades(_csv("1\tматематика\t5\n"))
+    assert result["new_subjects"] == []
+    assert _grades()[0][1] == "Математика"
+
+
+def test_aborted_import_restores_caches(add_users, monkeypatch):
+    add_users((1, "Иван Иванов"))
+    monkeypatch.setattr(bot, "IMPORT_CHUNK_ROWS", 2)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(bot.PERCENTILES, "refresh_user", fail)
+    with pytest.raises(RuntimeError):
+        bot.import_grades(_csv("1;Математика;5\n" * 5 + "1;Астрономия;5\n"))
+
+    assert _grades() == []
+    assert "Астрономия" not in bot.SUBJECTS
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(1) == []
+    assert bot.LEADERBOARD.rank(1) is None
+
+
+def test_xlsx(add_users):
+    openpyxl = pytest.importorskip("openpyxl")
+    add_users((1, "Иван Иванов"), (2, "Пётр Петров"))
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.append(["ученик", "предмет", "оценка", "дата"])
+    sheet.append([1, "Математика", 5, datetime(2025, 10, 1, 12, 30)])
+    sheet.append([2.0, "История", 4.5, date(2025, 10, 2)])
+    sheet.append(["Пётр Петров", "История", "abc", None])
+    buf = io.BytesIO()
+    book.save(buf)
+    buf.seek(0)
+
+    result = bot.import_grades(buf)
+    assert result["imported"] == 2
+    assert result["errors"] == [(4, "оценка «abc» не число 2–5")]
+    assert _grades() == [
+        (1, "Математика", 5.0, "2025-10-01 12:30:00"),
+        (2, "История", 4.5, "2025-10-02 00:00:00"),
+    ]
+
+
+def test_broken_xlsx_is_value_error(db):
+    pytest.importorskip("openpyxl")
+    with pytest.raises(ValueError, match="XLSX"):
+        bot.import_grades(io.BytesIO(b"PK\x03\x04not really a zip"))
+
+
+def test_header_after_blank_lines_and_error_cap(add_users, monkeypatch):
+    add_users((1, "Иван Иванов"))
+    monkeypatch.setattr(bot, "IMPORT_MAX_ERRORS", 3)
+    result = bot.import_grades(_csv(
+        ";;\n\n"
+        "оценка;предмет;ученик\n"
+        "5;Математика;1\n"
+        + "9;Математика;1\n" * 5
+    ))
+    assert result["imported"] == 1
+    assert result["error_count"] == 5
+    assert result["errors"] == [(line, "оценка «9» не число 2–5") for line in (5, 6, 7)]
+
+
+def test_achievements_follow_dates_not_file_order(add_users, monkeypatch):
+    add_users((1, "Иван Иванов"), (2, "Пётр Петров"))
+
+    def per_row(*args):
+        raise AssertionError("импорт не должен сдвигать счётчики построчно")
+
+    monkeypatch.setattr(bot.ACHIEVEMENT_ENGINE, "grade_added", per_row)
+    result = bot.import_grades(_csv(
+        "1;Математика;5;03.09.2025\n"
+        "2;Математика;5;\n"
+        "1;Математика;3;01.09.2025\n"
+        "1;Математика;5;04.09.2025\n"
+        "1;Математика;5;02.09.2025\n"
+    ))
+    assert result["imported"] == 5
+
+    # по датам: 3, 5, 5, 5 — серия из трёх пятёрок, открытая оценкой от 04.09
+    with bot.db_read() as conn:
+        state = conn.execute("SELECT cnt, grade_sum, streak5 FROM achievement_state WHERE tg_id=1").fetchone()
+        unlocked_at = conn.execute(
+            "SELECT unlocked_at FROM user_achievements WHERE tg_id=1 AND code='streak3_5'"
+        ).fetchone()[0]
+        assert conn.execute(bot.SQL_STREAK5, (1, 1)).fetchone()["streak5"] == 3
+    assert tuple(state) == (4, 18.0, 3)
+    assert unlocked_at == "2025-09-04 00:00:00"
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(1) == ["first_grade", "streak3_5"]
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(2) == ["first_grade"]
+
+    # пересчёт по истории приходит к тому же
+    assert bot.recompute_achievements()["changed"] == 0
@@ -0,0 +1,98 @@
+import sqlite3
+
+import bot
+
+# схема из init_db до версионных миграций; у users ещё нет is_verified
+BASELINE_SCHEMA = """
+CREATE TABLE users (tg_id INTEGER PRIMARY KEY, full_name TEXT NOT NULL);
+CREATE TABLE subjects (name TEXT PRIMARY KEY);
+CREATE TABLE grades (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tg_id INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    grade REAL NOT NULL CHECK(grade >= 2.0 AND grade <= 5.0),
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY(tg_id) REFERENCES users(tg_id),
+    FOREIGN KEY(subject) REFERENCES subjects(name)
+);
+CREATE TABLE user_achievements (
+    tg_id INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    unlocked_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (tg_id, code),
+    FOREIGN KEY(tg_id) REFERENCES users(tg_id)
+);
+"""
+
+
+def _baseline_db(path: str):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO users VALUES(?, ?)", [(1, "Иван Иванов"), (2, "Пётр Семёнов"), (3, "Анна Орлова")])
+    conn.executemany("INSERT INTO subjects VALUES(?)", [("Математика",), ("История",)])
+    conn.executemany("INSERT INTO grades(tg_id, subject, grade, created_at) VALUES(?, ?, ?, ?)", [
+        (1, "Математика", 5.0, "2025-09-01 10:00:00"),
+        (1, "Математика", 5.0, "2025-09-02 10:00:00"),
+        (1, "История", 3.0, "2025-11-10 10:00:00"),
+        (2, "История", 4.5, "2026-01-12 10:00:00"),
+    ])
+    conn.commit()
+    conn.close()
+
+
+def test_migrates_baseline_db(tmp_path, monkeypatch, check_aggregates):
+    path = str(tmp_path / "old.db")
+    _baseline_db(path)
+    bot.db_close()
+    monkeypatch.setattr(bot, "DB_NAME", path)
+    try:
+        bot.db_init()
+        with bot.db_read() as conn:
+            assert bot.get_schema_version(conn) == bot.MIGRATIONS[-1][0]
+            versions = [r["version"] for r in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+            assert versions == [v for v, _, _ in bot.MIGRATIONS]
+            # старые пользователи не верифицированы, данные на месте
+            assert {tuple(r) for r in conn.execute("SELECT tg_id, is_verified FROM users")} == {(1, 0), (2, 0), (3, 0)}
+            assert conn.execute("SELECT COUNT(*) FROM grades").fetchone()[0] == 4
+            # агрегаты и роллапы заполнены по существующим оценкам
+            check_aggregates(conn)
+            state = conn.execute("SELECT cnt, grade_sum, streak5 FROM achievement_state WHERE tg_id=1").fetchone()
+            assert tuple(state) == (3, 13.0, 0)
+
+        # кэши строятся из перенесённых данных; поиск по имени понимает ё
+        assert bot.LEADERBOARD.rank(2) == 1
+        rows, _, _ = bot.list_users_page(query="семен")
+        assert [r["tg_id"] for r in rows] == [2]
+
+        # повторный запуск ничего не применяет
+        assert bot.db_migrate() == []
+    finally:
+        bot.db_close()
+
+
+def test_dry_run_lists_pending_without_applying(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    _baseline_db(path)
+    bot.db_close()
+    monkeypatch.setattr(bot, "DB_NAME", path)
+    try:
+        pending = bot.db_migrate(dry_run=True)
+        assert [v for v, _, _ in pending] == [v for v, _, _ in bot.MIGRATIONS]
+        with bot.db_read() as conn:
+            assert bot.get_schema_version(conn) == 0
+            cols = {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+            tables = {r["name"] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        assert "is_verified" not in cols
+        assert "schema_version" not in tables
+    finally:
+        bot.db_close()
+
+
+def test_dry_run_does_not_create_db(tmp_path, monkeypatch):
+    bot.db_close()
+    monkeypatch.setattr(bot, "DB_NAME", str(tmp_path / "grades.db"))
+    try:
+        assert len(bot.db_migrate(dry_run=True)) == len(bot.MIGRATIONS)
+    finally:
+        bot.db_close()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,40 @@
+import bot
+
+
+def _states() -> dict[int, tuple]:
+    with bot.db_read() as conn:
+        return {r["tg_id"]: tuple(r)[1:] for r in conn.execute("SELECT tg_id, cnt, grade_sum, streak5 FROM achievement_state")}
+
+
+def test_recompute_matches_history_and_drops_stale_state(add_users):
+    add_users(*((i, f"Ученик{i} Тестовый") for i in range(1, 8)))
+    with bot.db_write() as conn:
+        conn.executemany("INSERT INTO grades(tg_id, subject, grade, created_at) VALUES(?, 'Математика', ?, ?)", [
+            (2, 5.0, "2025-09-01 10:00:00"),
+            (2, 5.0, "2025-09-02 10:00:00"),
+            (2, 5.0, "2025-09-03 10:00:00"),
+            (5, 3.0, "2025-09-01 10:00:00"),
+        ])
+        # счётчики, оставшиеся от удалённых оценок: до первого, между и после последнего пользователя с оценками
+        conn.executemany("INSERT INTO achievement_state(tg_id, cnt, grade_sum, streak5) VALUES(?, ?, ?, ?)", [
+            (1, 4, 20.0, 4), (2, 1, 2.0, 0), (3, 2, 10.0, 2), (4, 1, 5.0, 1), (7, 9, 45.0, 9),
+        ])
+        conn.execute("INSERT INTO user_achievements(tg_id, code, unlocked_at) VALUES(7, 'first_grade', '2025-01-01 00:00:00')")
+    bot.warm_caches()
+
+    calls = []
+    result = bot.recompute_achievements(chunk_size=2, progress=lambda done, total: calls.append((done, total)))
+
+    # выдано: first_grade и streak3_5 у 2, first_grade у 5; сброшены счётчики 1, 3, 4 и 7
+    assert result == {"grades": 4, "users": 2, "changed": 3, "dropped": 4}
+    assert calls[-1] == (4, 4)
+    assert _states() == {2: (3, 15.0, 3), 5: (1, 3.0, 0)}
+    # выданные достижения не отбираются — как при удалении оценок
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(7) == ["first_grade"]
+    assert bot.ACHIEVEMENT_ENGINE.unlocked(2) == ["first_grade", "streak3_5"]
+    with bot.db_read() as conn:
+        dates = dict(conn.execute("SELECT code, unlocked_at FROM user_achievements WHERE tg_id=2").fetchall())
+    assert dates == {"first_grade": "2025-09-01 10:00:00", "streak3_5": "2025-09-03 10:00:00"}
+
+    # следующий пересчёт ничего не меняет
+    assert bot.recompute_achievements(chunk_size=2) == {"grades": 4, "users": 2, "changed": 0, "dropped": 0}
@@ -0,0 +1,62 @@
+import bot
+
+
+def _insert(*grades: tuple[int, str, float, str]):
+    with bot.db_write() as conn:
+        conn.executemany("INSERT INTO grades(tg_id, subject, grade, created_at) VALUES(?, ?, ?, ?)", grades)
+
+
+def _grade_ids(tg_id: int) -> list[int]:
+    with bot.db_read() as conn:
+        return [r["id"] for r in conn.execute("SELECT id FROM grades WHERE tg_id=? ORDER BY id", (tg_id,))]
+
+
+def test_aggregates_follow_inserts(add_users, check_aggregates):
+    add_users((1, "Иван Иванов"), (2, "Пётр Петров"))
+    _insert(
+        (1, "Математика", 5.0, "2025-09-01 10:00:00"),
+        (1, "Математика", 3.5, "2025-09-01 18:00:00"),
+        (1, "История", 4.0, "2025-11-03 09:00:00"),
+        (2, "Математика", 2.0, "2026-01-15 12:00:00"),
+    )
+    bot.add_grade_db(2, "Математика", 4.5)
+    with bot.db_read() as conn:
+        check_aggregates(conn)
+        row = conn.execute("SELECT max_grade, last_grade FROM user_subject_stats WHERE tg_id=1 AND subject='Математика'").fetchone()
+    assert (row["max_grade"], row["last_grade"]) == (5.0, 3.5)
+
+
+def test_aggregates_follow_deletes(add_users, check_aggregates):
+    add_users((1, "Иван Иванов"), (2, "Пётр Петров"))
+    _insert(
+        (1, "Математика", 5.0, "2025-09-01 10:00:00"),
+        (1, "Математика", 3.0, "2025-10-20 10:00:00"),
+        (1, "Математика", 4.0, "2025-10-21 10:00:00"),
+        (2, "История", 4.0, "2025-12-01 10:00:00"),
+    )
+    bot.warm_caches()
+    first, _, last = _grade_ids(1)
+
+    # удалили максимум и последнюю оценку — max/last пересчитываются по оставшимся
+    assert bot.delete_grade_by_id(1, first)
+    assert bot.delete_grade_by_id(1, last)
+    with bot.db_read() as conn:
+        check_aggregates(conn)
+        row = conn.execute("SELECT cnt, max_grade, last_grade FROM user_subject_stats WHERE tg_id=1").fetchone()
+    assert (row["cnt"], row["max_grade"], row["last_grade"]) == (1, 3.0, 3.0)
+
+    # последняя оценка пользователя — строки агрегатов исчезают, а не остаются с нулями
+    assert bot.delete_all_grades(1) == 1
+    with bot.db_read() as conn:
+        check_aggregates(conn)
+        for table in ("user_stats", "user_subject_stats", "grade_rollups", "grade_daily"):
+            assert conn.execute(f"SELECT COUNT(*) FROM {table} WHERE tg_id=1").fetchone()[0] == 0
+    assert bot.LEADERBOARD.rank(1) is None
+    assert bot.LEADERBOARD.rank(2) == 1
+
+    # удаление пользователя вместе с оценками
+    assert bot.delete_user(2)
+    with bot.db_read() as conn:
+        check_aggregates(conn)
+        assert conn.execute("SELECT COUNT(*) FROM user_stats").fetchone()[0] == 0
+    assert len(bot.LEADERBOARD) == 0
@@ -0,0 +1,68 @@
+import bot
+
+NAMES = [
+    (1, "Иванов Иван"),
+    (2, "Петров Пётр"),
+    (3, "Петрова Анна"),
+    (4, "Сидоров Пётр"),
+    (5, "Орлова Анна"),
+]
+
+
+def _index() -> bot.TrigramIndex:
+    index = bot.TrigramIndex()
+    index.reset(NAMES)
+    return index
+
+
+def _keys(index: bot.TrigramIndex, query: str, limit: int = 8) -> list[int]:
+    return [key for key, _ in index.search(query, limit)]
+
+
+def test_full_matches_skip_partial_ones():
+    index = _index()
+    # все триграммы запроса есть только у «Петровой» — частичные совпадения не нужны
+    assert _keys(index, "петрова") == [3]
+    assert _keys(index, "Петров Пётр")[0] == 2
+
+
+def test_partial_matches_rank_by_matched_trigrams():
+    index = bot.TrigramIndex()
+    index.reset([(1, "Петров"), (2, "Петрович"), (3, "Пирогов")])
+    # полного совпадения нет: у «Петрович» 7 триграмм запроса из 8, у «Петров» — 6, у «Пирогов» — меньше половины
+    assert _keys(index, "Петровиц") == [2, 1]
+
+
+def test_ties_go_to_the_closer_string():
+    # обе строки содержат «петров» целиком; короче и ближе к запросу — «Петров Пётр»
+    assert _keys(_index(), "петров")[:2] == [2, 3]
+
+
+def test_prefix_ignores_word_end_and_yo():
+    index = _index()
+    assert set(_keys(index, "петр")) == {2, 3, 4}
+    assert _keys(index, "Пётр") == _keys(index, "петр")
+
+
+def test_typo_still_finds_the_name():
+    index = _index()
+    assert _keys(index, "Иваноф")[0] == 1
+    assert _keys(index, "Сидорв")[0] == 4
+
+
+def test_unrelated_query_and_limit():
+    index = _index()
+    assert index.search("Ъъъ") == []
+    assert index.search("") == []
+    assert len(index.search("анна", limit=1)) == 1
+    assert set(_keys(index, "анна")) == {3, 5}
+
+
+def test_put_replaces_and_removes():
+    index = _index()
+    index.put(2, "Кузнецов Пётр")
+    assert 2 not in _keys(index, "петров")
+    assert _keys(index, "кузнецов") == [2]
+    index.put(2, None)
+    assert _keys(index, "кузнецов") == []
+    assert len(index) == len(NAMES) - 1
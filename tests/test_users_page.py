@@ -0,0 +1,66 @@
+import bot
+
+
+def _ids(rows) -> list[int]:
+    return [r["tg_id"] for r in rows]
+
+
+def _walk_forward(limit: int, query: str | None = None) -> list[list[int]]:
+    pages = []
+    rows, has_prev, has_next = bot.list_users_page(query=query, limit=limit)
+    assert not has_prev
+    pages.append(_ids(rows))
+    while has_next:
+        rows, has_prev, has_next = bot.list_users_page(rows[-1]["tg_id"], "next", query, limit)
+        assert has_prev
+        pages.append(_ids(rows))
+    return pages
+
+
+def test_pages_forward_and_back(add_users):
+    # tg_id нарочно не в порядке имён
+    add_users(*((100 - i, f"Ученик{i:02d} Тестовый") for i in range(1, 13)))
+    order = [100 - i for i in range(1, 13)]
+
+    pages = _walk_forward(5)
+    assert pages == [order[0:5], order[5:10], order[10:12]]
+
+    # назад от последней страницы — ровно те же страницы
+    rows, has_prev, has_next = bot.list_users_page(pages[2][0], "prev", limit=5)
+    assert (_ids(rows), has_prev, has_next) == (order[5:10], True, True)
+    rows, has_prev, has_next = bot.list_users_page(rows[0]["tg_id"], "prev", limit=5)
+    assert (_ids(rows), has_prev, has_next) == (order[0:5], False, True)
+
+
+def test_exact_multiple_of_page_size_has_no_empty_last_page(add_users):
+    add_users(*((i, f"Ученик{i:02d} Тестовый") for i in range(1, 11)))
+    assert _walk_forward(5) == [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]]
+    rows, has_prev, has_next = bot.list_users_page(limit=10)
+    assert (len(rows), has_prev, has_next) == (10, False, False)
+
+
+def test_equal_names_are_ordered_by_id(add_users):
+    add_users((30, "Иван Иванов"), (10, "Иван Иванов"), (20, "Иван Иванов"), (5, "Анна Орлова"))
+    # страница в одну строку: курсор на одинаковых именах не теряет и не повторяет строк
+    assert _walk_forward(1) == [[5], [10], [20], [30]]
+
+
+def test_search_pages_and_edge_queries(add_users):
+    add_users(
+        (1, "Пётр Семёнов"), (2, "Пётр Петров"), (3, "Петра Ивановна"),
+        (4, "Анна Петрова"), (5, "Иван Сидоров"),
+    )
+    # порядок — по имени как есть («Петра» раньше «Пётр»), ё в запросе и в имени равны е
+    assert _walk_forward(2, "петр") == [[4, 3], [2, 1]]
+    assert _walk_forward(10, "пётр сем") == [[1]]
+    rows, has_prev, has_next = bot.list_users_page(query="5")
+    assert (_ids(rows), has_prev, has_next) == ([5], False, False)
+    assert bot.list_users_page(query="404")[0] == []
+    assert bot.list_users_page(query="?!") == ([], False, False)
+
+
+def test_deleted_cursor_restarts_from_first_page(add_users):
+    add_users(*((i, f"Ученик{i:02d} Тестовый") for i in range(1, 8)))
+    bot.delete_user(3)
+    rows, has_prev, has_next = bot.list_users_page(3, "next", limit=3)
+    assert (_ids(rows), has_prev, has_next) == ([1, 2, 4], False, True)